@@ -1,7 +1,31 @@
 from logzero import logger
+from botocore.config import Config
+from urllib.parse import urlparse, urlunparse
 import boto3
 import requests
 import json
+import queue
+import threading
+import time
+
+from models import Incident
+import telemetry
+import settings
+
+_dispatcher = None
+_coalescer = None
+
+# maximum message length per alert type; Slack truncates beyond 40,000 characters and SNS rejects payloads over 256KB
+MESSAGE_LIMITS = {
+    "alert-slack-webhook": 40000,
+    "alert-sns": 200000
+}
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+_sns_clients = {}
+_sns_clients_lock = threading.Lock()
 
 
 def get_alerts_in_group(alert_group_id, alert_definitions):
@@ -12,6 +36,19 @@ def get_alerts_in_group(alert_group_id, alert_definitions):
                 yield alert_id
 
 
+def get_alerts_for_groups(alert_groups, alert_definitions):
+    """
+    Return the alert definitions that deliver_alert_to_groups() would send to, in the same order
+    """
+    alerts_by_id = {alert["id"]: alert for alert in alert_definitions["alerts"]}
+    return [
+        alerts_by_id[alert_id]
+        for alert_group_id in alert_groups
+        for alert_id in get_alerts_in_group(alert_group_id, alert_definitions)
+        if alert_id in alerts_by_id
+    ]
+
+
 def deliver_alert_to_groups(incident, alert_groups, alert_definitions):
     logger.debug("deliver_alert_to_groups")
     for alert_group_id in alert_groups:
@@ -28,23 +65,270 @@ def deliver_alert(incident, alert_id, alert_definitions):
     logger.debug("deliver_alert: delivering to id {}".format(alert_id))
     for alert in alert_definitions["alerts"]:
         if alert["id"] == alert_id:
-            if alert["@type"] == "alert-slack-webhook":
-                alert_slack(incident, alert)
-            elif alert["@type"] == "alert-sns":
-                alert_sns(incident, alert)
+            if _coalescer is not None and incident.endpoint is not None:
+                _coalescer.add(incident, alert)
+            else:
+                dispatch_alert(incident, alert)
+
+
+def dispatch_alert(incident, alert):
+    if _dispatcher is not None:
+        _dispatcher.enqueue(incident, alert)
+    else:
+        send_alert(incident, alert)
+
+
+def send_alert(incident, alert):
+    """
+    Send an incident to one alert sink, returning whether it was delivered
+    """
+    started = time.perf_counter()
+    try:
+        if alert["@type"] == "alert-slack-webhook":
+            alert_slack(incident, alert)
+        elif alert["@type"] == "alert-sns":
+            alert_sns(incident, alert)
+        return True
+    except Exception as e:
+        logger.error("send_alert: problem delivering to {} - {}".format(alert["id"], str(e)))
+        telemetry.ALERT_DELIVERY_ERRORS.inc(type=alert["@type"])
+        return False
+    finally:
+        telemetry.ALERT_DELIVERY_DURATION.observe(time.perf_counter() - started, type=alert["@type"])
 
 
 def alert_slack(incident, alert):
     logger.debug("alert_slack: {} {}".format(alert["id"], incident.message))
-    _ = requests.post(alert["url"], json={"text": incident.message, "link_names": 1})
+    url = get_webhook_url(alert["url"])
+    response = webhook_session(url).post(
+        url,
+        json={"text": incident.message, "link_names": 1},
+        timeout=get_alert_timeout(alert)
+    )
+    response.raise_for_status()
 
 
 def alert_sns(incident, alert):
     logger.debug("alert_sns: {} {}".format(alert["id"], incident.message))
 
-    sns_client = boto3.client("sns", alert["region"])
+    sns_client = get_sns_client(alert["region"], get_alert_timeout(alert))
 
     _ = sns_client.publish(
         TopicArn=alert["arn"],
         Message=json.dumps(incident.as_dict(), indent=4, sort_keys=True)
     )
+
+
+def get_alert_timeout(alert):
+    return alert.get("timeout", settings.ALERT_TIMEOUT_SECONDS)
+
+
+def get_webhook_url(url):
+    """
+    Send the webhook to WEBHOOK_HOST_OVERRIDE instead of its own scheme and host, if set
+    """
+    if not settings.WEBHOOK_HOST_OVERRIDE:
+        return url
+
+    override = urlparse(settings.WEBHOOK_HOST_OVERRIDE)
+    return urlunparse(urlparse(url)._replace(scheme=override.scheme, netloc=override.netloc))
+
+
+def webhook_session(url):
+    """
+    Return the requests.Session shared by every webhook on the same host, so connections are reused
+    """
+    host = urlparse(url).netloc
+
+    with _sessions_lock:
+        if host not in _sessions:
+            _sessions[host] = requests.Session()
+        return _sessions[host]
+
+
+def get_sns_client(region, timeout):
+    with _sns_clients_lock:
+        key = (region, timeout)
+        if key not in _sns_clients:
+            _sns_clients[key] = boto3.client(
+                "sns",
+                region,
+                endpoint_url=settings.SNS_ENDPOINT_URL or None,
+                config=Config(connect_timeout=timeout, read_timeout=timeout)
+            )
+        return _sns_clients[key]
+
+
+def start_dispatcher(workers, max_queued):
+    global _dispatcher
+    _dispatcher = AlertDispatcher(workers, max_queued)
+    _dispatcher.start()
+
+
+def stop_dispatcher(drain_seconds):
+    global _dispatcher
+    if _dispatcher is not None:
+        _dispatcher.stop(drain_seconds)
+        _dispatcher = None
+
+
+class AlertDispatcher:
+    """
+    Deliver alerts on a dedicated pool of worker threads fed by a bounded queue.
+
+    Probe workers only enqueue alerts; they block only if max_queued alerts are
+    already waiting.
+    """
+
+    def __init__(self, workers, max_queued):
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._threads = [
+            threading.Thread(target=self._run, name="alert-dispatcher-{}".format(i), daemon=True)
+            for i in range(workers)
+        ]
+
+    def start(self):
+        logger.info("alerts: starting dispatcher with {} workers".format(len(self._threads)))
+        for thread in self._threads:
+            thread.start()
+
+    def enqueue(self, incident, alert):
+        self._queue.put((incident, alert))
+
+    def stop(self, drain_seconds):
+        """
+        Deliver what is already queued, waiting at most drain_seconds
+        """
+        logger.info("alerts: draining dispatcher ({} queued)".format(self._queue.qsize()))
+        deadline = time.time() + drain_seconds
+
+        for _ in self._threads:
+            try:
+                self._queue.put(None, timeout=max(0.0, deadline - time.time()))
+            except queue.Full:
+                break
+
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.time()))
+
+        if self._queue.qsize() > 0:
+            logger.warning("alerts: dispatcher stopped with {} alerts undelivered".format(self._queue.qsize()))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            incident, alert = item
+            send_alert(incident, alert)
+
+
+def start_coalescing(window_seconds):
+    global _coalescer
+    _coalescer = AlertCoalescer(window_seconds)
+    _coalescer.start()
+
+
+def flush_coalesced():
+    if _coalescer is not None:
+        _coalescer.flush()
+
+
+def stop_coalescing():
+    global _coalescer
+    if _coalescer is not None:
+        _coalescer.stop()
+        _coalescer = None
+
+
+class AlertCoalescer:
+    """
+    Gather endpoint incidents per alert and deliver them as one digest per alert.
+
+    Incidents are held until flush() is called, either at the end of each cycle
+    or, if window_seconds is set, every window_seconds by a background thread.
+    An alert with a single incident in the window receives it unchanged.
+    """
+
+    def __init__(self, window_seconds=0):
+        self.window_seconds = window_seconds
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        logger.info("alerts: coalescing alerts {}".format(
+            "every {}s".format(self.window_seconds) if self.window_seconds > 0 else "per cycle"))
+        if self.window_seconds > 0:
+            self._thread = threading.Thread(target=self._run, name="alert-coalescer", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def add(self, incident, alert):
+        with self._lock:
+            _, incidents = self._pending.setdefault(alert["id"], (alert, []))
+            incidents.append(incident)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        for alert, incidents in pending.values():
+            if len(incidents) == 1:
+                dispatch_alert(incidents[0], alert)
+                continue
+
+            logger.info("alerts: coalescing {} incidents for {}".format(len(incidents), alert["id"]))
+            for digest in create_digests(incidents, get_message_limit(alert)):
+                dispatch_alert(digest, alert)
+
+    def _run(self):
+        while not self._stopping.wait(self.window_seconds):
+            self.flush()
+
+
+def get_message_limit(alert):
+    return alert.get("maxMessageLength", MESSAGE_LIMITS.get(alert["@type"], 40000))
+
+
+def create_digests(incidents, message_limit):
+    """
+    Combine incidents into as few digest incidents as fit within message_limit characters each
+    """
+    cleared = len([incident for incident in incidents if incident.result.get("result")])
+    title = "Cupcake: {} new alerts, {} cleared".format(len(incidents) - cleared, cleared)
+
+    # leave room for the title and a part number
+    budget = message_limit - len(title) - 32
+
+    parts = []
+    lines = []
+    length = 0
+    for incident in incidents:
+        line = incident.message.strip()[:budget]
+        if len(lines) > 0 and length + len(line) + 1 > budget:
+            parts.append(lines)
+            lines = []
+            length = 0
+        lines.append(line)
+        length = length + len(line) + 1
+    parts.append(lines)
+
+    digests = []
+    for index, lines in enumerate(parts):
+        heading = title if len(parts) == 1 else "{} (part {} of {})".format(title, index + 1, len(parts))
+        digests.append(Incident(
+            timestamp=time.time(),
+            result={"result": cleared == len(incidents), "coalesced": len(lines)},
+            message="{}\n{}".format(heading, "\n".join(lines)),
+            presentation_message=heading
+        ))
+
+    return digests
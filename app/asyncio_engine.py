@@ -0,0 +1,301 @@
+from logzero import logger
+from concurrent.futures import wait
+from concurrent.futures.thread import ThreadPoolExecutor
+import asyncio
+import functools
+import socket
+import threading
+import time
+
+from models import ProbeOutcome
+from probes import get_request_path
+from limits import TokenBucket
+from timing import PhaseTimer, DNS, CONNECT, TLS, FIRST_BYTE
+import telemetry
+import tls
+
+
+class AsyncioProbeEngine:
+    """
+    Run probes as coroutines on a single event loop.
+
+    Network I/O for every probe shares one loop and is bounded by a single
+    concurrency limit, so in-flight probes cost sockets rather than threads.
+    Blocking work (metrics delivery, database access, alerting) is offloaded
+    to a small thread pool.
+
+    Probes may also be limited per host and per endpoint group, and rate
+    limited per host. A probe waiting on one of these limits does not hold a
+    slot of the overall concurrency limit, so probes of other hosts go ahead.
+
+    Jobs submitted to a started engine have already waited in the caller's
+    probe queue, so only jobs given to run() are counted as queued here.
+    """
+
+    def __init__(self, concurrency, timeout, max_workers, read_body=False, host_concurrency=0, group_concurrency=0, host_rate=0, host_burst=1):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.read_body = read_body
+        self.host_concurrency = host_concurrency
+        self.group_concurrency = group_concurrency
+        self.host_rate = host_rate
+        self.host_burst = host_burst
+        self._loop = None
+        self._executor = None
+        self._semaphore = None
+        self._thread = None
+        self._count_queued = False
+        self._jobs = set()
+        self._jobs_lock = threading.Lock()
+        self._host_semaphores = {}
+        self._group_semaphores = {}
+        self._host_buckets = {}
+
+    def run(self, coroutine_function, jobs):
+        """
+        Run coroutine_function(engine, *args) for each tuple of args in jobs to completion
+        """
+        logger.debug("asyncio_engine: running {} jobs with concurrency {}".format(len(jobs), self.concurrency))
+        self._loop = asyncio.new_event_loop()
+        self._count_queued = True
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                self._executor = executor
+                self._loop.run_until_complete(self._run_all(coroutine_function, jobs))
+        finally:
+            self._loop.close()
+            self._loop = None
+            self._executor = None
+            self._count_queued = False
+
+    async def _run_all(self, coroutine_function, jobs):
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        results = await asyncio.gather(*[coroutine_function(self, *args) for args in jobs], return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error("asyncio_engine: job failed - {}".format(repr(result)))
+
+    def start(self):
+        """
+        Run the event loop on a background thread so that jobs can be submitted as they fall due
+        """
+        logger.debug("asyncio_engine: starting with concurrency {}".format(self.concurrency))
+        self._loop = asyncio.new_event_loop()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self._thread = threading.Thread(target=self._loop.run_forever, name="asyncio-engine", daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._create_semaphore(), self._loop).result()
+
+    async def _create_semaphore(self):
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+
+    def submit(self, coroutine_function, *args):
+        """
+        Schedule coroutine_function(engine, *args) on the running loop, returning a concurrent.futures.Future
+        """
+        future = asyncio.run_coroutine_threadsafe(coroutine_function(self, *args), self._loop)
+        with self._jobs_lock:
+            self._jobs.add(future)
+        future.add_done_callback(self._job_done)
+        return future
+
+    def _job_done(self, future):
+        with self._jobs_lock:
+            self._jobs.discard(future)
+        log_failure(future)
+
+    def stop(self):
+        """
+        Wait for submitted jobs to finish, then stop the loop
+        """
+        with self._jobs_lock:
+            jobs = list(self._jobs)
+        wait(jobs)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._executor.shutdown()
+        self._loop.close()
+        self._loop = None
+        self._executor = None
+        self._thread = None
+
+    async def offload(self, fn, *args, **kwargs):
+        """
+        Run a blocking function on the engine's thread pool
+        """
+        return await self._loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+    async def probe(self, parse_result, group=None):
+        host = parse_result.netloc.lower()
+
+        # acquired explicitly, as contextlib.AsyncExitStack needs Python 3.7
+        acquired = []
+        try:
+            if self._count_queued:
+                telemetry.PROBES_QUEUED.inc()
+            try:
+                if self.host_concurrency > 0:
+                    await acquire(get_semaphore(self._host_semaphores, host, self.host_concurrency), acquired)
+                if self.group_concurrency > 0 and group is not None:
+                    await acquire(get_semaphore(self._group_semaphores, group, self.group_concurrency), acquired)
+                if self.host_rate > 0:
+                    await self.wait_for_rate(host)
+                await acquire(self._semaphore, acquired)
+            finally:
+                if self._count_queued:
+                    telemetry.PROBES_QUEUED.dec()
+
+            telemetry.PROBES_IN_FLIGHT.inc()
+            try:
+                if parse_result.scheme == "http" or parse_result.scheme == "https":
+                    return await self.probe_http(parse_result)
+                elif parse_result.scheme == "tcp":
+                    return await self.probe_tcp(parse_result)
+            finally:
+                telemetry.PROBES_IN_FLIGHT.dec()
+        finally:
+            for semaphore in reversed(acquired):
+                semaphore.release()
+
+        return None
+
+    async def wait_for_rate(self, host):
+        if host not in self._host_buckets:
+            self._host_buckets[host] = TokenBucket(self.host_rate, self.host_burst, time.time())
+
+        delay = self._host_buckets[host].reserve(time.time())
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def open_connection(self, host, port, timer, ssl_context=None):
+        """
+        Open a stream to the host, recording the DNS, connect and TLS phases on the timer
+        """
+        started = time.perf_counter()
+        addresses = await self._loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        timer.record(DNS, started)
+
+        error = None
+        started = time.perf_counter()
+        for family, socket_type, proto, _, socket_address in addresses:
+            sock = socket.socket(family, socket_type, proto)
+            try:
+                sock.setblocking(False)
+                await self._loop.sock_connect(sock, socket_address)
+            except OSError as e:
+                error = e
+                sock.close()
+                continue
+            except BaseException:
+                sock.close()
+                raise
+            timer.record(CONNECT, started)
+
+            if ssl_context is None:
+                return await asyncio.open_connection(sock=sock)
+
+            started = time.perf_counter()
+            streams = await asyncio.open_connection(sock=sock, ssl=ssl_context, server_hostname=host)
+            timer.record(TLS, started)
+            return streams
+
+        if error is not None:
+            raise error
+        raise OSError("getaddrinfo returned an empty list")
+
+    async def probe_http(self, parse_result):
+        timer = PhaseTimer()
+        writer = None
+
+        try:
+            ssl_context = None
+            default_port = 80
+            if parse_result.scheme == "https":
+                ssl_context = tls.get_ssl_context()
+                default_port = 443
+
+            reader, writer = await asyncio.wait_for(
+                self.open_connection(parse_result.hostname, parse_result.port or default_port, timer, ssl_context),
+                self.timeout)
+
+            request_path = get_request_path(parse_result)
+            logger.debug("request path: {}".format(request_path))
+            started = time.perf_counter()
+            writer.write("GET {} HTTP/1.1\r\nHost: {}\r\nAccept-Encoding: identity\r\nConnection: close\r\n\r\n".format(
+                request_path, parse_result.netloc).encode("ascii"))
+
+            status_line = await asyncio.wait_for(reader.readline(), self.timeout)
+            timer.record(FIRST_BYTE, started)
+            phases = timer.finish()
+            status = parse_status_line(status_line)
+
+            certificate_expiry = None
+            if ssl_context is not None:
+                certificate_expiry = tls.get_certificate_expiry(writer.get_extra_info("ssl_object").getpeercert(binary_form=True))
+
+            body = None
+            if self.read_body:
+                remainder = await asyncio.wait_for(reader.read(), self.timeout)
+                body = remainder.partition(b"\r\n\r\n")[2]
+
+            return ProbeOutcome(
+                kind=ProbeOutcome.RESPONSE,
+                phases=phases,
+                status=status,
+                body=body,
+                certificate_expiry=certificate_expiry
+            )
+
+        except asyncio.TimeoutError as e:
+            return ProbeOutcome(kind=ProbeOutcome.TIMEOUT, phases=timer.finish(), error=e)
+
+        except Exception as e:
+            return ProbeOutcome(kind=ProbeOutcome.ERROR, phases=timer.finish(), error=e)
+
+        finally:
+            if writer:
+                writer.close()
+
+    async def probe_tcp(self, parse_result):
+        timer = PhaseTimer()
+        writer = None
+
+        try:
+            _, writer = await asyncio.wait_for(
+                self.open_connection(parse_result.hostname, parse_result.port, timer),
+                self.timeout)
+            return ProbeOutcome(kind=ProbeOutcome.CONNECTED, phases=timer.finish())
+
+        except asyncio.TimeoutError as e:
+            return ProbeOutcome(kind=ProbeOutcome.TIMEOUT, phases=timer.finish(), error=e)
+
+        except Exception as e:
+            return ProbeOutcome(kind=ProbeOutcome.ERROR, phases=timer.finish(), error=e)
+
+        finally:
+            if writer:
+                writer.close()
+
+
+async def acquire(semaphore, acquired):
+    await semaphore.acquire()
+    acquired.append(semaphore)
+
+
+def get_semaphore(semaphores, key, limit):
+    if key not in semaphores:
+        semaphores[key] = asyncio.Semaphore(limit)
+    return semaphores[key]
+
+
+def log_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("asyncio_engine: job failed - {}".format(repr(future.exception())))
+
+
+def parse_status_line(status_line):
+    parts = status_line.decode("iso-8859-1").split(None, 2)
+    if len(parts) < 2 or not parts[0].startswith("HTTP/") or not parts[1].isdigit():
+        raise ValueError("bad status line: {}".format(repr(status_line)))
+    return parts[1]
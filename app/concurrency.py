@@ -0,0 +1,63 @@
+from logzero import logger
+import math
+
+# aim to finish a cycle within this fraction of the deadline
+TARGET_FRACTION = 0.75
+
+# a cycle finishing within this fraction of the deadline has more workers than it needs
+IDLE_FRACTION = 0.4
+
+# workers this busy are saturated
+BUSY_UTILISATION = 0.8
+
+
+class ConcurrencyController:
+    """
+    Tune the number of in-flight probes so that a cycle finishes within its deadline.
+
+    During a cycle, the limit is raised when the projected cycle duration is
+    over target while probes are waiting for a saturated pool. After a cycle,
+    the limit is lowered step by step when the cycle finished well inside the
+    deadline. Between the two thresholds the limit is left alone, so it
+    settles rather than oscillates. The limit always stays between floor and
+    ceiling.
+    """
+
+    def __init__(self, floor, ceiling, deadline, initial):
+        self.floor = floor
+        self.ceiling = ceiling
+        self.deadline = deadline
+        self.limit = max(floor, min(ceiling, initial))
+        logger.info("concurrency: tuning probe concurrency between {} and {}, starting at {}".format(floor, ceiling, self.limit))
+
+    def observe(self, elapsed, remaining, average_seconds, backlog, utilisation):
+        """
+        Raise the limit mid-cycle if, at the current rate, the cycle will overrun its target
+        """
+        if average_seconds is None or backlog == 0 or self.limit >= self.ceiling:
+            return
+
+        target = self.deadline * TARGET_FRACTION
+        projected = elapsed + remaining * average_seconds / self.limit
+
+        if projected > target and utilisation >= BUSY_UTILISATION:
+            limit = min(self.ceiling, max(self.limit + 1, int(math.ceil(self.limit * projected / target))))
+            logger.info("concurrency: raising probe concurrency from {} to {} (projected cycle {:.1f}s, target {:.1f}s, {} waiting, {:.0%} utilisation)".format(
+                self.limit, limit, projected, target, backlog, utilisation))
+            self.limit = limit
+
+    def finish(self, elapsed, utilisation):
+        """
+        Lower the limit after a cycle that needed fewer workers than it had
+        """
+        if self.limit <= self.floor:
+            return
+
+        if elapsed < self.deadline * IDLE_FRACTION:
+            limit = max(self.floor, self.limit - max(1, self.limit // 4))
+            logger.info("concurrency: lowering probe concurrency from {} to {} (cycle {:.1f}s, deadline {}s, {:.0%} utilisation)".format(
+                self.limit, limit, elapsed, self.deadline, utilisation))
+            self.limit = limit
+        else:
+            logger.debug("concurrency: keeping probe concurrency at {} (cycle {:.1f}s, {:.0%} utilisation)".format(
+                self.limit, elapsed, utilisation))
@@ -0,0 +1,124 @@
+from logzero import logger
+from botocore.config import Config
+from concurrent.futures.thread import ThreadPoolExecutor
+from urllib.parse import urlparse
+import botocore.exceptions
+import boto3
+import json
+import os
+
+from profiling import span
+import settings
+
+
+class ConfigSource:
+    """
+    Hold the parsed contents of a definitions file, re-reading it only when it has changed
+    """
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.definitions = None
+
+    def load(self):
+        """
+        Refresh the cached definitions, returning True if they changed
+        """
+        raise NotImplementedError("must define load() to use this base class")
+
+
+class LocalFileSource(ConfigSource):
+
+    def __init__(self, uri):
+        super().__init__(uri)
+        self._signature = None
+
+    def load(self):
+        stat = os.stat(self.uri)
+        signature = (stat.st_mtime_ns, stat.st_size)
+
+        if self.definitions is not None and signature == self._signature:
+            logger.debug("config_source: {} unchanged".format(self.uri))
+            return False
+
+        logger.info("getting file URI %s" % self.uri)
+        with span("config.read", uri=self.uri):
+            with open(self.uri) as f:
+                contents = f.read()
+        with span("config.parse", uri=self.uri):
+            self.definitions = json.loads(contents)
+        self._signature = signature
+        return True
+
+
+class S3Source(ConfigSource):
+
+    def __init__(self, uri):
+        super().__init__(uri)
+        parse_result = urlparse(uri)
+        self.bucket = parse_result.netloc
+        self.key = parse_result.path.lstrip("/")
+        self._etag = None
+        self._s3_client = None
+
+    def load(self):
+        arguments = {
+            "Bucket": self.bucket,
+            "Key": self.key
+        }
+
+        if self.definitions is not None and self._etag is not None:
+            arguments["IfNoneMatch"] = self._etag
+
+        try:
+            with span("config.read", uri=self.uri):
+                response = self.s3_client().get_object(**arguments)
+                contents = response["Body"].read().decode("utf-8")
+        except botocore.exceptions.ClientError as e:
+            if e.response.get("ResponseMetadata", {}).get("HTTPStatusCode") == 304:
+                logger.debug("config_source: {} unchanged".format(self.uri))
+                return False
+            raise
+
+        logger.info("getting file URI %s" % self.uri)
+        with span("config.parse", uri=self.uri):
+            self.definitions = json.loads(contents)
+        self._etag = response.get("ETag")
+        return True
+
+    def s3_client(self):
+        if self._s3_client is None:
+            if settings.S3_ENDPOINT_URL:
+                # stand-ins for S3 are rarely reachable by bucket subdomain
+                self._s3_client = boto3.client("s3", endpoint_url=settings.S3_ENDPOINT_URL, config=Config(s3={"addressing_style": "path"}))
+            else:
+                self._s3_client = boto3.client("s3")
+        return self._s3_client
+
+
+def create_source(uri):
+    if uri.lower().startswith("s3://"):
+        return S3Source(uri)
+
+    return LocalFileSource(uri)
+
+
+class ConfigLoader:
+    """
+    Load a set of named definitions files concurrently
+    """
+
+    def __init__(self, uris):
+        self.sources = {name: create_source(uri) for name, uri in uris.items()}
+
+    def load(self):
+        """
+        Refresh every source, returning the set of names whose definitions changed
+        """
+        with ThreadPoolExecutor(max_workers=len(self.sources)) as executor:
+            futures = {name: executor.submit(source.load) for name, source in self.sources.items()}
+
+        return {name for name, future in futures.items() if future.result()}
+
+    def get(self, name):
+        return self.sources[name].definitions
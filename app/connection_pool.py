@@ -0,0 +1,115 @@
+from logzero import logger
+import http.client
+import select
+import threading
+import time
+
+from timing import TimedConnection
+from tls import TLSConnection
+
+DEFAULT_PORTS = {
+    "http": 80,
+    "https": 443
+}
+
+
+class HTTPConnection(TimedConnection, http.client.HTTPConnection):
+    """
+    An HTTPConnection that records DNS and connect time
+    """
+
+
+def create_connection(parse_result, timeout):
+    if parse_result.scheme == "http":
+        return HTTPConnection(
+            host=parse_result.netloc,
+            timeout=timeout)
+
+    return TLSConnection(
+        host=parse_result.netloc,
+        timeout=timeout)
+
+
+def get_pool_key(parse_result):
+    return (parse_result.scheme, parse_result.hostname, parse_result.port or DEFAULT_PORTS[parse_result.scheme])
+
+
+def is_connection_dropped(conn):
+    """
+    An idle keep-alive socket should have nothing to read; if it is readable then the peer has closed it
+    """
+    if conn.sock is None:
+        return True
+
+    try:
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+    except (OSError, ValueError):
+        return True
+
+    return len(readable) > 0
+
+
+class ConnectionPool:
+    """
+    Keep idle HTTP(S) connections per (scheme, host, port) so that probes can reuse warm connections
+    """
+
+    def __init__(self, max_idle_per_host, idle_timeout, timeout):
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, parse_result, fresh=False):
+        """
+        Return a tuple of (connection, reused)
+        """
+        if not fresh:
+            key = get_pool_key(parse_result)
+            now = time.time()
+            stale = []
+            conn = None
+
+            with self._lock:
+                idle = self._idle.get(key, [])
+                while len(idle) > 0:
+                    candidate, released_at = idle.pop()
+                    if now - released_at > self.idle_timeout:
+                        stale.append(candidate)
+                    else:
+                        conn = candidate
+                        break
+
+            for candidate in stale:
+                candidate.close()
+
+            if conn is not None:
+                if not is_connection_dropped(conn):
+                    logger.debug("connection_pool: reusing connection to {}".format(parse_result.netloc))
+                    return conn, True
+                logger.debug("connection_pool: dropping broken connection to {}".format(parse_result.netloc))
+                conn.close()
+
+        return create_connection(parse_result, self.timeout), False
+
+    def release(self, parse_result, conn):
+        key = get_pool_key(parse_result)
+        evicted = None
+
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            idle.append((conn, time.time()))
+            if len(idle) > self.max_idle_per_host:
+                evicted, _ = idle.pop(0)
+
+        if evicted is not None:
+            evicted.close()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+
+        for connections in idle.values():
+            for conn, _ in connections:
+                conn.close()
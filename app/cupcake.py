@@ -5,19 +5,32 @@ from urllib.parse import urlparse
 from datetime import datetime, timezone
 from dateutil.relativedelta import relativedelta
 from concurrent.futures.thread import ThreadPoolExecutor
+from concurrent.futures import wait, FIRST_COMPLETED
+import asyncio
+import threading
 import re
-import socket
-import http.client
-import json
 import time
-import requests
 import signal
 import os
-import boto3
 import uuid
-from models import Incident, Threshold, Metric, Endpoint
-from alerts import deliver_alert_to_groups, deliver_alert_to_group, get_alerts_in_group
-from metrics import deliver_metric_to_groups, get_metrics_in_group
+from models import Incident, Metric, ProbeOutcome, ProbeAttempt
+from alerts import deliver_alert_to_groups, deliver_alert_to_group
+import alerts
+from metrics import deliver_metric_to_groups
+import metrics
+from asyncio_engine import AsyncioProbeEngine
+from probe_plan import compile_plan
+from scheduler import ProbeScheduler, RetryQueue
+from concurrency import ConcurrencyController
+from limits import ProbeLimiter, ProbeQueue, get_group
+from config_source import ConfigLoader
+import probes
+import outbox
+import profiling
+from profiling import span
+import telemetry
+import timing
+from database.reconciler import ActiveReconciler
 import settings
 
 requested_to_quit = False
@@ -26,24 +39,99 @@ last_summary_emitted = 0
 endpoint_definitions = None
 alert_definitions = None
 metrics_definitions = None
+probe_plan = None
+config_loader = None
 db = None
+reconciler = None
+unwritten_reconciler = None
+scheduler = None
+concurrency_controller = None
+probe_limiter = None
 
 def main():
     logger.info("starting...")
 
     setup_signal_handling()
+    start_services()
 
+    if settings.SCHEDULING == "interval":
+        run_scheduled()
+    else:
+        profiler = None
+        if settings.PROFILE_SLOW_CYCLE_SECONDS > 0:
+            profiler = profiling.create_profiler(settings.PROFILE_MODE, settings.PROFILE_TOP)
+
+        while lifecycle_continues():
+            run_cycle(profiler)
+
+            if lifecycle_continues():
+                logger.info("sleeping for %s seconds..." % settings.SLEEP_SECONDS)
+                for _ in range(settings.SLEEP_SECONDS):
+                    if lifecycle_continues():
+                        time.sleep(1)
+
+    shutdown()
+
+
+def start_services():
+    """
+    Open the database and start the background services enabled in settings; shutdown() stops them again
+    """
     global db
     db = settings.get_database()
 
-    while lifecycle_continues():
-        lifecycle()
+    if settings.TELEMETRY_PORT > 0:
+        telemetry.start_server(settings.TELEMETRY_ADDRESS, settings.TELEMETRY_PORT)
+
+    if settings.SPAN_SINK:
+        profiling.start_spans(settings.SPAN_SINK, settings.SPAN_FILE)
+
+    if settings.ALERT_WORKERS > 0:
+        alerts.start_dispatcher(
+            workers=settings.ALERT_WORKERS,
+            max_queued=settings.ALERT_MAX_QUEUED
+        )
+
+    if settings.ALERT_OUTBOX:
+        outbox.start_deliverer(
+            db=db,
+            poll_seconds=settings.OUTBOX_POLL_SECONDS,
+            batch_size=settings.OUTBOX_BATCH_SIZE,
+            backoff_seconds=settings.OUTBOX_BACKOFF_SECONDS,
+            max_backoff_seconds=settings.OUTBOX_MAX_BACKOFF_SECONDS,
+            retention_seconds=settings.OUTBOX_RETENTION_SECONDS,
+            coalesce=settings.ALERT_COALESCING
+        )
+    elif settings.ALERT_COALESCING:
+        alerts.start_coalescing(settings.ALERT_COALESCING_SECONDS)
+
+    if settings.METRICS_AGGREGATION:
+        metrics.start_publisher(
+            batch_size=settings.METRICS_BATCH_SIZE,
+            flush_seconds=settings.METRICS_AGGREGATION_SECONDS,
+            max_queued=settings.METRICS_MAX_QUEUED,
+            aggregate=True,
+            buckets=sorted(settings.METRICS_AGGREGATION_BUCKETS)
+        )
+    elif settings.METRICS_BATCHING:
+        metrics.start_publisher(
+            batch_size=settings.METRICS_BATCH_SIZE,
+            flush_seconds=settings.METRICS_FLUSH_SECONDS,
+            max_queued=settings.METRICS_MAX_QUEUED
+        )
+
 
-        if lifecycle_continues():
-            logger.info("sleeping for %s seconds..." % settings.SLEEP_SECONDS)
-            for _ in range(settings.SLEEP_SECONDS):
-                if lifecycle_continues():
-                    time.sleep(1)
+def shutdown():
+    logger.info("shutting down...")
+
+    outbox.stop_deliverer()
+    alerts.stop_coalescing()
+    alerts.stop_dispatcher(settings.ALERT_DRAIN_SECONDS)
+    metrics.stop_publisher()
+    probes.close_connections()
+    db.close()
+    telemetry.stop_server()
+    profiling.stop_spans()
 
 
 def lifecycle_continues():
@@ -62,43 +150,80 @@ def setup_signal_handling():
     signal.signal(signal.SIGINT, signal_handler)
 
 
-def get_file_or_s3(uri):
-    logger.info("getting file URI %s" % uri)
+def lifecycle():
+    with span("load_definitions"):
+        load_definitions()
+    with span("endpoints_check"):
+        endpoints_check()
 
-    if uri.lower().startswith("s3://"):
-        s3 = boto3.resource("s3")
-        parse_result = urlparse(uri)
-        s3_object = s3.Object(parse_result.netloc, parse_result.path.lstrip("/"))
-        return s3_object.get()["Body"].read().decode("utf-8")
 
-    return open(uri).read()
+def run_cycle(profiler=None):
+    """
+    Run one cycle, reporting where the time went if it took longer than PROFILE_SLOW_CYCLE_SECONDS
+    """
+    if profiler is not None:
+        profiler.start()
 
+    started = time.perf_counter()
+    try:
+        lifecycle()
+    finally:
+        seconds = time.perf_counter() - started
+        if profiler is not None:
+            profiler.stop()
 
-def lifecycle():
+    record_cycle(seconds)
+
+    if profiler is not None and seconds >= settings.PROFILE_SLOW_CYCLE_SECONDS:
+        logger.warning("slow cycle took {:.1f}s, top offenders:\n{}".format(seconds, profiler.report()))
+        if settings.PROFILE_DIR:
+            profiler.save(os.path.join(settings.PROFILE_DIR, "cycle-{}".format(datetime.utcnow().strftime("%Y%m%dT%H%M%S"))))
+
+
+def load_definitions():
     global last_summary_emitted
     global endpoint_definitions
     global alert_definitions
     global metrics_definitions
+    global probe_plan
 
-    endpoint_definitions = json.loads(
-        get_file_or_s3(settings.ENDPOINT_DEFINITIONS_FILE)
-    )
+    with span("config.load"), telemetry.CONFIG_LOAD_DURATION.time():
+        changed = get_config_loader().load()
 
-    alert_definitions = json.loads(
-        get_file_or_s3(settings.ALERT_DEFINITIONS_FILE)
-    )
+    endpoint_definitions = config_loader.get("endpoints")
+    alert_definitions = config_loader.get("alerts")
+    metrics_definitions = config_loader.get("metrics")
 
-    metrics_definitions = json.loads(
-        get_file_or_s3(settings.METRICS_DEFINITIONS_FILE)
-    )
+    if probe_plan is None or "endpoints" in changed or "alerts" in changed:
+        with span("compile_plan"):
+            probe_plan = compile_plan(endpoint_definitions, alert_definitions, settings.PROBE_DEDUPLICATION)
 
     if settings.SUMMARY_ENABLED:
         seconds=time.time()-last_summary_emitted
         if seconds >= settings.SUMMARY_SLEEP_SECONDS:
             last_summary_emitted = time.time()
-            emit_summary()
+            with span("emit_summary"):
+                emit_summary()
+
+
+def record_cycle(seconds):
+    telemetry.CYCLE_DURATION.observe(seconds)
+    if seconds > settings.SLEEP_SECONDS:
+        telemetry.CYCLE_OVERRUNS.inc()
+        logger.warning("cycle took {:.1f}s, longer than SLEEP_SECONDS ({}s)".format(seconds, settings.SLEEP_SECONDS))
+
+
+def get_config_loader():
+    global config_loader
 
-    endpoints_check()
+    if config_loader is None:
+        config_loader = ConfigLoader({
+            "endpoints": settings.ENDPOINT_DEFINITIONS_FILE,
+            "alerts": settings.ALERT_DEFINITIONS_FILE,
+            "metrics": settings.METRICS_DEFINITIONS_FILE
+        })
+
+    return config_loader
 
 
 def emit_summary():
@@ -107,18 +232,11 @@ def emit_summary():
     """
     logger.info("emit summary")
 
-    global endpoint_definitions
+    global probe_plan
     global alert_definitions
     global db
 
-    number_of_endpoints = 0
-
-    for group in endpoint_definitions["groups"]:
-        for environment in group["environments"]:
-            for endpoint_group in environment["endpoint-groups"]:
-                if endpoint_group["enabled"] == "true":
-                    for _ in endpoint_group["endpoints"]:
-                        number_of_endpoints = number_of_endpoints + 1
+    number_of_endpoints = len(probe_plan)
 
     endpoint_plural = "s"
 
@@ -149,366 +267,575 @@ def emit_summary():
 
 
 def endpoints_check():
-    global endpoint_definitions
-    global alert_definitions
-    global metrics_definitions
-    global db
-
-    thread_args = []
+    global probe_plan
 
     logger.info("collecting endpoint health")
 
-    with ThreadPoolExecutor(max_workers=settings.MAX_WORKERS) as executor:
-
-        for group in endpoint_definitions["groups"]:
-            environment_group_id = group["id"]
+    probes = [create_probe(group) for group in probe_plan.groups]
 
-            for environment in group["environments"]:
-                environment_id = environment["id"]
+    if settings.DB_RECONCILIATION:
+        with span("reconciliation.begin"):
+            begin_reconciliation()
 
-                for endpoint_group in environment["endpoint-groups"]:
-                    endpoint_group_id = endpoint_group["id"]
-                    endpoint_group_enabled = endpoint_group["enabled"]
+    if settings.PROBE_ENGINE == "asyncio" and settings.PROBE_BULKHEADS:
+        engine = create_engine()
+        engine.start()
+        try:
+            run_probes(engine, probes)
+        finally:
+            engine.stop()
+    elif settings.PROBE_ENGINE == "asyncio":
+        create_engine().run(run_test_async, [(probe,) for probe in probes])
+    elif settings.PROBE_AUTOTUNE:
+        controller = get_concurrency_controller()
+        with ThreadPoolExecutor(max_workers=controller.ceiling) as executor:
+            run_probes(executor, probes, controller)
+    else:
+        with ThreadPoolExecutor(max_workers=settings.MAX_WORKERS) as executor:
+            run_probes(executor, probes)
 
-                    if endpoint_group_enabled == "true":
-                        for endpoint in endpoint_group["endpoints"]:
-                            endpoint_id = endpoint["id"]
-                            endpoint_url = endpoint["url"]
+    if reconciler is not None:
+        with span("reconciliation.commit"):
+            commit_reconciliation()
 
-                            if "appendTraceID" in endpoint and endpoint["appendTraceID"]:
+    if settings.ALERT_COALESCING_SECONDS == 0:
+        with span("alerts.flush_coalesced"):
+            alerts.flush_coalesced()
 
-                                # default argument key
-                                trace_argument_key = "cupcake_trace_id"
 
-                                # use custom key if provided
-                                if "traceArgumentKey" in endpoint:
-                                    trace_argument_key = endpoint["traceArgumentKey"]
+def run_probes(runner, probes, controller=None):
+    """
+    Run every probe to its final attempt, resubmitting timed out attempts once their backoff has passed.
 
-                                endpoint_url = create_or_append_query_string(
-                                    original=endpoint_url,
-                                    argument="{}={}".format(trace_argument_key, get_trace_id())
-                                )
+    At most get_probe_capacity() attempts are in flight, or the controller's limit if one is given.
+    """
+    retries = RetryQueue()
+    pending = create_probe_queue()
+    for probe in probes:
+        pending.push(probe)
+    futures = {}
+
+    started = time.time()
+    last_sample = started
+    busy_seconds = 0.0
+    capacity_seconds = 0.0
+    submitted_at = {}
+    probe_seconds = []
+
+    while len(pending) > 0 or len(futures) > 0 or len(retries) > 0:
+        # retries go ahead of probes that have not started yet
+        for probe in retries.pop_due(time.time()):
+            pending.push(probe, front=True)
+
+        limit = get_probe_capacity() if controller is None else controller.limit
+        while True:
+            probe = pending.pop(time.time(), limit)
+            if probe is None:
+                break
+            future = submit_probe(runner, probe, retries)
+            submitted_at[future] = time.time()
+            futures[future] = probe
+
+        wake = [due for due in [retries.next_due(), pending.next_ready(time.time())] if due is not None]
+        timeout = None if len(wake) == 0 else max(0.0, min(wake) - time.time())
+        if controller is not None:
+            timeout = 1.0 if timeout is None else min(timeout, 1.0)
+
+        in_flight = len(futures)
+        done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+
+        now = time.time()
+        for future in done:
+            pending.release(futures.pop(future))
+            probe_seconds.append(now - submitted_at.pop(future))
+        busy_seconds = busy_seconds + in_flight * (now - last_sample)
+        capacity_seconds = capacity_seconds + limit * (now - last_sample)
+        last_sample = now
+
+        if controller is not None and capacity_seconds > 0:
+            controller.observe(
+                elapsed=now - started,
+                remaining=len(pending) + len(futures),
+                average_seconds=sum(probe_seconds) / len(probe_seconds) if len(probe_seconds) > 0 else None,
+                backlog=len(pending),
+                utilisation=busy_seconds / capacity_seconds
+            )
 
-                            if "appendAttempt" in endpoint and endpoint["appendAttempt"]:
+    if controller is not None and capacity_seconds > 0:
+        controller.finish(time.time() - started, busy_seconds / capacity_seconds)
 
-                                # default argument key
-                                append_attempt_key = "cupcake_attempt"
 
-                                # use custom key if provided
-                                if "attemptArgumentKey" in endpoint:
-                                    append_attempt_key = endpoint["attemptArgumentKey"]
+def create_probe_queue():
+    """
+    Create the queue of probes waiting to start; the asyncio engine applies the host and group limits itself
+    """
+    return ProbeQueue(
+        limiter=get_probe_limiter() if settings.PROBE_ENGINE != "asyncio" else None,
+        min_share=settings.PROBE_BULKHEAD_MIN_SHARE if settings.PROBE_BULKHEADS else None
+    )
 
-                                endpoint_url = create_or_append_query_string(
-                                    original=endpoint_url,
-                                    argument="{}=##CUPCAKE_ATTEMPT##".format(append_attempt_key)
-                                )
 
-                            endpoint_expected = ""
-                            if "expected" in endpoint:
-                                endpoint_expected = endpoint["expected"]
+def get_probe_capacity():
+    if settings.PROBE_ENGINE == "asyncio":
+        return settings.PROBE_CONCURRENCY
+    return settings.MAX_WORKERS
 
-                            endpoint_threshold = None
-                            if "threshold" in endpoint:
-                                endpoint_threshold = Threshold(endpoint["threshold"])
 
-                            endpoint_model = Endpoint(
-                                environment_group = environment_group_id,
-                                environment = environment_id,
-                                endpoint_group = endpoint_group_id,
-                                endpoint = endpoint_id,
-                                url = endpoint_url
-                            )
+def submit_probe(runner, probe, retries):
+    """
+    Start an attempt of a probe on a thread pool or a started asyncio engine, returning a concurrent.futures.Future
+    """
+    if settings.PROBE_ENGINE == "asyncio":
+        return runner.submit(run_test_async, probe, retries)
+    return runner.submit(run_test, probe, retries)
 
-                            metrics_groups = get_endpoint_default(
-                                model=endpoint_model,
-                                property="metrics-groups",
-                                default_value=["default"]
-                            )
 
-                            alert_groups = get_endpoint_default(
-                                model=endpoint_model,
-                                property="alert-groups",
-                                default_value=get_alerts_in_group("default", alert_definitions)
-                            )
+def get_probe_limiter():
+    """
+    Return the limiter shared by every run, so that host rates carry over between runs, or None if no limits are set
+    """
+    global probe_limiter
 
-                            executor.submit(run_test, endpoint_model, metrics_groups, alert_groups, endpoint_expected, endpoint_threshold)
+    if settings.PROBE_HOST_CONCURRENCY == 0 and settings.PROBE_GROUP_CONCURRENCY == 0 and settings.PROBE_HOST_RATE == 0:
+        return None
 
+    if probe_limiter is None:
+        probe_limiter = ProbeLimiter(
+            per_host=settings.PROBE_HOST_CONCURRENCY,
+            per_group=settings.PROBE_GROUP_CONCURRENCY,
+            host_rate=settings.PROBE_HOST_RATE,
+            host_burst=settings.PROBE_HOST_BURST
+        )
 
-def get_trace_id():
-    return str(uuid.uuid4())
+    return probe_limiter
 
 
-def create_or_append_query_string(original, argument):
-    if "?" in original:
-        return "{}&{}".format(original, argument)
-    # else...
-    return "{}?{}".format(original, argument)
+def get_concurrency_controller():
+    global concurrency_controller
 
+    if concurrency_controller is None:
+        concurrency_controller = ConcurrencyController(
+            floor=settings.PROBE_MIN_WORKERS,
+            ceiling=settings.PROBE_MAX_WORKERS,
+            deadline=settings.SLEEP_SECONDS,
+            initial=settings.MAX_WORKERS
+        )
 
-def run_test(endpoint_model, metrics_groups, alert_groups, endpoint_expected, endpoint_threshold):
-    attempt = 0
-    keep_trying = True
-    incident_timestamp = datetime.now(timezone.utc).astimezone().isoformat()
-    original_endpoint_url = endpoint_model.url
-    while keep_trying:
+    return concurrency_controller
 
-        if "##CUPCAKE_ATTEMPT##" in original_endpoint_url:
-            endpoint_model.url = original_endpoint_url.replace("##CUPCAKE_ATTEMPT##", str(attempt + 1))
 
-        result = test_endpoint(
-            endpoint=endpoint_model,
-            expected=endpoint_expected,
-            threshold=endpoint_threshold,
-            metrics_groups=metrics_groups
+def create_probe(group):
+    """
+    Create a probe of the first spec in a group, carrying the other specs as duplicates that share its outcome
+    """
+    timestamp = datetime.now(timezone.utc).astimezone().isoformat()
+
+    listings = [
+        ProbeAttempt(
+            key=spec.key,
+            bulkhead=spec.bulkhead,
+            endpoint=spec.create_endpoint(get_trace_id),
+            metrics_groups=spec.metrics_groups,
+            alert_groups=spec.alert_groups,
+            expected=spec.expected,
+            threshold=spec.threshold,
+            timestamp=timestamp
         )
-        if not result["result"] and result["message"] == "TIMEOUT":
-            attempt = attempt + 1
-            if attempt <= 3:
-                logger.info("re-testing timed out endpoint ({}) (attempt {} failed)".format(endpoint_model.url, attempt))
-                keep_trying = True
-                continue
-        break
-
-    incident = Incident(
-        timestamp=incident_timestamp,
-        endpoint=endpoint_model,
-        result=result,
-        expected=endpoint_expected
+        for spec in group
+    ]
+
+    listings[0].duplicates = listings[1:]
+    return listings[0]
+
+
+def create_engine():
+    return AsyncioProbeEngine(
+        concurrency=settings.PROBE_CONCURRENCY,
+        timeout=settings.CONNECTION_TIMEOUT,
+        max_workers=settings.MAX_WORKERS,
+        read_body=settings.SHOW_BODY_IN_DEBUG_ON_UNEXPECTED_STATUS,
+        host_concurrency=settings.PROBE_HOST_CONCURRENCY,
+        group_concurrency=settings.PROBE_GROUP_CONCURRENCY,
+        host_rate=settings.PROBE_HOST_RATE,
+        host_burst=settings.PROBE_HOST_BURST
     )
 
-    handle_result(
-        incident=incident,
-        alert_groups=alert_groups
-    )
 
+def run_scheduled():
+    """
+    Probe each endpoint on its own interval, reloading the definitions every SLEEP_SECONDS
+    """
+    global scheduler
+
+    logger.info("scheduling endpoints individually (default interval {}s)".format(settings.SLEEP_SECONDS))
+
+    if settings.DB_RECONCILIATION:
+        logger.warning("DB_RECONCILIATION is ignored with interval scheduling")
+
+    scheduler = ProbeScheduler(default_interval=settings.SLEEP_SECONDS)
+    retries = RetryQueue()
+    wake = threading.Event()
+
+    pending = create_probe_queue()
+
+    if settings.PROBE_ENGINE == "asyncio":
+        runner = create_engine()
+        runner.start()
+    else:
+        runner = ThreadPoolExecutor(max_workers=settings.MAX_WORKERS)
+
+    next_reload = 0
+    try:
+        while lifecycle_continues():
+            wake.clear()
+            now = time.time()
+            if now >= next_reload:
+                load_definitions()
+                scheduler.update(probe_plan, now)
+                if settings.ALERT_COALESCING_SECONDS == 0:
+                    alerts.flush_coalesced()
+                next_reload = now + settings.SLEEP_SECONDS
+
+            for group in scheduler.pop_due(now):
+                pending.push(create_probe(group))
+
+            for probe in retries.pop_due(now):
+                pending.push(probe, front=True)
+
+            probe = pending.pop(now, get_probe_capacity())
+            while probe is not None:
+                submit_scheduled(runner, probe, retries, pending, wake)
+                probe = pending.pop(now, get_probe_capacity())
+
+            # a completing probe wakes the loop early, as it frees a worker and may free a host or group slot
+            next_due = min([due for due in [scheduler.next_due(), retries.next_due(), pending.next_ready(now), next_reload] if due is not None])
+            wake.wait(max(0.0, min(next_due, now + 1) - time.time()))
+    finally:
+        if settings.PROBE_ENGINE == "asyncio":
+            runner.stop()
+        else:
+            runner.shutdown()
 
-def get_endpoint_default(model, property, default_value):
-    global endpoint_definitions
 
-    result = default_value
+def submit_scheduled(runner, probe, retries, pending, wake):
+    """
+    Start an attempt of a scheduled probe, marking the endpoint complete once its final attempt is handled
+    """
+    future = submit_probe(runner, probe, retries)
 
-    environment_group = get_child_by_property(endpoint_definitions["groups"], "id", model.environment_group)
-    environment = get_child_by_property(environment_group["environments"], "id", model.environment)
-    endpoint_group = get_child_by_property(environment["endpoint-groups"], "id", model.endpoint_group)
-    endpoint = get_child_by_property(endpoint_group["endpoints"], "id", model.endpoint)
+    def complete(future):
+        pending.release(probe)
+        if future.cancelled() or future.exception() is not None or future.result() is not False:
+            scheduler.complete(probe.key)
+        wake.set()
 
-    if property in environment_group:
-        result = environment_group[property]
+    future.add_done_callback(complete)
 
-    if property in environment:
-        result = environment[property]
 
-    if property in endpoint_group:
-        result = endpoint_group[property]
+def begin_reconciliation():
+    """
+    Answer this cycle's active lookups from memory, falling back to the database if the actives cannot be loaded
+    """
+    global reconciler
 
-    if property in endpoint:
-        result = endpoint[property]
+    # a reconciler whose last commit failed still holds the changes to write
+    candidate = unwritten_reconciler if unwritten_reconciler is not None else ActiveReconciler(db)
+    if candidate.begin():
+        reconciler = candidate
+    else:
+        logger.warning("could not load actives, reconciliation disabled for this cycle")
 
-    return result
 
+def commit_reconciliation():
+    global reconciler
+    global unwritten_reconciler
 
-def get_child_by_property(parent, property, target):
-    for child in parent:
-        if property in child and child[property] == target:
-            return child
+    unwritten_reconciler = None if reconciler.commit() else reconciler
+    reconciler = None
 
-    return None
+    outbox.notify()
 
 
-def test_endpoint(endpoint, expected, threshold, metrics_groups):
-    global metrics_definitions
+def get_trace_id():
+    return str(uuid.uuid4())
+
 
-    logger.info("testing endpoint {}".format(endpoint.url))
+def run_test(probe, retries):
+    """
+    Run one attempt of a probe, returning False if a timed out attempt was deferred to the retry queue
+    """
     if not lifecycle_continues():
-        logger.info("test_endpoint: bailing")
+        logger.info("run_test: bailing")
+        return
+
+    probe.endpoint.url = get_attempt_url(probe.original_url, probe.attempt)
+
+    logger.info("testing endpoint {}".format(probe.endpoint.url))
+    parse_result = urlparse(probe.endpoint.url)
+
+    telemetry.PROBES_IN_FLIGHT.inc()
+    try:
+        with span("probe", scheme=parse_result.scheme):
+            outcome = probes.probe(parse_result, probe.endpoint.fresh_connection)
+    finally:
+        telemetry.PROBES_IN_FLIGHT.dec()
+
+    if outcome is None:
+        logger.warning("unsupported scheme for endpoint {}".format(probe.endpoint.url))
+        return
+
+    with span("judge_outcome"):
+        result = judge_outcome(probe.endpoint, probe.expected, probe.threshold, probe.metrics_groups, parse_result, outcome)
+    record_probe(parse_result, result, outcome)
+    if retry_timed_out(probe.endpoint, result, probe.attempt):
+        probe.attempt = probe.attempt + 1
+        retries.defer(probe, time.time() + get_retry_backoff(probe.attempt))
         return False
 
-    parse_result = urlparse(endpoint.url)
+    with span("handle_probe_results"):
+        handle_probe_results(probe, result, parse_result, outcome)
 
-    start_time = time.time()
-    test_time = None
 
-    if parse_result.scheme == "http" or parse_result.scheme == "https":
-        try:
-            conn = None
+async def run_test_async(engine, probe, retries=None):
+    """
+    Run a probe to its final attempt, or with a retry queue run one attempt, returning False if a timed out attempt was deferred to it
+    """
+    while True:
 
-            if parse_result.scheme == "http":
-                conn = http.client.HTTPConnection(
-                    host=parse_result.netloc,
-                    timeout=settings.CONNECTION_TIMEOUT)
-            else:
-                conn = http.client.HTTPSConnection(
-                    host=parse_result.netloc,
-                    timeout=settings.CONNECTION_TIMEOUT)
-
-            request_path = "{}{}".format(parse_result.path, "?{}".format(parse_result.query) if len(parse_result.query) > 0 else "")
-            logger.debug("request path: {}".format(request_path))
-            conn.request("GET", request_path)
-            http_response = conn.getresponse()
-            status = str(http_response.status)
-            logger.debug("status: {}, expected: {}".format(status, expected))
-            if re.match(expected, status):
-                # result was good but now check if timing was beyond threshold
-                test_time = get_relative_time(start_time, time.time())
-                logger.debug("response time was {}ms".format(int(round(getattr(test_time, "microsecond") / 1000.0))))
-
-                metrics_record_response_time(
-                    endpoint=endpoint,
-                    timestamp=time.time(),
-                    response_time=int(round(getattr(test_time, "microsecond") / 1000.0)),
-                    metrics_groups=metrics_groups
-                )
+        if not lifecycle_continues():
+            logger.info("run_test_async: bailing")
+            return
 
-                threshold_result = None
-                if threshold is not None:
-                    threshold_result = threshold.result(test_time)
-
-                if threshold_result is None or threshold_result.okay:
-                    return {
-                        "result": True,
-                        "message": "OK"
-                    }
-
-                return {
-                    "result": False,
-                    "message": "BAD",
-                    "threshold": threshold_result.result
-                }
-
-            test_time = get_relative_time(start_time, time.time())
-            logger.debug("response time was {}ms".format(int(round(getattr(test_time, "microsecond") / 1000.0))))
-
-            metrics_record_response_time(
-                endpoint=endpoint,
-                timestamp=time.time(),
-                response_time=int(round(getattr(test_time, "microsecond") / 1000.0)),
-                metrics_groups=metrics_groups
-            )
+        probe.endpoint.url = get_attempt_url(probe.original_url, probe.attempt)
 
-            if settings.SHOW_BODY_IN_DEBUG_ON_UNEXPECTED_STATUS:
-                body = http_response.read()
-                logger.debug("body for {} was {}", endpoint.url, body)
+        logger.info("testing endpoint {}".format(probe.endpoint.url))
+        parse_result = urlparse(probe.endpoint.url)
 
-            return {
-                "result": False,
-                "actual": status,
-                "message": "BAD"
-            }
+        with span("probe", scheme=parse_result.scheme):
+            outcome = await engine.probe(parse_result, get_group(probe.key))
 
-        except Exception as e:
-            logger.debug("error during testing: {}".format(str(e)))
-            pass
+        if outcome is None:
+            logger.warning("unsupported scheme for endpoint {}".format(probe.endpoint.url))
+            return
+
+        result = await engine.offload(
+            judge_outcome, probe.endpoint, probe.expected, probe.threshold, probe.metrics_groups, parse_result, outcome
+        )
+        record_probe(parse_result, result, outcome)
+        if retry_timed_out(probe.endpoint, result, probe.attempt):
+            probe.attempt = probe.attempt + 1
+            if retries is not None:
+                # a submitted probe holds a place in the caller's probe queue until it returns
+                retries.defer(probe, time.time() + get_retry_backoff(probe.attempt))
+                return False
+            # engine.probe() has released its concurrency slots, so waiting here holds none
+            await asyncio.sleep(get_retry_backoff(probe.attempt))
+            continue
+        break
+
+    await engine.offload(handle_probe_results, probe, result, parse_result, outcome)
+
+
+def handle_probe_results(probe, result, parse_result, outcome):
+    """
+    Handle the final result of a probe, then judge its outcome for each duplicate listing and handle that too
+    """
+    handle_result(
+        incident=Incident(
+            timestamp=probe.timestamp,
+            endpoint=probe.endpoint,
+            result=result,
+            expected=probe.expected
+        ),
+        alert_groups=probe.alert_groups
+    )
+
+    for duplicate in probe.duplicates:
+        duplicate.endpoint.url = get_attempt_url(duplicate.original_url, probe.attempt)
+
+        handle_result(
+            incident=Incident(
+                timestamp=duplicate.timestamp,
+                endpoint=duplicate.endpoint,
+                result=judge_outcome(
+                    duplicate.endpoint, duplicate.expected, duplicate.threshold, duplicate.metrics_groups, parse_result, outcome
+                ),
+                expected=duplicate.expected
+            ),
+            alert_groups=duplicate.alert_groups
+        )
+
+
+def record_probe(parse_result, result, outcome):
+    telemetry.PROBE_DURATION.observe(
+        outcome.phases[timing.TOTAL],
+        scheme=parse_result.scheme,
+        result="ok" if result["result"] else result["message"].lower()
+    )
+
+
+def get_attempt_url(original_endpoint_url, attempt):
+    if "##CUPCAKE_ATTEMPT##" in original_endpoint_url:
+        return original_endpoint_url.replace("##CUPCAKE_ATTEMPT##", str(attempt + 1))
+    return original_endpoint_url
+
+
+def retry_timed_out(endpoint_model, result, attempt):
+    if not result["result"] and result["message"] == "TIMEOUT":
+        if attempt + 1 <= settings.RETRY_ATTEMPTS:
+            logger.info("re-testing timed out endpoint ({}) (attempt {} failed)".format(endpoint_model.url, attempt + 1))
+            return True
+    return False
 
-        test_time = get_relative_time(start_time, time.time())
 
-        metrics_record_response_time(
+def get_retry_backoff(attempt):
+    """
+    Return the delay before a retry, doubling from RETRY_BACKOFF_SECONDS with each attempt
+    """
+    return min(settings.RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1), settings.RETRY_MAX_BACKOFF_SECONDS)
+
+
+def judge_outcome(endpoint, expected, threshold, metrics_groups, parse_result, outcome):
+    """
+    Turn the raw outcome of a probe into the result consumed by handle_result()
+    """
+    timings = timing.get_milliseconds(outcome.phases)
+
+    with span("metrics.record"):
+        metrics_record_timings(
             endpoint=endpoint,
             timestamp=time.time(),
-            response_time=int(round(getattr(test_time, "microsecond") / 1000.0)),
+            timings=timings,
             metrics_groups=metrics_groups
         )
 
-        return {
-            "result": False,
-            "message": "TIMEOUT"
-        }
-
-    elif parse_result.scheme == "tcp":
-        s = socket.socket()
-        try:
-            s.settimeout(settings.CONNECTION_TIMEOUT)
-            s.connect((parse_result.hostname, parse_result.port))
-        except socket.timeout:
+    if parse_result.scheme == "tcp":
+        if outcome.kind == ProbeOutcome.TIMEOUT:
             logger.info(
                 "tcp endpoint {} hit timeout".format(parse_result.netloc)
             )
-
-            test_time = get_relative_time(start_time, time.time())
-
-            metrics_record_response_time(
-                endpoint=endpoint,
-                timestamp=time.time(),
-                response_time=int(round(getattr(test_time, "microsecond") / 1000.0)),
-                metrics_groups=metrics_groups
-            )
-
             return {
                 "result": False,
                 "message": "TIMEOUT"
             }
 
-        except Exception as e:
-
-            test_time = get_relative_time(start_time, time.time())
-
-            metrics_record_response_time(
-                endpoint=endpoint,
-                timestamp=time.time(),
-                response_time=int(round(getattr(test_time, "microsecond") / 1000.0)),
-                metrics_groups=metrics_groups
-            )
-
+        if outcome.kind == ProbeOutcome.ERROR:
             logger.info(
-                "tcp endpoint {} had a problem: {}".format(parse_result.netloc, e)
+                "tcp endpoint {} had a problem: {}".format(parse_result.netloc, outcome.error)
             )
             return {
                 "result": False,
                 "message": "BAD"
             }
 
-        finally:
-            s.close()
         # result was good but now check if timing was beyond threshold
-        test_time = get_relative_time(start_time, time.time())
+        log_timings(timings)
 
-        logger.debug("response time was {}ms".format(int(round(getattr(test_time, "microsecond") / 1000.0))))
+        return judge_threshold(threshold, timings, {
+            "result": True
+        })
 
-        metrics_record_response_time(
-            endpoint=endpoint,
-            timestamp=time.time(),
-            response_time=int(round(getattr(test_time, "microsecond") / 1000.0)),
-            metrics_groups=metrics_groups
+    if outcome.kind != ProbeOutcome.RESPONSE:
+        logger.debug("error during testing: {}".format(str(outcome.error)))
+        return {
+            "result": False,
+            "message": "TIMEOUT"
+        }
+
+    logger.debug("status: {}, expected: {}".format(outcome.status, expected))
+    log_timings(timings)
+
+    if re.match(expected, outcome.status):
+        # result was good but now check if timing was beyond threshold
+        result = judge_threshold(threshold, timings, {
+            "result": True,
+            "message": "OK"
+        })
+
+        if result["result"]:
+            return judge_certificate(endpoint, outcome, result)
+
+        return result
+
+    if settings.SHOW_BODY_IN_DEBUG_ON_UNEXPECTED_STATUS:
+        logger.debug("body for {} was {}".format(endpoint.url, outcome.body))
+
+    return {
+        "result": False,
+        "actual": outcome.status,
+        "message": "BAD"
+    }
+
+
+def judge_certificate(endpoint, outcome, okay_result):
+    if endpoint.certificate_expiry_days is None or outcome.certificate_expiry is None:
+        return okay_result
+
+    days_remaining = (outcome.certificate_expiry - time.time()) / 86400.0
+    logger.debug("certificate for {} expires in {} days".format(endpoint.url, int(days_remaining)))
+
+    if days_remaining >= endpoint.certificate_expiry_days:
+        return okay_result
+
+    return {
+        "result": False,
+        "message": "BAD",
+        "certificate": "expires in {} days ({})".format(
+            int(days_remaining),
+            datetime.utcfromtimestamp(outcome.certificate_expiry).strftime('%Y-%m-%d %H:%M:%S')
         )
+    }
 
-        threshold_result = None
-        if threshold is not None:
-            threshold_result = threshold.result(test_time)
 
-        if threshold_result is None or threshold_result.okay:
-            return {
-                "result": True
-            }
+def judge_threshold(threshold, timings, okay_result):
+    threshold_result = None
+    if threshold is not None:
+        threshold_result = threshold.result(timings)
 
-        return {
-            "result": False,
-            "message": "BAD",
-            "threshold": threshold_result.result
-        }
+    if threshold_result is None or threshold_result.okay:
+        return okay_result
 
+    return {
+        "result": False,
+        "message": "BAD",
+        "threshold": threshold_result.result
+    }
 
-def metrics_record_response_time(endpoint, timestamp, response_time, metrics_groups):
-    global metrics_definitions
 
-    logger.debug("metrics_record_response_time({}, {}, {})".format(
-        endpoint.url, str(timestamp), str(response_time)))
+def log_timings(timings):
+    logger.debug("response time was {}ms".format(timings[timing.TOTAL]))
+    logger.debug("phase times: {}".format(
+        ", ".join(["{} {}ms".format(phase, timings[phase]) for phase in timing.PHASES[:-1] if phase in timings]) or "none"))
 
-    metric = Metric(
-        endpoint=endpoint,
-        timestamp=timestamp,
-        name='RESPONSE-TIME',
-        data=response_time
-    )
 
-    deliver_metric_to_groups(metric, metrics_groups, metrics_definitions)
+def metrics_record_timings(endpoint, timestamp, timings, metrics_groups):
+    """
+    Record the response time, and with PROBE_PHASE_METRICS the time of each phase that happened
+    """
+    global metrics_definitions
+
+    logger.debug("metrics_record_timings({}, {}, {})".format(
+        endpoint.url, str(timestamp), str(timings)))
 
+    phases = timing.PHASES if settings.PROBE_PHASE_METRICS else [timing.TOTAL]
+    for phase in phases:
+        if phase not in timings:
+            continue
 
-def get_relative_time(start_time, end_time):
-    return relativedelta(microsecond=int(round((end_time-start_time) * 1000000)))
+        metric = Metric(
+            endpoint=endpoint,
+            timestamp=timestamp,
+            name=phase,
+            data=timings[phase]
+        )
+
+        deliver_metric_to_groups(metric, metrics_groups, metrics_definitions)
 
 
 def handle_result(incident, alert_groups):
     global alert_definitions
     global db
+    global reconciler
 
     if not lifecycle_continues():
         logger.info("handle_result: bailing")
@@ -535,9 +862,16 @@ def handle_result(incident, alert_groups):
     if "threshold" in incident.result:
         logger.info("threshold for {}: {}".format(incident.endpoint.url, incident.result["threshold"]))
 
-    if db.active_exists(incident):
+    if "certificate" in incident.result:
+        logger.info("certificate for {}: {}".format(incident.endpoint.url, incident.result["certificate"]))
+
+    actives = db if reconciler is None else reconciler
+
+    with span("db.get_active"):
+        active = actives.get_active(incident)
+
+    if active is not None:
         # there's an existing alert for this tuple
-        active = db.get_active(incident)
         if incident.result["result"]:
             # existing alert cleared
             logger.info("cleared alert for {}".format(incident.endpoint.url))
@@ -548,9 +882,8 @@ def handle_result(incident, alert_groups):
                 ", ".join(human_readable(delta))
             )
 
-            db.remove_active(incident)
-
-            deliver_alert_to_groups(incident, alert_groups, alert_definitions)
+            with span("commit_incident"):
+                commit_incident(actives, incident, alert_groups, cleared=True)
         else:
             # existing alert continues
             logger.debug("alert continues")
@@ -573,6 +906,12 @@ def handle_result(incident, alert_groups):
                     repr(incident.endpoint),
                     incident.result["threshold"]
                 )
+            elif "certificate" in incident.result:
+                incident.presentation_message = "certificate {}".format(incident.result["certificate"])
+                incident.message = "{} certificate {}".format(
+                    repr(incident.endpoint),
+                    incident.result["certificate"]
+                )
             else:
                 incident.presentation_message = "result was {}".format(incident.result["message"])
                 incident.message = "{} expected {}".format(
@@ -600,9 +939,41 @@ def handle_result(incident, alert_groups):
                 #     incident.endpoint.url
                 # )
 
-            db.save_active(incident)
+            with span("commit_incident"):
+                commit_incident(actives, incident, alert_groups, cleared=False)
+
 
+def commit_incident(actives, incident, alert_groups, cleared):
+    """
+    Record a new or cleared active and deliver its alerts, through the outbox if enabled
+    """
+    if not settings.ALERT_OUTBOX:
+        with span("db.write"):
+            if cleared:
+                actives.remove_active(incident)
+            else:
+                actives.save_active(incident)
+
+        with span("alerts.deliver"):
+            deliver_alert_to_groups(incident, alert_groups, alert_definitions)
+        return
+
+    deliveries = [(alert, incident) for alert in alerts.get_alerts_for_groups(alert_groups, alert_definitions)]
+
+    with span("db.write"):
+        if cleared:
+            written = actives.apply_active_changes([], [incident], deliveries)
+        else:
+            written = actives.apply_active_changes([incident], [], deliveries)
+
+    if not written:
+        # the outbox rows were not written either, so send the alerts now rather than lose them
+        logger.error("could not write the outbox for {}, delivering its alerts directly".format(incident.endpoint.url))
+        with span("alerts.deliver"):
             deliver_alert_to_groups(incident, alert_groups, alert_definitions)
+        return
+
+    outbox.notify()
 
 
 if __name__ == "__main__":
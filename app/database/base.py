@@ -1,4 +1,6 @@
 import abc
+import json
+import time
 
 class Database(object, metaclass=abc.ABCMeta):
 
@@ -20,8 +22,76 @@ class Database(object, metaclass=abc.ABCMeta):
 
     @abc.abstractmethod
     def save_active(self, incident):
+        """
+        Write an active incident, returning whether it was written
+        """
         raise NotImplementedError("must define save_active() to use this base class")
 
     @abc.abstractmethod
     def remove_active(self, incident):
+        """
+        Delete an active incident, returning whether it was deleted
+        """
         raise NotImplementedError("must define remove_active() to use this base class")
+
+    def apply_active_changes(self, saves, removes, deliveries=None):
+        """
+        Save and remove a batch of actives, queueing any (alert, incident) deliveries in the alert outbox,
+        and return whether the changes were written.
+        Backends should override this to do all of it in a single transaction.
+        """
+        if deliveries:
+            raise NotImplementedError("must define apply_active_changes() to use the alert outbox")
+
+        written = [self.remove_active(incident) for incident in removes]
+        written.extend(self.save_active(incident) for incident in saves)
+        return all(written)
+
+    def get_pending_outbox(self, now, limit):
+        raise NotImplementedError("must define get_pending_outbox() to use the alert outbox")
+
+    def mark_outbox_delivered(self, ids, now):
+        raise NotImplementedError("must define mark_outbox_delivered() to use the alert outbox")
+
+    def reschedule_outbox(self, retries):
+        raise NotImplementedError("must define reschedule_outbox() to use the alert outbox")
+
+    def purge_outbox(self, delivered_before):
+        raise NotImplementedError("must define purge_outbox() to use the alert outbox")
+
+    def close(self):
+        pass
+
+
+def get_active_key(endpoint):
+    return (endpoint.environment_group, endpoint.environment, endpoint.endpoint_group, endpoint.endpoint)
+
+
+def get_row_key(active):
+    return (active["environment_group"], active["environment"], active["endpoint_group"], active["endpoint"])
+
+
+def create_active_row(incident):
+    """
+    Build the in-memory equivalent of an active table row for an incident
+    """
+    return {
+        "environment_group": incident.endpoint.environment_group,
+        "environment": incident.endpoint.environment,
+        "endpoint_group": incident.endpoint.endpoint_group,
+        "endpoint": incident.endpoint.endpoint,
+        "timestamp": incident.timestamp,
+        "message": incident.message,
+        "url": incident.endpoint.url
+    }
+
+
+def create_outbox_rows(deliveries):
+    """
+    Build outbox rows of (alert, payload, created, next_attempt) for a list of (alert, incident) deliveries
+    """
+    now = time.time()
+    return [
+        (json.dumps(alert), json.dumps(incident.as_dict()), now, now)
+        for alert, incident in deliveries
+    ]
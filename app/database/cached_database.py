@@ -0,0 +1,111 @@
+import threading
+from .base import Database, get_active_key, get_row_key, create_active_row
+
+from logzero import logger
+
+class CachedDatabase(Database):
+    """
+    Keep every active incident in memory in front of another Database.
+
+    Reads are answered from a dict keyed by the endpoint 4-tuple and writes go
+    through to the wrapped database, only changing the dict once they have been
+    written. This assumes Cupcake is the only writer of the active table.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.actives = None
+        self.lock = threading.Lock()
+
+    def initialise(self, settings):
+        logger.info("cached_database: initialise()")
+        self.hydrate()
+
+    def hydrate(self):
+        actives = self.db.get_all_actives()
+
+        if actives is None:
+            logger.warning("cached_database: could not load actives, reading through to the database")
+            return False
+
+        with self.lock:
+            self.actives = {get_row_key(active): active for active in actives}
+
+        logger.info("cached_database: cached %s actives" % len(self.actives))
+        return True
+
+    def is_hydrated(self):
+        with self.lock:
+            if self.actives is not None:
+                return True
+
+        return self.hydrate()
+
+    def get_active(self, incident):
+        if not self.is_hydrated():
+            return self.db.get_active(incident)
+
+        with self.lock:
+            return self.actives.get(get_active_key(incident.endpoint))
+
+    def get_all_actives(self):
+        if not self.is_hydrated():
+            return None
+
+        with self.lock:
+            return list(self.actives.values())
+
+    def active_exists(self, incident):
+        if not self.is_hydrated():
+            return self.db.active_exists(incident)
+
+        with self.lock:
+            return get_active_key(incident.endpoint) in self.actives
+
+    def save_active(self, incident):
+        if not self.db.save_active(incident):
+            return False
+
+        with self.lock:
+            if self.actives is not None:
+                self.actives[get_active_key(incident.endpoint)] = create_active_row(incident)
+
+        return True
+
+    def remove_active(self, incident):
+        if not self.db.remove_active(incident):
+            return False
+
+        with self.lock:
+            if self.actives is not None:
+                self.actives.pop(get_active_key(incident.endpoint), None)
+
+        return True
+
+    def apply_active_changes(self, saves, removes, deliveries=None):
+        if not self.db.apply_active_changes(saves, removes, deliveries):
+            return False
+
+        with self.lock:
+            if self.actives is not None:
+                for incident in removes:
+                    self.actives.pop(get_active_key(incident.endpoint), None)
+                for incident in saves:
+                    self.actives[get_active_key(incident.endpoint)] = create_active_row(incident)
+
+        return True
+
+    def get_pending_outbox(self, now, limit):
+        return self.db.get_pending_outbox(now, limit)
+
+    def mark_outbox_delivered(self, ids, now):
+        return self.db.mark_outbox_delivered(ids, now)
+
+    def reschedule_outbox(self, retries):
+        return self.db.reschedule_outbox(retries)
+
+    def purge_outbox(self, delivered_before):
+        return self.db.purge_outbox(delivered_before)
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,71 @@
+import time
+from .base import Database
+
+import telemetry
+
+# reads that return None only when the backend logged an error; writes return False
+NONE_ON_ERROR = ("get_all_actives", "active_exists")
+
+class InstrumentedDatabase(Database):
+    """
+    Time every call to another Database and count the calls that fail, for the telemetry endpoint.
+    The backends log and swallow their driver errors, so a failure is a call that raises or reports it in its result.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def call(self, method, *args):
+        started = time.perf_counter()
+        try:
+            result = getattr(self.db, method)(*args)
+            if is_failure(method, result):
+                telemetry.DATABASE_ERRORS.inc(method=method)
+            return result
+        except Exception:
+            telemetry.DATABASE_ERRORS.inc(method=method)
+            raise
+        finally:
+            telemetry.DATABASE_DURATION.observe(time.perf_counter() - started, method=method)
+
+    def initialise(self, settings):
+        pass
+
+    def get_active(self, incident):
+        return self.call("get_active", incident)
+
+    def get_all_actives(self):
+        return self.call("get_all_actives")
+
+    def active_exists(self, incident):
+        return self.call("active_exists", incident)
+
+    def save_active(self, incident):
+        return self.call("save_active", incident)
+
+    def remove_active(self, incident):
+        return self.call("remove_active", incident)
+
+    def apply_active_changes(self, saves, removes, deliveries=None):
+        return self.call("apply_active_changes", saves, removes, deliveries)
+
+    def get_pending_outbox(self, now, limit):
+        return self.call("get_pending_outbox", now, limit)
+
+    def mark_outbox_delivered(self, ids, now):
+        return self.call("mark_outbox_delivered", ids, now)
+
+    def reschedule_outbox(self, retries):
+        return self.call("reschedule_outbox", retries)
+
+    def purge_outbox(self, delivered_before):
+        return self.call("purge_outbox", delivered_before)
+
+    def close(self):
+        self.db.close()
+
+
+def is_failure(method, result):
+    if method in NONE_ON_ERROR:
+        return result is None
+    return result is False
@@ -1,7 +1,10 @@
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
 import abc
-from .base import Database
+import contextlib
+import threading
+from .base import Database, create_outbox_rows
 from logzero import logger
 
 class PostgreSqlDatabase(Database):
@@ -31,6 +34,15 @@ class PostgreSqlDatabase(Database):
         else:
             logger.info("postgresql_database: schema ready")
 
+        self.create_outbox()
+
+        pool_size = settings.get("pool_size", 1)
+        logger.info("postgresql_database: creating connection pool of %s" % pool_size)
+        # connect on first use, so an unreachable server is logged by each call rather than failing initialise()
+        self.pool = psycopg2.pool.ThreadedConnectionPool(0, pool_size, self.connection_string)
+        # ThreadedConnectionPool raises rather than waits when exhausted, so make callers queue for a connection
+        self.pool_slots = threading.BoundedSemaphore(pool_size)
+
 
     def create_schema(self):
         logger.debug("postgresql_database: create_schema()")
@@ -47,80 +59,163 @@ class PostgreSqlDatabase(Database):
             if con:
                 con.close()
 
-    def get_active(self, incident):
-        logger.debug("postgresql_database: get_active()")
+    def create_outbox(self):
+        logger.debug("postgresql_database: create_outbox()")
         con = None
+
         try:
             con = psycopg2.connect(self.connection_string)
-            cur = con.cursor(cursor_factory=psycopg2.extras.DictCursor)
-            cur.execute('''SELECT * FROM active WHERE environment_group = %s AND environment = %s AND endpoint_group = %s AND endpoint = %s''',
-                (incident.endpoint.environment_group, incident.endpoint.environment, incident.endpoint.endpoint_group, incident.endpoint.endpoint))
-            data = cur.fetchone()
-            return data
+            cur = con.cursor()
+            cur.execute("CREATE TABLE IF NOT EXISTS outbox (id BIGSERIAL PRIMARY KEY, alert TEXT NOT NULL, payload TEXT NOT NULL, created DOUBLE PRECISION NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, next_attempt DOUBLE PRECISION NOT NULL, delivered DOUBLE PRECISION)")
+            cur.execute("CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (next_attempt) WHERE delivered IS NULL")
+            con.commit()
         except psycopg2.Error as e:
-            logger.error("postgresql_database: problem during get_active() - %s" % str(e))
+            logger.error("postgresql_database: problem during create_outbox() - %s" % str(e))
         finally:
             if con:
                 con.close()
 
+    @contextlib.contextmanager
+    def cursor(self, cursor_factory=None):
+        """
+        Borrow a pooled connection for one transaction, committing on success and rolling back on error.
+        Connections that have failed are discarded so that the next caller reconnects.
+        """
+        with self.pool_slots:
+            con = self.pool.getconn()
+            broken = False
+            try:
+                yield con.cursor(cursor_factory=cursor_factory)
+                con.commit()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                broken = True
+                raise
+            except Exception:
+                con.rollback()
+                raise
+            finally:
+                self.pool.putconn(con, close=broken or con.closed != 0)
+
+    def close(self):
+        logger.info("postgresql_database: close()")
+        self.pool.closeall()
+
+    def get_active(self, incident):
+        logger.debug("postgresql_database: get_active()")
+        try:
+            with self.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+                cur.execute('''SELECT * FROM active WHERE environment_group = %s AND environment = %s AND endpoint_group = %s AND endpoint = %s''',
+                    (incident.endpoint.environment_group, incident.endpoint.environment, incident.endpoint.endpoint_group, incident.endpoint.endpoint))
+                data = cur.fetchone()
+                return data
+        except psycopg2.Error as e:
+            logger.error("postgresql_database: problem during get_active() - %s" % str(e))
+
     def get_all_actives(self):
         logger.debug("postgresql_database: get_all_actives()")
-        con = None
         try:
-            con = psycopg2.connect(self.connection_string)
-            cur = con.cursor(cursor_factory=psycopg2.extras.DictCursor)
-            cur.execute("SELECT * FROM active")
-            data = cur.fetchall()
-            return data
+            with self.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+                cur.execute("SELECT * FROM active")
+                data = cur.fetchall()
+                return data
         except psycopg2.Error as e:
             logger.error("postgresql_database: problem during get_all_actives() - %s" % str(e))
             return None
-        finally:
-            if con:
-                con.close()
 
     def active_exists(self, incident):
         logger.debug("postgresql_database: active_exists()")
-        con = None
         try:
-            con = psycopg2.connect(self.connection_string)
-            cur = con.cursor()
-            cur.execute('''SELECT COUNT(*) FROM active WHERE environment_group = %s AND environment = %s AND endpoint_group = %s AND endpoint = %s''',
-                (incident.endpoint.environment_group, incident.endpoint.environment, incident.endpoint.endpoint_group, incident.endpoint.endpoint))
-            data = cur.fetchone()
-            return int(data[0]) > 0
+            with self.cursor() as cur:
+                cur.execute('''SELECT COUNT(*) FROM active WHERE environment_group = %s AND environment = %s AND endpoint_group = %s AND endpoint = %s''',
+                    (incident.endpoint.environment_group, incident.endpoint.environment, incident.endpoint.endpoint_group, incident.endpoint.endpoint))
+                data = cur.fetchone()
+                return int(data[0]) > 0
         except psycopg2.Error as e:
             logger.error("postgresql_database: problem during active_exists() - %s" % str(e))
-        finally:
-            if con:
-                con.close()
 
     def save_active(self, incident):
         logger.debug("postgresql_database: save_active()")
-        con = None
         try:
-            con = psycopg2.connect(self.connection_string)
-            cur = con.cursor()
-            cur.execute("INSERT INTO active VALUES (%s,%s,%s,%s,%s,%s,%s)",
-                (incident.endpoint.environment_group, incident.endpoint.environment, incident.endpoint.endpoint_group, incident.endpoint.endpoint, incident.timestamp, incident.message, incident.endpoint.url))
-            con.commit()
+            with self.cursor() as cur:
+                cur.execute("INSERT INTO active VALUES (%s,%s,%s,%s,%s,%s,%s)",
+                    (incident.endpoint.environment_group, incident.endpoint.environment, incident.endpoint.endpoint_group, incident.endpoint.endpoint, incident.timestamp, incident.message, incident.endpoint.url))
+            return True
         except psycopg2.Error as e:
             logger.error("postgresql_database: problem during save_active() - %s" % str(e))
-        finally:
-            if con:
-                con.close()
+            return False
+
+    def apply_active_changes(self, saves, removes, deliveries=None):
+        logger.debug("postgresql_database: apply_active_changes()")
+        try:
+            with self.cursor() as cur:
+                if len(removes) > 0:
+                    psycopg2.extras.execute_values(cur,
+                        "DELETE FROM active WHERE (environment_group, environment, endpoint_group, endpoint) IN (VALUES %s)",
+                        [(incident.endpoint.environment_group, incident.endpoint.environment, incident.endpoint.endpoint_group, incident.endpoint.endpoint) for incident in removes])
+                if len(saves) > 0:
+                    psycopg2.extras.execute_values(cur,
+                        "INSERT INTO active VALUES %s",
+                        [(incident.endpoint.environment_group, incident.endpoint.environment, incident.endpoint.endpoint_group, incident.endpoint.endpoint, incident.timestamp, incident.message, incident.endpoint.url) for incident in saves])
+                if deliveries:
+                    psycopg2.extras.execute_values(cur,
+                        "INSERT INTO outbox (alert, payload, created, next_attempt) VALUES %s",
+                        create_outbox_rows(deliveries))
+            return True
+        except psycopg2.Error as e:
+            logger.error("postgresql_database: problem during apply_active_changes() - %s" % str(e))
+            return False
+
+    def get_pending_outbox(self, now, limit):
+        logger.debug("postgresql_database: get_pending_outbox()")
+        try:
+            with self.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+                cur.execute("SELECT id, alert, payload, attempts FROM outbox WHERE delivered IS NULL AND next_attempt <= %s ORDER BY id LIMIT %s",
+                    (now, limit))
+                data = cur.fetchall()
+                return data
+        except psycopg2.Error as e:
+            logger.error("postgresql_database: problem during get_pending_outbox() - %s" % str(e))
+            return []
+
+    def mark_outbox_delivered(self, ids, now):
+        logger.debug("postgresql_database: mark_outbox_delivered()")
+        try:
+            with self.cursor() as cur:
+                cur.execute("UPDATE outbox SET delivered = %s WHERE id = ANY(%s)", (now, list(ids)))
+            return True
+        except psycopg2.Error as e:
+            logger.error("postgresql_database: problem during mark_outbox_delivered() - %s" % str(e))
+            return False
+
+    def reschedule_outbox(self, retries):
+        logger.debug("postgresql_database: reschedule_outbox()")
+        try:
+            with self.cursor() as cur:
+                psycopg2.extras.execute_values(cur,
+                    "UPDATE outbox SET attempts = retry.attempts, next_attempt = retry.next_attempt FROM (VALUES %s) AS retry (id, attempts, next_attempt) WHERE outbox.id = retry.id",
+                    retries)
+            return True
+        except psycopg2.Error as e:
+            logger.error("postgresql_database: problem during reschedule_outbox() - %s" % str(e))
+            return False
+
+    def purge_outbox(self, delivered_before):
+        logger.debug("postgresql_database: purge_outbox()")
+        try:
+            with self.cursor() as cur:
+                cur.execute("DELETE FROM outbox WHERE delivered IS NOT NULL AND delivered < %s", (delivered_before,))
+            return True
+        except psycopg2.Error as e:
+            logger.error("postgresql_database: problem during purge_outbox() - %s" % str(e))
+            return False
 
     def remove_active(self, incident):
         logger.debug("postgresql_database: remove_active()")
-        con = None
         try:
-            con = psycopg2.connect(self.connection_string)
-            cur = con.cursor()
-            cur.execute("DELETE FROM active WHERE environment_group = %s AND environment = %s AND endpoint_group = %s AND endpoint = %s",
-                (incident.endpoint.environment_group, incident.endpoint.environment, incident.endpoint.endpoint_group, incident.endpoint.endpoint))
-            con.commit()
+            with self.cursor() as cur:
+                cur.execute("DELETE FROM active WHERE environment_group = %s AND environment = %s AND endpoint_group = %s AND endpoint = %s",
+                    (incident.endpoint.environment_group, incident.endpoint.environment, incident.endpoint.endpoint_group, incident.endpoint.endpoint))
+            return True
         except psycopg2.Error as e:
             logger.error("postgresql_database: problem during remove_active() - %s" % str(e))
-        finally:
-            if con:
-                con.close()
+            return False
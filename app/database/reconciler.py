@@ -0,0 +1,121 @@
+import threading
+
+from logzero import logger
+from .base import get_active_key, get_row_key, create_active_row
+
+
+class ActiveReconciler:
+    """
+    Answer active incident lookups for one cycle from memory and write the cycle's changes back in one batch.
+
+    Loaded once from get_all_actives() at the start of a cycle, it offers the
+    same get_active(), active_exists(), save_active() and remove_active() calls
+    as a Database so that it can stand in for one while results arrive.
+
+    Changes that could not be written are kept, and written with the changes of
+    the next cycle the reconciler is used for.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.actives = {}
+        self.saves = {}
+        self.removes = {}
+        self.deliveries = []
+        self.lock = threading.Lock()
+
+    def begin(self):
+        """
+        Load the current actives, returning False if they could not be read.
+        Changes kept from a failed commit() are applied over what was loaded.
+        """
+        actives = self.db.get_all_actives()
+
+        if actives is None:
+            return False
+
+        with self.lock:
+            self.actives = {get_row_key(active): active for active in actives}
+            for key in self.removes:
+                self.actives.pop(key, None)
+            for key, incident in self.saves.items():
+                self.actives[key] = create_active_row(incident)
+
+        logger.debug("reconciler: loaded {} actives".format(len(self.actives)))
+        return True
+
+    def get_active(self, incident):
+        with self.lock:
+            return self.actives.get(get_active_key(incident.endpoint))
+
+    def active_exists(self, incident):
+        with self.lock:
+            return get_active_key(incident.endpoint) in self.actives
+
+    def save_active(self, incident):
+        key = get_active_key(incident.endpoint)
+        with self.lock:
+            self.actives[key] = create_active_row(incident)
+            self.saves[key] = incident
+            self.removes.pop(key, None)
+        return True
+
+    def remove_active(self, incident):
+        key = get_active_key(incident.endpoint)
+        with self.lock:
+            self.actives.pop(key, None)
+            if self.saves.pop(key, None) is None:
+                self.removes[key] = incident
+        return True
+
+    def apply_active_changes(self, saves, removes, deliveries=None):
+        for incident in removes:
+            self.remove_active(incident)
+
+        for incident in saves:
+            self.save_active(incident)
+
+        if deliveries:
+            with self.lock:
+                self.deliveries.extend(deliveries)
+
+        return True
+
+    def commit(self):
+        """
+        Write the changes made since the last commit, returning False and keeping them if they could not be written
+        """
+        with self.lock:
+            saves = list(self.saves.values())
+            removes = list(self.removes.values())
+            deliveries = self.deliveries
+            self.saves = {}
+            self.removes = {}
+            self.deliveries = []
+
+        if len(saves) == 0 and len(removes) == 0 and len(deliveries) == 0:
+            logger.debug("reconciler: no changes")
+            return True
+
+        logger.info("reconciler: writing {} new and {} cleared actives".format(len(saves), len(removes)))
+        if self.db.apply_active_changes(saves, removes, deliveries):
+            return True
+
+        logger.error("reconciler: could not write {} new and {} cleared actives, keeping them for the next commit".format(len(saves), len(removes)))
+        self.restore(saves, removes, deliveries)
+        return False
+
+    def restore(self, saves, removes, deliveries):
+        """
+        Put back changes that were taken for a commit, unless the endpoint has changed again since
+        """
+        with self.lock:
+            for incident in saves:
+                key = get_active_key(incident.endpoint)
+                if key not in self.saves and key not in self.removes:
+                    self.saves[key] = incident
+            for incident in removes:
+                key = get_active_key(incident.endpoint)
+                if key not in self.saves and key not in self.removes:
+                    self.removes[key] = incident
+            self.deliveries = deliveries + self.deliveries
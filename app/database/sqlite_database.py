@@ -1,9 +1,34 @@
 import sqlite3
 import abc
-from .base import Database
+import contextlib
+import threading
+from .base import Database, create_outbox_rows
 
 from logzero import logger
 
+SCHEMA_VERSION = 2
+
+CREATE_ACTIVE_TABLE = "CREATE TABLE active (environment_group TEXT NOT NULL, environment TEXT NOT NULL, endpoint_group TEXT NOT NULL, endpoint TEXT NOT NULL, timestamp INTEGER, message TEXT, url TEXT, PRIMARY KEY (environment_group, environment, endpoint_group, endpoint))"
+
+CREATE_OUTBOX_TABLE = "CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, alert TEXT NOT NULL, payload TEXT NOT NULL, created REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, next_attempt REAL NOT NULL, delivered REAL)"
+
+CREATE_OUTBOX_INDEX = "CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (next_attempt) WHERE delivered IS NULL"
+
+# ON CONFLICT ... DO UPDATE needs SQLite 3.24; older libraries fall back to INSERT OR REPLACE on the primary key
+if sqlite3.sqlite_version_info >= (3, 24, 0):
+    UPSERT_ACTIVE = "INSERT INTO active VALUES (?,?,?,?,?,?,?) ON CONFLICT (environment_group, environment, endpoint_group, endpoint) DO UPDATE SET timestamp = excluded.timestamp, message = excluded.message, url = excluded.url"
+else:
+    UPSERT_ACTIVE = "INSERT OR REPLACE INTO active VALUES (?,?,?,?,?,?,?)"
+
+CONNECTION_PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -8000",
+    "PRAGMA temp_store = MEMORY"
+]
+
+BUSY_TIMEOUT_SECONDS = 10
+
 class SqliteDatabase(Database):
 
     def initialise(self, settings):
@@ -11,118 +36,244 @@ class SqliteDatabase(Database):
         con = None
 
         create = False
+        migrate = False
 
         self.db_name = settings["db_name"]
+        self.con = None
+        self.lock = threading.Lock()
 
         try:
-            con = sqlite3.connect(self.db_name)
+            con = self.connect()
             cur = con.cursor()
-            cur.execute("SELECT * FROM active")
-            _ = cur.fetchone()
-        except sqlite3.Error:
-            # no active table
-            create = True
+            cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'active'")
+            if cur.fetchone()[0] == 0:
+                # no active table
+                create = True
+            else:
+                cur.execute("PRAGMA user_version")
+                migrate = cur.fetchone()[0] < SCHEMA_VERSION
+        except sqlite3.Error as e:
+            logger.error("sqlite_database: problem during initialise() - %s" % str(e))
         finally:
             if con:
                 con.close()
 
         if create:
             self.create_schema()
+        elif migrate:
+            self.migrate_schema()
         else:
             logger.info("sqlite_database: schema ready")
 
+        self.create_outbox()
+
+    def connect(self):
+        con = sqlite3.connect(self.db_name, timeout=BUSY_TIMEOUT_SECONDS, check_same_thread=False)
+        for pragma in CONNECTION_PRAGMAS:
+            con.execute(pragma)
+        return con
 
     def create_schema(self):
         logger.debug("sqlite_database: create_schema()")
         con = None
 
         try:
-            con = sqlite3.connect(self.db_name)
-            cur = con.cursor()
-            cur.execute("CREATE TABLE active (environment_group TEXT, environment TEXT, endpoint_group TEXT, endpoint TEXT, timestamp INTEGER, message TEXT, url TEXT)")
-            con.commit()
+            con = self.connect()
+            con.executescript("BEGIN; %s; PRAGMA user_version = %s; COMMIT;" % (CREATE_ACTIVE_TABLE, SCHEMA_VERSION))
         except sqlite3.Error as e:
             logger.error("sqlite_database: problem during create_schema() - %s" % str(e))
         finally:
             if con:
                 con.close()
 
-    def get_active(self, incident):
-        logger.debug("sqlite_database: get_active()")
+    def create_outbox(self):
+        logger.debug("sqlite_database: create_outbox()")
         con = None
+
         try:
-            con = sqlite3.connect(self.db_name)
-            con.row_factory = sqlite3.Row
-            cur = con.cursor()
-            cur.execute('''SELECT * FROM active WHERE environment_group = ? AND environment = ? AND endpoint_group = ? AND endpoint = ?''',
-                (incident.endpoint.environment_group, incident.endpoint.environment, incident.endpoint.endpoint_group, incident.endpoint.endpoint))
-            data = cur.fetchone()
-            return data
+            con = self.connect()
+            con.executescript("BEGIN; %s; %s; COMMIT;" % (CREATE_OUTBOX_TABLE, CREATE_OUTBOX_INDEX))
         except sqlite3.Error as e:
-            logger.error("sqlite_database: problem during get_active() - %s" % str(e))
+            logger.error("sqlite_database: problem during create_outbox() - %s" % str(e))
         finally:
             if con:
                 con.close()
 
-    def get_all_actives(self):
-        logger.debug("sqlite_database: get_all_actives()")
+    def migrate_schema(self):
+        """
+        Rebuild a version 1 active table (no key) in place with the version 2 primary key, keeping the oldest row per endpoint
+        """
+        logger.info("sqlite_database: migrate_schema() to version %s" % SCHEMA_VERSION)
         con = None
+
         try:
-            con = sqlite3.connect(self.db_name)
-            con.row_factory = sqlite3.Row
-            cur = con.cursor()
-            cur.execute("SELECT * FROM active")
-            data = cur.fetchall()
-            return data
+            con = self.connect()
+            con.executescript(
+                "BEGIN; "
+                "ALTER TABLE active RENAME TO active_v1; "
+                "%s; "
+                "INSERT OR IGNORE INTO active SELECT environment_group, environment, endpoint_group, endpoint, timestamp, message, url FROM active_v1 "
+                "WHERE environment_group IS NOT NULL AND environment IS NOT NULL AND endpoint_group IS NOT NULL AND endpoint IS NOT NULL "
+                "ORDER BY timestamp; "
+                "DROP TABLE active_v1; "
+                "PRAGMA user_version = %s; "
+                "COMMIT;" % (CREATE_ACTIVE_TABLE, SCHEMA_VERSION))
         except sqlite3.Error as e:
-            logger.error("sqlite_database: problem during get_all_actives() - %s" % str(e))
-            return None
+            logger.error("sqlite_database: problem during migrate_schema() - %s" % str(e))
+            if con:
+                con.rollback()
+            # every write relies on the version 2 key, so do not carry on with the old table
+            raise
         finally:
             if con:
                 con.close()
 
+    @contextlib.contextmanager
+    def cursor(self):
+        """
+        Use the shared connection for one transaction, committing on success and rolling back on error.
+        The connection is opened on first use and dropped after an operational error so that the next caller reconnects.
+        """
+        with self.lock:
+            if self.con is None:
+                logger.debug("sqlite_database: connecting")
+                self.con = self.connect()
+                self.con.row_factory = sqlite3.Row
+
+            try:
+                yield self.con.cursor()
+                self.con.commit()
+            except (sqlite3.OperationalError, sqlite3.ProgrammingError):
+                self._disconnect()
+                raise
+            except Exception:
+                self.con.rollback()
+                raise
+
+    def _disconnect(self):
+        try:
+            self.con.close()
+        except sqlite3.Error:
+            pass
+        self.con = None
+
+    def close(self):
+        logger.info("sqlite_database: close()")
+        with self.lock:
+            if self.con is not None:
+                self._disconnect()
+
+    def get_active(self, incident):
+        logger.debug("sqlite_database: get_active()")
+        try:
+            with self.cursor() as cur:
+                cur.execute('''SELECT * FROM active WHERE environment_group = ? AND environment = ? AND endpoint_group = ? AND endpoint = ?''',
+                    (incident.endpoint.environment_group, incident.endpoint.environment, incident.endpoint.endpoint_group, incident.endpoint.endpoint))
+                data = cur.fetchone()
+                return data
+        except sqlite3.Error as e:
+            logger.error("sqlite_database: problem during get_active() - %s" % str(e))
+
+    def get_all_actives(self):
+        logger.debug("sqlite_database: get_all_actives()")
+        try:
+            with self.cursor() as cur:
+                cur.execute("SELECT * FROM active")
+                data = cur.fetchall()
+                return data
+        except sqlite3.Error as e:
+            logger.error("sqlite_database: problem during get_all_actives() - %s" % str(e))
+            return None
+
     def active_exists(self, incident):
         logger.debug("sqlite_database: active_exists()")
-        con = None
         try:
-            con = sqlite3.connect(self.db_name)
-            cur = con.cursor()
-            cur.execute('''SELECT COUNT(*) FROM active WHERE environment_group = ? AND environment = ? AND endpoint_group = ? AND endpoint = ?''',
-                (incident.endpoint.environment_group, incident.endpoint.environment, incident.endpoint.endpoint_group, incident.endpoint.endpoint))
-            data = cur.fetchone()
-            return int(data[0]) > 0
+            with self.cursor() as cur:
+                cur.execute('''SELECT COUNT(*) FROM active WHERE environment_group = ? AND environment = ? AND endpoint_group = ? AND endpoint = ?''',
+                    (incident.endpoint.environment_group, incident.endpoint.environment, incident.endpoint.endpoint_group, incident.endpoint.endpoint))
+                data = cur.fetchone()
+                return int(data[0]) > 0
         except sqlite3.Error as e:
             logger.error("sqlite_database: problem during active_exists() - %s" % str(e))
-        finally:
-            if con:
-                con.close()
 
     def save_active(self, incident):
         logger.debug("sqlite_database: save_active()")
-        con = None
         try:
-            con = sqlite3.connect(self.db_name)
-            cur = con.cursor()
-            cur.execute("INSERT INTO active VALUES (?,?,?,?,?,?,?)",
-                (incident.endpoint.environment_group, incident.endpoint.environment, incident.endpoint.endpoint_group, incident.endpoint.endpoint, incident.timestamp, incident.message, incident.endpoint.url))
-            con.commit()
+            with self.cursor() as cur:
+                cur.execute(UPSERT_ACTIVE,
+                    (incident.endpoint.environment_group, incident.endpoint.environment, incident.endpoint.endpoint_group, incident.endpoint.endpoint, incident.timestamp, incident.message, incident.endpoint.url))
+            return True
         except sqlite3.Error as e:
             logger.error("sqlite_database: problem during save_active() - %s" % str(e))
-        finally:
-            if con:
-                con.close()
+            return False
+
+    def apply_active_changes(self, saves, removes, deliveries=None):
+        logger.debug("sqlite_database: apply_active_changes()")
+        try:
+            with self.cursor() as cur:
+                cur.executemany("DELETE FROM active WHERE environment_group = ? AND environment = ? AND endpoint_group = ? AND endpoint = ?",
+                    [(incident.endpoint.environment_group, incident.endpoint.environment, incident.endpoint.endpoint_group, incident.endpoint.endpoint) for incident in removes])
+                cur.executemany(UPSERT_ACTIVE,
+                    [(incident.endpoint.environment_group, incident.endpoint.environment, incident.endpoint.endpoint_group, incident.endpoint.endpoint, incident.timestamp, incident.message, incident.endpoint.url) for incident in saves])
+                if deliveries:
+                    cur.executemany("INSERT INTO outbox (alert, payload, created, next_attempt) VALUES (?,?,?,?)",
+                        create_outbox_rows(deliveries))
+            return True
+        except sqlite3.Error as e:
+            logger.error("sqlite_database: problem during apply_active_changes() - %s" % str(e))
+            return False
+
+    def get_pending_outbox(self, now, limit):
+        logger.debug("sqlite_database: get_pending_outbox()")
+        try:
+            with self.cursor() as cur:
+                cur.execute("SELECT id, alert, payload, attempts FROM outbox WHERE delivered IS NULL AND next_attempt <= ? ORDER BY id LIMIT ?",
+                    (now, limit))
+                data = cur.fetchall()
+                return data
+        except sqlite3.Error as e:
+            logger.error("sqlite_database: problem during get_pending_outbox() - %s" % str(e))
+            return []
+
+    def mark_outbox_delivered(self, ids, now):
+        logger.debug("sqlite_database: mark_outbox_delivered()")
+        try:
+            with self.cursor() as cur:
+                cur.executemany("UPDATE outbox SET delivered = ? WHERE id = ?",
+                    [(now, id) for id in ids])
+            return True
+        except sqlite3.Error as e:
+            logger.error("sqlite_database: problem during mark_outbox_delivered() - %s" % str(e))
+            return False
+
+    def reschedule_outbox(self, retries):
+        logger.debug("sqlite_database: reschedule_outbox()")
+        try:
+            with self.cursor() as cur:
+                cur.executemany("UPDATE outbox SET attempts = ?, next_attempt = ? WHERE id = ?",
+                    [(attempts, next_attempt, id) for id, attempts, next_attempt in retries])
+            return True
+        except sqlite3.Error as e:
+            logger.error("sqlite_database: problem during reschedule_outbox() - %s" % str(e))
+            return False
+
+    def purge_outbox(self, delivered_before):
+        logger.debug("sqlite_database: purge_outbox()")
+        try:
+            with self.cursor() as cur:
+                cur.execute("DELETE FROM outbox WHERE delivered IS NOT NULL AND delivered < ?", (delivered_before,))
+            return True
+        except sqlite3.Error as e:
+            logger.error("sqlite_database: problem during purge_outbox() - %s" % str(e))
+            return False
 
     def remove_active(self, incident):
         logger.debug("sqlite_database: remove_active()")
-        con = None
         try:
-            con = sqlite3.connect(self.db_name)
-            cur = con.cursor()
-            cur.execute("DELETE FROM active WHERE environment_group = ? AND environment = ? AND endpoint_group = ? AND endpoint = ?",
-                (incident.endpoint.environment_group, incident.endpoint.environment, incident.endpoint.endpoint_group, incident.endpoint.endpoint))
-            con.commit()
+            with self.cursor() as cur:
+                cur.execute("DELETE FROM active WHERE environment_group = ? AND environment = ? AND endpoint_group = ? AND endpoint = ?",
+                    (incident.endpoint.environment_group, incident.endpoint.environment, incident.endpoint.endpoint_group, incident.endpoint.endpoint))
+            return True
         except sqlite3.Error as e:
             logger.error("sqlite_database: problem during remove_active() - %s" % str(e))
-        finally:
-            if con:
-                con.close()
+            return False
@@ -0,0 +1,321 @@
+from collections import deque
+from urllib.parse import urlparse
+import threading
+
+import telemetry
+
+
+def get_host(url):
+    return urlparse(url).netloc.lower()
+
+
+def get_group(key):
+    """
+    Return the (environment group, environment, endpoint group) part of an endpoint key
+    """
+    return key[:3]
+
+
+class TokenBucket:
+    """
+    Allow up to rate events per second on average, with bursts of up to burst events
+    """
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now):
+        """
+        Take a token if one is available now
+        """
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens = self.tokens - 1
+            return True
+        return False
+
+    def reserve(self, now):
+        """
+        Take a token, returning the number of seconds to wait before it may be used
+        """
+        self._refill(now)
+        self.tokens = self.tokens - 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def next_available(self, now):
+        self._refill(now)
+        if self.tokens >= 1:
+            return now
+        return now + (1 - self.tokens) / self.rate
+
+
+class ProbeLimiter:
+    """
+    Limit in-flight probes per host and per endpoint group, and optionally the rate of probes per host.
+
+    A limit of 0 means unlimited.
+    """
+
+    def __init__(self, per_host, per_group, host_rate, host_burst):
+        self.per_host = per_host
+        self.per_group = per_group
+        self.host_rate = host_rate
+        self.host_burst = host_burst
+        self._hosts = {}
+        self._groups = {}
+        self._buckets = {}
+
+    def try_acquire(self, host, group, now):
+        if self.per_host > 0 and self._hosts.get(host, 0) >= self.per_host:
+            return False
+
+        if self.per_group > 0 and self._groups.get(group, 0) >= self.per_group:
+            return False
+
+        if self.host_rate > 0 and not self._get_bucket(host, now).take(now):
+            return False
+
+        self._hosts[host] = self._hosts.get(host, 0) + 1
+        self._groups[group] = self._groups.get(group, 0) + 1
+        return True
+
+    def release(self, host, group):
+        self._hosts[host] = self._hosts[host] - 1
+        if self._hosts[host] == 0:
+            del self._hosts[host]
+
+        self._groups[group] = self._groups[group] - 1
+        if self._groups[group] == 0:
+            del self._groups[group]
+
+    def is_host_available(self, host, now):
+        """
+        Return whether the host's own limits would allow a probe now, whatever its endpoint group
+        """
+        if self.per_host > 0 and self._hosts.get(host, 0) >= self.per_host:
+            return False
+        return self.next_available(host, now) <= now
+
+    def next_available(self, host, now):
+        """
+        Return when the host's rate limit next allows a probe
+        """
+        if self.host_rate <= 0:
+            return now
+        return self._get_bucket(host, now).next_available(now)
+
+    def _get_bucket(self, host, now):
+        if host not in self._buckets:
+            self._buckets[host] = TokenBucket(self.host_rate, self.host_burst, now)
+        return self._buckets[host]
+
+
+class HostRotation:
+    """
+    Hold waiting probes per host, handing them out round-robin across hosts.
+
+    Within a host, probes start in order, except that a probe whose endpoint
+    group is at its limit lets the next probe of another group go first.
+    """
+
+    def __init__(self):
+        self._queues = {}
+        self._rotation = deque()
+
+    def __len__(self):
+        return len(self._rotation)
+
+    def hosts(self):
+        return self._queues.keys()
+
+    def push(self, probe, front=False):
+        host = get_host(probe.original_url)
+
+        if host not in self._queues:
+            self._queues[host] = deque()
+            self._rotation.append(host)
+
+        if front:
+            self._queues[host].appendleft(probe)
+        else:
+            self._queues[host].append(probe)
+
+    def pop(self, limiter, now):
+        for _ in range(len(self._rotation)):
+            host = self._rotation[0]
+            self._rotation.rotate(-1)
+            queue = self._queues[host]
+
+            index = find_startable(host, queue, limiter, now)
+            if index is None:
+                continue
+
+            probe = queue[index]
+            del queue[index]
+            if len(queue) == 0:
+                del self._queues[host]
+                self._rotation.remove(host)
+            return probe
+
+        return None
+
+
+def find_startable(host, queue, limiter, now):
+    """
+    Return the index of the first probe in a host's queue that the limiter lets start now, acquiring its limits, or None
+    """
+    if limiter is None:
+        return 0
+
+    if not limiter.is_host_available(host, now):
+        return None
+
+    refused = set()
+    for index, probe in enumerate(queue):
+        group = get_group(probe.key)
+        if group in refused:
+            continue
+        if limiter.try_acquire(host, group, now):
+            return index
+        refused.add(group)
+
+    return None
+
+
+class ProbeQueue:
+    """
+    Hold probes waiting for a worker and decide which may start next.
+
+    Probes are queued per host and handed out round-robin across hosts, so
+    probes of one host are spread out between those of the others. A probe
+    whose host or endpoint group is at its limit is held back while probes of
+    other hosts go ahead.
+
+    With bulkheads, probes are first divided by their bulkhead. Each bulkhead
+    with waiting probes is guaranteed an equal part of min_share of the
+    capacity, and may borrow any capacity not needed to meet the guarantees
+    of the other waiting bulkheads.
+    """
+
+    def __init__(self, limiter=None, min_share=None):
+        self.limiter = limiter
+        self.min_share = min_share
+        self._bulkheads = {}
+        self._rotation = deque()
+        self._in_flight = {}
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return self._size
+
+    def push(self, probe, front=False):
+        bulkhead = self._get_bulkhead(probe)
+
+        with self._lock:
+            if bulkhead not in self._bulkheads:
+                self._bulkheads[bulkhead] = HostRotation()
+                self._rotation.append(bulkhead)
+
+            self._bulkheads[bulkhead].push(probe, front)
+            self._size = self._size + 1
+
+        telemetry.PROBES_QUEUED.inc()
+
+    def pop(self, now, capacity):
+        """
+        Return the next probe that may start now with at most capacity probes in flight, or None
+        """
+        with self._lock:
+            in_flight = sum(self._in_flight.values())
+            if in_flight >= capacity or len(self._rotation) == 0:
+                return None
+
+            if self.min_share is None:
+                return self._pop_from(self._rotation[0], now)
+
+            guarantee = max(1, int(capacity * self.min_share / len(self._rotation)))
+            unmet = sum([max(0, guarantee - self._in_flight.get(bulkhead, 0)) for bulkhead in self._rotation])
+
+            # bulkheads within their guarantee go first, then any bulkhead may borrow what is left over
+            borrowers = []
+            for _ in range(len(self._rotation)):
+                bulkhead = self._rotation[0]
+                self._rotation.rotate(-1)
+
+                if self._in_flight.get(bulkhead, 0) >= guarantee:
+                    borrowers.append(bulkhead)
+                    continue
+
+                probe = self._pop_from(bulkhead, now)
+                if probe is not None:
+                    return probe
+
+            if capacity - in_flight > unmet:
+                for bulkhead in borrowers:
+                    probe = self._pop_from(bulkhead, now)
+                    if probe is not None:
+                        return probe
+
+        return None
+
+    def _pop_from(self, bulkhead, now):
+        rotation = self._bulkheads[bulkhead]
+        probe = rotation.pop(self.limiter, now)
+        if probe is None:
+            return None
+
+        if len(rotation) == 0:
+            del self._bulkheads[bulkhead]
+            self._rotation.remove(bulkhead)
+
+        self._in_flight[bulkhead] = self._in_flight.get(bulkhead, 0) + 1
+        self._size = self._size - 1
+        telemetry.PROBES_QUEUED.dec()
+        return probe
+
+    def release(self, probe):
+        bulkhead = self._get_bulkhead(probe)
+
+        with self._lock:
+            self._in_flight[bulkhead] = self._in_flight[bulkhead] - 1
+            if self._in_flight[bulkhead] == 0:
+                del self._in_flight[bulkhead]
+
+            if self.limiter is not None:
+                self.limiter.release(get_host(probe.original_url), get_group(probe.key))
+
+    def next_ready(self, now):
+        """
+        Return when a rate limited host can next start a probe, or None if no host is waiting on its rate
+        """
+        if self.limiter is None or self.limiter.host_rate <= 0:
+            return None
+
+        with self._lock:
+            # hosts held back by a concurrency limit are released by a completing probe instead
+            waiting = [
+                self.limiter.next_available(host, now)
+                for rotation in self._bulkheads.values()
+                for host in rotation.hosts()
+            ]
+            waiting = [ready for ready in waiting if ready > now]
+
+        if len(waiting) == 0:
+            return None
+        return min(waiting)
+
+    def _get_bulkhead(self, probe):
+        if self.min_share is None:
+            return None
+        return probe.bulkhead
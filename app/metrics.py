@@ -1,10 +1,22 @@
 from logzero import logger
+from datetime import datetime, timezone
+import bisect
 import boto3
+import contextlib
 import json
+import queue
+import threading
+import time
 
 from models import Metric, Endpoint
+import telemetry
+import settings
 
 _cloudwatch_client = None
+_publisher = None
+
+# CloudWatch takes at most 150 values per datum, and one of them is the overflow bucket
+MAX_BUCKETS = 149
 
 def get_metrics_in_group(metrics_group_id, metrics_definitions):
     logger.debug("get_metrics_in_group: {}".format(metrics_group_id))
@@ -31,44 +43,246 @@ def deliver_metric(metric, metrics_id, metrics_definitions):
     for metrics in metrics_definitions["metrics"]:
         if metrics["id"] == metrics_id:
             if metrics["provider"]["@type"] == "cloudwatch":
-                metrics_cloudwatch(metric, metrics)
+                if _publisher is not None:
+                    _publisher.enqueue(metric, metrics)
+                else:
+                    metrics_cloudwatch(metric, metrics)
 
 
 def metrics_cloudwatch(metric, metrics):
     logger.debug("metrics_cloudwatch: {} {}".format(metrics["id"], metric.data))
     cloudwatch = cloudwatch_client(metrics["provider"])
-    cloudwatch.put_metric_data(
-        MetricData=[
-            {
-                'MetricName': metric.name,
-                'Dimensions': [
-                    {
-                        'Name': 'ENVIRONMENT-GROUP',
-                        'Value': metric.endpoint.environment_group
-                    },
-                    {
-                        'Name': 'ENVIRONMENT',
-                        'Value': metric.endpoint.environment
-                    },
-                    {
-                        'Name': 'ENDPOINT-GROUP',
-                        'Value': metric.endpoint.endpoint_group
-                    },
-                    {
-                        'Name': 'ENDPOINT',
-                        'Value': metric.endpoint.endpoint
-                    },
-                ],
-                'Unit': 'Milliseconds',
-                'Value': metric.data
-            },
-        ],
-        Namespace=metrics["provider"]["namespace"]
-    )
+    with time_delivery("cloudwatch"):
+        cloudwatch.put_metric_data(
+            MetricData=[
+                create_cloudwatch_datum(metric)
+            ],
+            Namespace=metrics["provider"]["namespace"]
+        )
+
+
+@contextlib.contextmanager
+def time_delivery(provider):
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        telemetry.METRIC_DELIVERY_ERRORS.inc(provider=provider)
+        raise
+    finally:
+        telemetry.METRIC_DELIVERY_DURATION.observe(time.perf_counter() - started, provider=provider)
+
+
+def create_cloudwatch_datum(metric, include_timestamp=False):
+    datum = {
+        'MetricName': metric.name,
+        'Dimensions': create_cloudwatch_dimensions(metric.endpoint),
+        'Unit': 'Milliseconds',
+        'Value': metric.data
+    }
+
+    if include_timestamp:
+        datum['Timestamp'] = datetime.fromtimestamp(metric.timestamp, timezone.utc)
+
+    return datum
+
+
+def create_cloudwatch_dimensions(endpoint):
+    return [
+        {
+            'Name': 'ENVIRONMENT-GROUP',
+            'Value': endpoint.environment_group
+        },
+        {
+            'Name': 'ENVIRONMENT',
+            'Value': endpoint.environment
+        },
+        {
+            'Name': 'ENDPOINT-GROUP',
+            'Value': endpoint.endpoint_group
+        },
+        {
+            'Name': 'ENDPOINT',
+            'Value': endpoint.endpoint
+        },
+    ]
 
 
 def cloudwatch_client(provider):
     global _cloudwatch_client
     if _cloudwatch_client is None:
-        _cloudwatch_client = boto3.client("cloudwatch", provider["region"])
+        _cloudwatch_client = boto3.client("cloudwatch", provider["region"], endpoint_url=settings.CLOUDWATCH_ENDPOINT_URL or None)
     return _cloudwatch_client
+
+
+def start_publisher(batch_size, flush_seconds, max_queued, aggregate=False, buckets=None):
+    global _publisher
+    if buckets and len(buckets) > MAX_BUCKETS:
+        raise ValueError("at most {} metric buckets can be published, {} given".format(MAX_BUCKETS, len(buckets)))
+    _publisher = MetricsPublisher(batch_size, flush_seconds, max_queued, aggregate, buckets)
+    _publisher.start()
+
+
+def stop_publisher():
+    global _publisher
+    if _publisher is not None:
+        _publisher.stop()
+        _publisher = None
+
+
+class MetricsPublisher:
+    """
+    Batch metrics on a background thread so that probe workers only have to enqueue them.
+
+    Metrics are grouped by CloudWatch region and namespace and sent when a batch
+    reaches batch_size or every flush_seconds, whichever comes first. At most
+    max_queued metrics are held; anything beyond that is dropped and counted.
+
+    When aggregate is set, individual values are not sent at all. Instead each
+    metric and set of dimensions is folded into a StatisticSet and published
+    once per flush_seconds window.
+    """
+
+    def __init__(self, batch_size, flush_seconds, max_queued, aggregate=False, buckets=None):
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.aggregate = aggregate
+        self.buckets = buckets
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics-publisher", daemon=True)
+
+    def start(self):
+        logger.info("metrics: starting publisher (batch size {}, flush every {}s, aggregate: {})".format(self.batch_size, self.flush_seconds, self.aggregate))
+        self._thread.start()
+
+    def stop(self):
+        logger.info("metrics: stopping publisher")
+        self._stopping.set()
+        self._thread.join()
+
+    def enqueue(self, metric, metrics):
+        try:
+            self._queue.put_nowait((metric, metrics))
+        except queue.Full:
+            self.dropped = self.dropped + 1
+
+    def _run(self):
+        batches = {}
+        statistics = {}
+        deadline = time.time() + self.flush_seconds
+
+        while True:
+            stopping = self._stopping.is_set()
+
+            try:
+                metric, metrics = self._queue.get(
+                    block=not stopping,
+                    timeout=max(0.0, min(deadline - time.time(), 1.0)))
+            except queue.Empty:
+                if stopping:
+                    # queue drained after a stop request
+                    self._flush(batches, statistics)
+                    return
+            else:
+                key = (metrics["provider"]["region"], metrics["provider"]["namespace"])
+                if self.aggregate:
+                    self._accumulate(statistics, key, metric, metrics["provider"])
+                else:
+                    provider, batch = batches.setdefault(key, (metrics["provider"], []))
+                    batch.append(create_cloudwatch_datum(metric, include_timestamp=True))
+                    if len(batch) >= self.batch_size:
+                        self._send(provider, batches.pop(key)[1])
+
+            if time.time() >= deadline:
+                self._flush(batches, statistics)
+                deadline = time.time() + self.flush_seconds
+
+    def _accumulate(self, statistics, key, metric, provider):
+        provider, accumulators = statistics.setdefault(key, (provider, {}))
+        endpoint = metric.endpoint
+        metric_key = (metric.name, endpoint.environment_group, endpoint.environment, endpoint.endpoint_group, endpoint.endpoint)
+
+        if metric_key not in accumulators:
+            accumulators[metric_key] = StatisticSet(metric.name, endpoint, self.buckets)
+
+        accumulators[metric_key].add(metric.data, metric.timestamp)
+
+    def _flush(self, batches, statistics):
+        for provider, batch in batches.values():
+            self._send(provider, batch)
+        batches.clear()
+
+        for provider, accumulators in statistics.values():
+            datums = [statistic_set.as_cloudwatch_datum() for statistic_set in accumulators.values()]
+            for i in range(0, len(datums), self.batch_size):
+                self._send(provider, datums[i:i + self.batch_size])
+        statistics.clear()
+
+        if self.dropped > 0:
+            logger.warning("metrics: queue full, dropped {} metrics".format(self.dropped))
+            self.dropped = 0
+
+    def _send(self, provider, batch):
+        logger.debug("metrics: sending {} metrics to {}".format(len(batch), provider["namespace"]))
+        try:
+            with time_delivery("cloudwatch"):
+                cloudwatch_client(provider).put_metric_data(
+                    MetricData=batch,
+                    Namespace=provider["namespace"]
+                )
+        except Exception as e:
+            logger.error("metrics: problem sending {} metrics to {} - {}".format(len(batch), provider["namespace"], str(e)))
+
+
+class StatisticSet:
+    """
+    Accumulate count, sum, minimum and maximum (and optionally bucket counts) for one metric over a window
+    """
+
+    __slots__ = ("name", "endpoint", "buckets", "counts", "count", "sum", "minimum", "maximum", "timestamp")
+
+    def __init__(self, name, endpoint, buckets=None):
+        self.name = name
+        self.endpoint = endpoint
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) if buckets else None
+        self.count = 0
+        self.sum = 0
+        self.minimum = None
+        self.maximum = None
+        self.timestamp = None
+
+    def add(self, value, timestamp):
+        self.count = self.count + 1
+        self.sum = self.sum + value
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+        self.timestamp = timestamp
+
+        if self.counts is not None:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+
+    def as_cloudwatch_datum(self):
+        datum = {
+            'MetricName': self.name,
+            'Dimensions': create_cloudwatch_dimensions(self.endpoint),
+            'Unit': 'Milliseconds',
+            'Timestamp': datetime.fromtimestamp(self.timestamp, timezone.utc)
+        }
+
+        if self.counts is None:
+            datum['StatisticValues'] = {
+                'SampleCount': self.count,
+                'Sum': self.sum,
+                'Minimum': self.minimum,
+                'Maximum': self.maximum
+            }
+        else:
+            # each bucket is reported at its upper bound, and the overflow bucket at the largest value seen
+            bounds = list(self.buckets) + [max(self.maximum, self.buckets[-1] + 1)]
+            datum['Values'] = [bound for bound, count in zip(bounds, self.counts) if count > 0]
+            datum['Counts'] = [count for count in self.counts if count > 0]
+
+        return datum
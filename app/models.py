@@ -1,5 +1,7 @@
 import json
 
+import timing
+
 class Incident:
     """
     Hold the fields associated with an incident
@@ -27,12 +29,46 @@ class Incident:
             "presentation_message": self.presentation_message
         }
 
+    @staticmethod
+    def from_dict(data):
+        """
+        Rebuild an incident from the output of as_dict()
+        """
+        endpoint = None
+        if data["endpoint"]:
+            endpoint = Endpoint(
+                environment_group=data["environment_group"],
+                environment=data["environment"],
+                endpoint_group=data["endpoint_group"],
+                endpoint=data["endpoint"],
+                url=data["url"]
+            )
+
+        return Incident(
+            timestamp=data["timestamp"],
+            endpoint=endpoint,
+            result=data["result"],
+            expected=data["expected"],
+            message=data["message"],
+            presentation_message=data["presentation_message"]
+        )
+
 
 class Threshold:
     """
-    Analyse a timing against a threshold
+    Analyse the timings of a probe against a threshold.
+
+    min and max apply to the total response time. A threshold may also hold
+    a min and max for each phase, e.g. {"max": 500, "dns": {"max": 50}}.
     """
 
+    PHASES = {
+        "dns": timing.DNS,
+        "connect": timing.CONNECT,
+        "tls": timing.TLS,
+        "firstByte": timing.FIRST_BYTE
+    }
+
     def __init__(self, threshold):
         if "min" in threshold:
             self.min = threshold["min"]
@@ -43,8 +79,19 @@ class Threshold:
         else:
             self.max = None
 
-    def result(self, test_time):
-        milliseconds = int(round(int(getattr(test_time, "microsecond")) / 1000.0))
+        self.phases = {}
+        for name, phase in Threshold.PHASES.items():
+            if name in threshold:
+                self.phases[phase] = (name, threshold[name].get("min"), threshold[name].get("max"))
+
+    def get_identity(self):
+        return (self.min, self.max, tuple(sorted(self.phases.items())))
+
+    def result(self, timings):
+        """
+        Check timings in milliseconds keyed by phase; a phase that did not happen is not checked
+        """
+        milliseconds = timings[timing.TOTAL]
 
         if self.min is not None and milliseconds < self.min:
             return ThresholdResult(
@@ -58,6 +105,22 @@ class Threshold:
                 result="time {}ms greater than maximum {}ms".format(milliseconds, self.max)
             )
 
+        for phase, (name, minimum, maximum) in self.phases.items():
+            if phase not in timings:
+                continue
+
+            if minimum is not None and timings[phase] < minimum:
+                return ThresholdResult(
+                    okay=False,
+                    result="{} time {}ms less than minimum {}ms".format(name, timings[phase], minimum)
+                )
+
+            if maximum is not None and timings[phase] > maximum:
+                return ThresholdResult(
+                    okay=False,
+                    result="{} time {}ms greater than maximum {}ms".format(name, timings[phase], maximum)
+                )
+
         return ThresholdResult()
 
 
@@ -76,12 +139,14 @@ class Endpoint:
     Represent an endpoint's metadata
     """
 
-    def __init__(self, environment_group, environment, endpoint_group, endpoint, url):
+    def __init__(self, environment_group, environment, endpoint_group, endpoint, url, fresh_connection=False, certificate_expiry_days=None):
         self.environment_group = environment_group
         self.environment = environment
         self.endpoint_group = endpoint_group
         self.endpoint = endpoint
         self.url = url
+        self.fresh_connection = fresh_connection
+        self.certificate_expiry_days = certificate_expiry_days
 
 
     def __repr__(self):
@@ -104,3 +169,43 @@ class Metric:
         self.timestamp = timestamp
         self.name = name
         self.data = data
+
+
+class ProbeAttempt:
+    """
+    Hold the state of one probe of an endpoint across its attempts
+    """
+
+    def __init__(self, key, bulkhead, endpoint, metrics_groups, alert_groups, expected, threshold, timestamp, duplicates=()):
+        self.key = key
+        self.bulkhead = bulkhead
+        self.endpoint = endpoint
+        self.metrics_groups = metrics_groups
+        self.alert_groups = alert_groups
+        self.expected = expected
+        self.threshold = threshold
+        self.timestamp = timestamp
+        self.original_url = endpoint.url
+        self.attempt = 0
+        # other listings of the same probe, which share its outcome
+        self.duplicates = duplicates
+
+
+class ProbeOutcome:
+    """
+    Hold the raw observation from a single probe attempt
+    """
+
+    RESPONSE = "response"
+    CONNECTED = "connected"
+    TIMEOUT = "timeout"
+    ERROR = "error"
+
+    def __init__(self, kind, phases, status=None, body=None, error=None, certificate_expiry=None):
+        self.kind = kind
+        # seconds taken by each phase of the attempt that happened, keyed by metric name
+        self.phases = phases
+        self.status = status
+        self.body = body
+        self.error = error
+        self.certificate_expiry = certificate_expiry
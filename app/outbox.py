@@ -0,0 +1,143 @@
+from logzero import logger
+import json
+import threading
+import time
+
+from models import Incident
+import alerts
+
+_deliverer = None
+
+
+def start_deliverer(db, poll_seconds, batch_size, backoff_seconds, max_backoff_seconds, retention_seconds, coalesce=False):
+    global _deliverer
+    _deliverer = OutboxDeliverer(db, poll_seconds, batch_size, backoff_seconds, max_backoff_seconds, retention_seconds, coalesce)
+    _deliverer.start()
+
+
+def notify():
+    if _deliverer is not None:
+        _deliverer.notify()
+
+
+def stop_deliverer():
+    global _deliverer
+    if _deliverer is not None:
+        _deliverer.stop()
+        _deliverer = None
+
+
+def get_backoff(attempts, backoff_seconds, max_backoff_seconds):
+    return min(backoff_seconds * 2 ** attempts, max_backoff_seconds)
+
+
+class OutboxDeliverer:
+    """
+    Send pending alert deliveries from the database outbox.
+
+    Deliveries are written in the same transaction as the incident state
+    change, so an alert is never lost if Cupcake stops or a sink is down.
+    The deliverer wakes every poll_seconds, or when notified, and sends
+    pending rows in batches. Delivered rows are marked done and failed rows
+    are retried with exponential backoff.
+    """
+
+    def __init__(self, db, poll_seconds, batch_size, backoff_seconds, max_backoff_seconds, retention_seconds, coalesce=False):
+        self.db = db
+        self.poll_seconds = poll_seconds
+        self.batch_size = batch_size
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.retention_seconds = retention_seconds
+        self.coalesce = coalesce
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="outbox-deliverer", daemon=True)
+        self._last_purge = 0
+
+    def start(self):
+        logger.info("outbox: starting deliverer (batch size {}, polling every {}s)".format(self.batch_size, self.poll_seconds))
+        self._thread.start()
+
+    def notify(self):
+        self._wake.set()
+
+    def stop(self):
+        self._stopping.set()
+        self._wake.set()
+        self._thread.join()
+        # one last pass for anything written since the thread last woke
+        self.deliver_pending()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wake.wait(self.poll_seconds)
+            self._wake.clear()
+            if self._stopping.is_set():
+                return
+            try:
+                self.deliver_pending()
+                self.purge()
+            except Exception as e:
+                logger.error("outbox: problem delivering pending alerts - {}".format(str(e)))
+
+    def deliver_pending(self):
+        """
+        Send batches of due deliveries until none remain
+        """
+        while True:
+            rows = self.db.get_pending_outbox(time.time(), self.batch_size)
+            if len(rows) == 0:
+                return
+
+            delivered, failed = self.deliver_batch(rows)
+
+            now = time.time()
+            if len(delivered) > 0:
+                self.db.mark_outbox_delivered(delivered, now)
+            if len(failed) > 0:
+                logger.warning("outbox: {} deliveries failed, will retry".format(len(failed)))
+                self.db.reschedule_outbox([
+                    (row["id"], row["attempts"] + 1, now + get_backoff(row["attempts"], self.backoff_seconds, self.max_backoff_seconds))
+                    for row in failed
+                ])
+
+            if len(failed) > 0 or len(rows) < self.batch_size:
+                return
+
+    def deliver_batch(self, rows):
+        """
+        Send a batch of outbox rows, returning the ids delivered and the rows that failed
+        """
+        pending = {}
+        for row in rows:
+            alert = json.loads(row["alert"])
+            _, batch = pending.setdefault(alert["id"], (alert, []))
+            batch.append((row, Incident.from_dict(json.loads(row["payload"]))))
+
+        delivered = []
+        failed = []
+        for alert, batch in pending.values():
+            if self.coalesce and len(batch) > 1:
+                digests = alerts.create_digests([incident for _, incident in batch], alerts.get_message_limit(alert))
+                if all([alerts.send_alert(digest, alert) for digest in digests]):
+                    delivered.extend([row["id"] for row, _ in batch])
+                else:
+                    failed.extend([row for row, _ in batch])
+                continue
+
+            for row, incident in batch:
+                if alerts.send_alert(incident, alert):
+                    delivered.append(row["id"])
+                else:
+                    failed.append(row)
+
+        return delivered, failed
+
+    def purge(self):
+        now = time.time()
+        if now - self._last_purge < self.retention_seconds:
+            return
+
+        self._last_purge = now
+        self.db.purge_outbox(now - self.retention_seconds)
@@ -0,0 +1,158 @@
+from logzero import logger
+from collections import namedtuple
+
+from alerts import get_alerts_in_group
+from models import Threshold, Endpoint
+
+
+class EndpointSpec(namedtuple("EndpointSpec", [
+        "environment_group",
+        "environment",
+        "endpoint_group",
+        "endpoint",
+        "url",
+        "trace_argument_key",
+        "attempt_argument_key",
+        "fresh_connection",
+        "certificate_expiry_days",
+        "interval",
+        "bulkhead",
+        "expected",
+        "threshold",
+        "metrics_groups",
+        "alert_groups"])):
+    """
+    Hold an endpoint definition with its inherited properties already resolved
+    """
+
+    __slots__ = ()
+
+    @property
+    def key(self):
+        return (self.environment_group, self.environment, self.endpoint_group, self.endpoint)
+
+    @property
+    def probe_identity(self):
+        """
+        Specs with the same identity make the same request and can share one probe
+        """
+        threshold = None if self.threshold is None else self.threshold.get_identity()
+        return (self.url, self.expected, threshold, self.fresh_connection, self.interval)
+
+    def create_endpoint(self, get_trace_id):
+        """
+        Create the (mutable) Endpoint model for one probe of this spec
+        """
+        endpoint_url = self.url
+
+        if self.trace_argument_key is not None:
+            endpoint_url = create_or_append_query_string(
+                original=endpoint_url,
+                argument="{}={}".format(self.trace_argument_key, get_trace_id())
+            )
+
+        if self.attempt_argument_key is not None:
+            endpoint_url = create_or_append_query_string(
+                original=endpoint_url,
+                argument="{}=##CUPCAKE_ATTEMPT##".format(self.attempt_argument_key)
+            )
+
+        return Endpoint(
+            environment_group=self.environment_group,
+            environment=self.environment,
+            endpoint_group=self.endpoint_group,
+            endpoint=self.endpoint,
+            url=endpoint_url,
+            fresh_connection=self.fresh_connection,
+            certificate_expiry_days=self.certificate_expiry_days
+        )
+
+
+class ProbePlan:
+    """
+    A flat list of the enabled endpoints in a set of endpoint definitions.
+
+    The specs are also arranged into groups that are probed together: each
+    spec is a group of its own unless identical specs are being deduplicated,
+    in which case every group holds all the listings of one probe.
+    """
+
+    def __init__(self, specs, deduplicate=False):
+        self.specs = tuple(specs)
+
+        if deduplicate:
+            groups = {}
+            for spec in self.specs:
+                groups.setdefault(spec.probe_identity, []).append(spec)
+            self.groups = tuple(tuple(group) for group in groups.values())
+        else:
+            self.groups = tuple((spec,) for spec in self.specs)
+
+    def __len__(self):
+        return len(self.specs)
+
+
+def compile_plan(endpoint_definitions, alert_definitions, deduplicate=False):
+    logger.debug("compile_plan")
+
+    specs = []
+
+    default_alert_groups = tuple(get_alerts_in_group("default", alert_definitions))
+
+    for group in endpoint_definitions["groups"]:
+        for environment in group["environments"]:
+            for endpoint_group in environment["endpoint-groups"]:
+                if endpoint_group["enabled"] == "true":
+                    for endpoint in endpoint_group["endpoints"]:
+                        chain = (group, environment, endpoint_group, endpoint)
+
+                        spec = EndpointSpec(
+                            environment_group=group["id"],
+                            environment=environment["id"],
+                            endpoint_group=endpoint_group["id"],
+                            endpoint=endpoint["id"],
+                            url=endpoint["url"],
+                            trace_argument_key=get_argument_key(endpoint, "appendTraceID", "traceArgumentKey", "cupcake_trace_id"),
+                            attempt_argument_key=get_argument_key(endpoint, "appendAttempt", "attemptArgumentKey", "cupcake_attempt"),
+                            fresh_connection=bool(endpoint.get("freshConnection", False)),
+                            certificate_expiry_days=resolve_property(chain, "certificateExpiryDays", None),
+                            interval=resolve_property(chain, "interval", None),
+                            bulkhead=resolve_property(chain, "bulkhead", group["id"]),
+                            expected=endpoint.get("expected", ""),
+                            threshold=Threshold(endpoint["threshold"]) if "threshold" in endpoint else None,
+                            metrics_groups=tuple(resolve_property(chain, "metrics-groups", ["default"])),
+                            alert_groups=tuple(resolve_property(chain, "alert-groups", default_alert_groups))
+                        )
+
+                        specs.append(spec)
+
+    plan = ProbePlan(specs, deduplicate)
+
+    logger.info("compiled probe plan with {} endpoints ({} distinct probes)".format(len(plan.specs), len(plan.groups)))
+
+    return plan
+
+
+def get_argument_key(endpoint, flag, key_property, default_key):
+    if flag in endpoint and endpoint[flag]:
+        # use custom key if provided
+        return endpoint.get(key_property, default_key)
+
+    return None
+
+
+def resolve_property(chain, property, default_value):
+    result = default_value
+
+    for node in chain:
+        if property in node:
+            result = node[property]
+
+    return result
+
+
+def create_or_append_query_string(original, argument):
+    if "?" in original:
+        return "{}&{}".format(original, argument)
+    # else...
+    return "{}?{}".format(original, argument)
@@ -0,0 +1,142 @@
+from logzero import logger
+import socket
+import threading
+import time
+
+from connection_pool import ConnectionPool, create_connection
+from models import ProbeOutcome
+from timing import PhaseTimer, create_socket, FIRST_BYTE
+from tls import TLSConnection
+import settings
+
+
+def get_request_path(parse_result):
+    return "{}{}".format(parse_result.path, "?{}".format(parse_result.query) if len(parse_result.query) > 0 else "")
+
+
+_connection_pool = None
+_connection_pool_lock = threading.Lock()
+
+
+def get_connection_pool():
+    global _connection_pool
+
+    with _connection_pool_lock:
+        if _connection_pool is None:
+            _connection_pool = ConnectionPool(
+                max_idle_per_host=settings.HTTP_POOL_MAX_IDLE_PER_HOST,
+                idle_timeout=settings.HTTP_POOL_IDLE_TIMEOUT_SECONDS,
+                timeout=settings.CONNECTION_TIMEOUT
+            )
+        return _connection_pool
+
+
+def close_connections():
+    with _connection_pool_lock:
+        if _connection_pool is not None:
+            _connection_pool.close_all()
+
+
+def probe(parse_result, fresh_connection=False):
+    if parse_result.scheme == "http" or parse_result.scheme == "https":
+        return probe_http(parse_result, fresh_connection)
+    elif parse_result.scheme == "tcp":
+        return probe_tcp(parse_result)
+
+    return None
+
+
+def send_request(conn, parse_result, timer):
+    conn.timer = timer
+    if conn.sock is None:
+        conn.connect()
+
+    request_path = get_request_path(parse_result)
+    logger.debug("request path: {}".format(request_path))
+
+    started = time.perf_counter()
+    conn.request("GET", request_path)
+    http_response = conn.getresponse()
+    timer.record(FIRST_BYTE, started)
+    return http_response
+
+
+def probe_http(parse_result, fresh_connection=False):
+    pool = None
+    if settings.HTTP_KEEP_ALIVE:
+        pool = get_connection_pool()
+
+    timer = PhaseTimer()
+    conn = None
+
+    try:
+        reused = False
+        if pool is not None:
+            conn, reused = pool.acquire(parse_result, fresh=fresh_connection)
+        else:
+            conn = create_connection(parse_result, settings.CONNECTION_TIMEOUT)
+
+        try:
+            http_response = send_request(conn, parse_result, timer)
+        except ConnectionError:
+            if not reused:
+                raise
+            # the server closed an idle keep-alive connection; measure a fresh one instead
+            logger.debug("reused connection to {} was closed, reconnecting".format(parse_result.netloc))
+            conn.close()
+            conn = create_connection(parse_result, settings.CONNECTION_TIMEOUT)
+            timer = PhaseTimer()
+            http_response = send_request(conn, parse_result, timer)
+
+        phases = timer.finish()
+
+        certificate_expiry = None
+        if isinstance(conn, TLSConnection):
+            conn.save_session()
+            certificate_expiry = conn.certificate_expiry
+
+        body = None
+        if pool is not None or settings.SHOW_BODY_IN_DEBUG_ON_UNEXPECTED_STATUS:
+            # the response has to be read in full before the connection can be reused
+            body = http_response.read()
+
+        if pool is not None and not http_response.will_close:
+            pool.release(parse_result, conn)
+            conn = None
+
+        return ProbeOutcome(
+            kind=ProbeOutcome.RESPONSE,
+            phases=phases,
+            status=str(http_response.status),
+            body=body if settings.SHOW_BODY_IN_DEBUG_ON_UNEXPECTED_STATUS else None,
+            certificate_expiry=certificate_expiry
+        )
+
+    except socket.timeout as e:
+        return ProbeOutcome(kind=ProbeOutcome.TIMEOUT, phases=timer.finish(), error=e)
+
+    except Exception as e:
+        return ProbeOutcome(kind=ProbeOutcome.ERROR, phases=timer.finish(), error=e)
+
+    finally:
+        if conn:
+            conn.close()
+
+
+def probe_tcp(parse_result):
+    timer = PhaseTimer()
+    s = None
+
+    try:
+        s = create_socket((parse_result.hostname, parse_result.port), settings.CONNECTION_TIMEOUT, timer=timer)
+        return ProbeOutcome(kind=ProbeOutcome.CONNECTED, phases=timer.finish())
+
+    except socket.timeout as e:
+        return ProbeOutcome(kind=ProbeOutcome.TIMEOUT, phases=timer.finish(), error=e)
+
+    except Exception as e:
+        return ProbeOutcome(kind=ProbeOutcome.ERROR, phases=timer.finish(), error=e)
+
+    finally:
+        if s:
+            s.close()
@@ -0,0 +1,225 @@
+from logzero import logger
+from collections import Counter
+import contextlib
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+
+import telemetry
+
+# seconds between samples of the sampling profiler
+SAMPLE_INTERVAL = 0.01
+
+# (file, function) of the innermost frame of a thread with nothing to do
+IDLE_FRAMES = {
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("thread.py", "_worker"),
+    ("selectors.py", "select"),
+    ("socketserver.py", "serve_forever")
+}
+
+# files whose frames sit at the bottom of every thread's stack
+THREAD_FILES = {"threading.py", "thread.py"}
+
+_sink = None
+
+
+def start_spans(sink, path=None):
+    global _sink
+    if sink == "log":
+        _sink = LogSpanSink()
+    elif sink == "jsonl":
+        _sink = JsonLinesSpanSink(path)
+    elif sink == "telemetry":
+        _sink = TelemetrySpanSink()
+    else:
+        raise ValueError("unknown span sink: {}".format(sink))
+    logger.info("profiling: recording spans to {}".format(sink))
+
+
+def stop_spans():
+    global _sink
+    if _sink is not None:
+        _sink.close()
+        _sink = None
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """
+    Time the enclosed block and record it to the span sink, if one is started
+    """
+    sink = _sink
+    if sink is None:
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        sink.record(name, time.perf_counter() - started, attributes)
+
+
+class LogSpanSink:
+
+    def record(self, name, seconds, attributes):
+        logger.info("span: {} took {:.1f}ms{}".format(
+            name, seconds * 1000.0, "".join([" {}={}".format(key, value) for key, value in attributes.items()])))
+
+    def close(self):
+        pass
+
+
+class JsonLinesSpanSink:
+    """
+    Append one JSON object per span to a file
+    """
+
+    def __init__(self, path):
+        self._file = open(path, "a", buffering=1)
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds, attributes):
+        line = json.dumps(dict(attributes, timestamp=time.time(), span=name, seconds=seconds, thread=threading.current_thread().name))
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class TelemetrySpanSink:
+
+    def record(self, name, seconds, attributes):
+        telemetry.SPAN_DURATION.observe(seconds, span=name)
+
+    def close(self):
+        pass
+
+
+def create_profiler(mode, top):
+    if mode == "cprofile":
+        return CProfileProfiler(top)
+    if mode == "sampling":
+        return SamplingProfiler(SAMPLE_INTERVAL, top)
+    raise ValueError("unknown profiler: {}".format(mode))
+
+
+class CProfileProfiler:
+    """
+    Profile the thread running the cycle with cProfile
+    """
+
+    def __init__(self, top):
+        self.top = top
+        self._profile = None
+
+    def start(self):
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def stop(self):
+        self._profile.disable()
+
+    def report(self):
+        output = io.StringIO()
+        pstats.Stats(self._profile, stream=output).sort_stats("cumulative").print_stats(self.top)
+        return output.getvalue()
+
+    def save(self, path):
+        self._profile.dump_stats(path + ".prof")
+
+
+class SamplingProfiler:
+    """
+    Sample the stacks of every thread at a fixed interval.
+
+    Threads that are idle (waiting for work, on an event or in select) are
+    not counted, so the report shows where busy threads spent their time,
+    including time blocked on the network.
+    """
+
+    def __init__(self, interval, top):
+        self.interval = interval
+        self.top = top
+        self._samples = 0
+        self._own = Counter()
+        self._cumulative = Counter()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._samples = 0
+        self._own.clear()
+        self._cumulative.clear()
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+
+    def _run(self):
+        ident = threading.get_ident()
+        while not self._stopping.wait(self.interval):
+            for thread_ident, frame in sys._current_frames().items():
+                if thread_ident != ident and not is_idle(frame):
+                    self.sample(frame)
+
+    def sample(self, frame):
+        self._samples = self._samples + 1
+        self._own[get_location(frame)] += 1
+
+        seen = set()
+        while frame is not None:
+            location = get_location(frame)
+            if location not in seen:
+                seen.add(location)
+                self._cumulative[location] += 1
+            frame = frame.f_back
+
+    def report(self):
+        if self._samples == 0:
+            return "no busy samples\n"
+
+        lines = ["{} samples of busy threads every {}ms".format(self._samples, int(self.interval * 1000))]
+
+        lines.append("by own time:")
+        lines.extend(self.format_locations(self._own.most_common(self.top)))
+
+        lines.append("by total time:")
+        lines.extend(self.format_locations([
+            (location, count) for location, count in self._cumulative.most_common()
+            if os.path.basename(location[0]) not in THREAD_FILES
+        ][:self.top]))
+
+        return "\n".join(lines) + "\n"
+
+    def format_locations(self, counts):
+        return [
+            "{:>7.1%} total {:>7.1%} own  {} ({}:{})".format(
+                self._cumulative[location] / self._samples, self._own[location] / self._samples, location[2], location[0], location[1])
+            for location, _ in counts
+        ]
+
+    def save(self, path):
+        with open(path + ".txt", "w") as f:
+            f.write(self.report())
+
+
+def get_location(frame):
+    code = frame.f_code
+    return (code.co_filename, code.co_firstlineno, code.co_name)
+
+
+def is_idle(frame):
+    return (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in IDLE_FRAMES
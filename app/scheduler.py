@@ -0,0 +1,178 @@
+from logzero import logger
+import heapq
+import threading
+import zlib
+
+import telemetry
+
+
+class ScheduleEntry:
+    """
+    Hold the scheduling state of one group of endpoints that are probed together
+    """
+
+    def __init__(self, group, interval, due):
+        self.group = group
+        self.interval = interval
+        self.due = due
+        self.running = False
+        self.overruns = 0
+
+
+class ProbeScheduler:
+    """
+    Decide when each endpoint in a probe plan is next due to be probed.
+
+    Due times are kept in a heap so that finding the next due endpoint does
+    not depend on the size of the plan. Each endpoint is probed every
+    interval seconds at a fixed phase derived from its key, which spreads
+    start times across the interval and keeps them stable across restarts.
+    An endpoint that is still being probed when it is next due overruns: the
+    run is skipped and counted rather than started twice.
+    """
+
+    def __init__(self, default_interval):
+        self.default_interval = default_interval
+        self._entries = {}
+        self._heap = []
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def update(self, plan, now):
+        """
+        Schedule the endpoint groups in a probe plan, keeping the phase of groups already scheduled.
+
+        A group is keyed by the key of its first endpoint.
+        """
+        with self._lock:
+            entries = {}
+            for group in plan.groups:
+                key = group[0].key
+                interval = group[0].interval or self.default_interval
+                entry = self._entries.get(key)
+
+                if entry is None or entry.interval != interval:
+                    due = get_first_due(key, interval, now)
+                    if entry is None:
+                        entry = ScheduleEntry(group, interval, due)
+                    else:
+                        entry.interval = interval
+                        entry.due = due
+                    self._push(entry, key)
+
+                entry.group = group
+                entries[key] = entry
+
+            self._entries = entries
+
+        logger.debug("scheduler: {} endpoints scheduled".format(len(entries)))
+
+    def pop_due(self, now):
+        """
+        Return the endpoint groups due at or before now, and schedule their next run
+        """
+        due = []
+
+        with self._lock:
+            while len(self._heap) > 0 and self._heap[0][0] <= now:
+                due_time, _, key = heapq.heappop(self._heap)
+                entry = self._entries.get(key)
+                if entry is None or entry.due != due_time:
+                    # removed from the plan, or rescheduled since this was pushed
+                    continue
+
+                if entry.running:
+                    entry.overruns = entry.overruns + 1
+                    telemetry.SCHEDULE_OVERRUNS.inc()
+                    logger.warning("scheduler: {} still running after {}s, skipping this run ({} overruns)".format(
+                        repr(key), entry.interval, entry.overruns))
+                else:
+                    entry.running = True
+                    due.append(entry.group)
+
+                entry.due = get_next_due(entry.due, entry.interval, now)
+                self._push(entry, key)
+
+        return due
+
+    def complete(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.running = False
+
+    def next_due(self):
+        with self._lock:
+            if len(self._heap) == 0:
+                return None
+            return self._heap[0][0]
+
+    def _push(self, entry, key):
+        self._sequence = self._sequence + 1
+        heapq.heappush(self._heap, (entry.due, self._sequence, key))
+
+
+def get_phase(key, interval):
+    """
+    Return a fixed offset within the interval for an endpoint key
+    """
+    return (zlib.crc32(repr(key).encode("utf-8")) / 2 ** 32) * interval
+
+
+def get_first_due(key, interval, now):
+    due = now - (now % interval) + get_phase(key, interval)
+    if due < now:
+        due = due + interval
+    return due
+
+
+def get_next_due(due, interval, now):
+    """
+    Return the next due time after due, skipping any runs that were missed entirely
+    """
+    due = due + interval
+    if due <= now:
+        missed = int((now - due) // interval) + 1
+        due = due + missed * interval
+    return due
+
+
+class RetryQueue:
+    """
+    Hold probe attempts that have been deferred until a backoff has passed
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._heap)
+
+    def defer(self, probe, due):
+        with self._lock:
+            self._sequence = self._sequence + 1
+            heapq.heappush(self._heap, (due, self._sequence, probe))
+
+        telemetry.PROBES_QUEUED.inc()
+
+    def pop_due(self, now):
+        due = []
+
+        with self._lock:
+            while len(self._heap) > 0 and self._heap[0][0] <= now:
+                due.append(heapq.heappop(self._heap)[2])
+
+        telemetry.PROBES_QUEUED.dec(len(due))
+        return due
+
+    def next_due(self):
+        with self._lock:
+            if len(self._heap) == 0:
+                return None
+            return self._heap[0][0]
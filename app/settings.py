@@ -4,6 +4,8 @@ import re
 import distutils.util
 from database.sqlite_database import SqliteDatabase
 from database.postgresql_database import PostgreSqlDatabase
+from database.cached_database import CachedDatabase
+from database.instrumented_database import InstrumentedDatabase
 
 DEBUG = bool(distutils.util.strtobool(os.getenv("DEBUG", "False")))
 SLEEP_SECONDS = int(os.getenv("SLEEP_SECONDS"))
@@ -16,12 +18,85 @@ SUMMARY_SLEEP_SECONDS = int(os.getenv("SUMMARY_SLEEP_SECONDS"))
 METRICS_DEFINITIONS_FILE = os.getenv("METRICS_DEFINITIONS_FILE")
 MAX_WORKERS = int(os.getenv("MAX_WORKERS", default="2"))
 SHOW_BODY_IN_DEBUG_ON_UNEXPECTED_STATUS = bool(distutils.util.strtobool(os.getenv("SHOW_BODY_IN_DEBUG_ON_UNEXPECTED_STATUS", "False")))
+PROBE_ENGINE = os.getenv("PROBE_ENGINE", "thread")
+SCHEDULING = os.getenv("SCHEDULING", "cycle")
+PROBE_AUTOTUNE = bool(distutils.util.strtobool(os.getenv("PROBE_AUTOTUNE", "False")))
+PROBE_MIN_WORKERS = int(os.getenv("PROBE_MIN_WORKERS", default="1"))
+PROBE_MAX_WORKERS = int(os.getenv("PROBE_MAX_WORKERS", default="64"))
+PROBE_DEDUPLICATION = bool(distutils.util.strtobool(os.getenv("PROBE_DEDUPLICATION", "False")))
+PROBE_PHASE_METRICS = bool(distutils.util.strtobool(os.getenv("PROBE_PHASE_METRICS", "False")))
+PROBE_BULKHEADS = bool(distutils.util.strtobool(os.getenv("PROBE_BULKHEADS", "False")))
+PROBE_BULKHEAD_MIN_SHARE = float(os.getenv("PROBE_BULKHEAD_MIN_SHARE", default="0.5"))
+PROBE_HOST_CONCURRENCY = int(os.getenv("PROBE_HOST_CONCURRENCY", default="0"))
+PROBE_GROUP_CONCURRENCY = int(os.getenv("PROBE_GROUP_CONCURRENCY", default="0"))
+PROBE_HOST_RATE = float(os.getenv("PROBE_HOST_RATE", default="0"))
+PROBE_HOST_BURST = int(os.getenv("PROBE_HOST_BURST", default="1"))
+RETRY_ATTEMPTS = int(os.getenv("RETRY_ATTEMPTS", default="3"))
+RETRY_BACKOFF_SECONDS = float(os.getenv("RETRY_BACKOFF_SECONDS", default="0"))
+RETRY_MAX_BACKOFF_SECONDS = float(os.getenv("RETRY_MAX_BACKOFF_SECONDS", default="30"))
+PROBE_CONCURRENCY = int(os.getenv("PROBE_CONCURRENCY", default="500"))
+HTTP_KEEP_ALIVE = bool(distutils.util.strtobool(os.getenv("HTTP_KEEP_ALIVE", "False")))
+HTTP_POOL_MAX_IDLE_PER_HOST = int(os.getenv("HTTP_POOL_MAX_IDLE_PER_HOST", default="4"))
+HTTP_POOL_IDLE_TIMEOUT_SECONDS = int(os.getenv("HTTP_POOL_IDLE_TIMEOUT_SECONDS", default="30"))
+TLS_CA_PATH = os.getenv("TLS_CA_PATH", "")
+TLS_VERIFY = bool(distutils.util.strtobool(os.getenv("TLS_VERIFY", "True")))
+TLS_MINIMUM_VERSION = os.getenv("TLS_MINIMUM_VERSION", "")
+METRICS_BATCHING = bool(distutils.util.strtobool(os.getenv("METRICS_BATCHING", "False")))
+METRICS_BATCH_SIZE = int(os.getenv("METRICS_BATCH_SIZE", default="1000"))
+METRICS_FLUSH_SECONDS = int(os.getenv("METRICS_FLUSH_SECONDS", default="10"))
+METRICS_MAX_QUEUED = int(os.getenv("METRICS_MAX_QUEUED", default="100000"))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", default=str(MAX_WORKERS + 1)))
+ALERT_WORKERS = int(os.getenv("ALERT_WORKERS", default="0"))
+ALERT_MAX_QUEUED = int(os.getenv("ALERT_MAX_QUEUED", default="1000"))
+ALERT_TIMEOUT_SECONDS = int(os.getenv("ALERT_TIMEOUT_SECONDS", default="10"))
+ALERT_DRAIN_SECONDS = int(os.getenv("ALERT_DRAIN_SECONDS", default="20"))
+ALERT_COALESCING = bool(distutils.util.strtobool(os.getenv("ALERT_COALESCING", "False")))
+ALERT_COALESCING_SECONDS = int(os.getenv("ALERT_COALESCING_SECONDS", default="0"))
+DB_CACHE = bool(distutils.util.strtobool(os.getenv("DB_CACHE", "False")))
+DB_RECONCILIATION = bool(distutils.util.strtobool(os.getenv("DB_RECONCILIATION", "False")))
+METRICS_AGGREGATION = bool(distutils.util.strtobool(os.getenv("METRICS_AGGREGATION", "False")))
+METRICS_AGGREGATION_SECONDS = int(os.getenv("METRICS_AGGREGATION_SECONDS", default="60"))
+METRICS_AGGREGATION_BUCKETS = [int(bucket) for bucket in os.getenv("METRICS_AGGREGATION_BUCKETS", "").split(",") if bucket.strip()]
+ALERT_OUTBOX = bool(distutils.util.strtobool(os.getenv("ALERT_OUTBOX", "False")))
+OUTBOX_POLL_SECONDS = int(os.getenv("OUTBOX_POLL_SECONDS", default="5"))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", default="100"))
+OUTBOX_BACKOFF_SECONDS = int(os.getenv("OUTBOX_BACKOFF_SECONDS", default="10"))
+OUTBOX_MAX_BACKOFF_SECONDS = int(os.getenv("OUTBOX_MAX_BACKOFF_SECONDS", default="600"))
+OUTBOX_RETENTION_SECONDS = int(os.getenv("OUTBOX_RETENTION_SECONDS", default="86400"))
+TELEMETRY_PORT = int(os.getenv("TELEMETRY_PORT", default="0"))
+TELEMETRY_ADDRESS = os.getenv("TELEMETRY_ADDRESS", "0.0.0.0")
+SPAN_SINK = os.getenv("SPAN_SINK", "")
+SPAN_FILE = os.getenv("SPAN_FILE", "cupcake-spans.jsonl")
+PROFILE_SLOW_CYCLE_SECONDS = float(os.getenv("PROFILE_SLOW_CYCLE_SECONDS", default="0"))
+PROFILE_MODE = os.getenv("PROFILE_MODE", "sampling")
+PROFILE_TOP = int(os.getenv("PROFILE_TOP", default="20"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "")
+SNS_ENDPOINT_URL = os.getenv("SNS_ENDPOINT_URL", "")
+CLOUDWATCH_ENDPOINT_URL = os.getenv("CLOUDWATCH_ENDPOINT_URL", "")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL", "")
+WEBHOOK_HOST_OVERRIDE = os.getenv("WEBHOOK_HOST_OVERRIDE", "")
 
 def get_database():
+  db = None
   if DB_TYPE == "postgresql":
-    return get_database_postgresql()
+    db = get_database_postgresql()
   else:
-    return get_database_sqlite()
+    db = get_database_sqlite()
+
+  if DB_CACHE:
+    db = get_database_cached(db)
+
+  if TELEMETRY_PORT > 0:
+    return InstrumentedDatabase(db)
+
+  return db
+
+
+def get_database_cached(db):
+  cached_db = CachedDatabase(db)
+  cached_db.initialise({})
+
+  return cached_db
 
 
 def get_database_postgresql():
@@ -30,7 +105,8 @@ def get_database_postgresql():
     "dbname": os.getenv("DB_NAME"),
     "user": os.getenv("DB_USER"),
     "host": os.getenv("DB_HOST"),
-    "password": os.getenv("DB_PASSWORD")
+    "password": os.getenv("DB_PASSWORD"),
+    "pool_size": DB_POOL_SIZE
   })
 
   return db
@@ -0,0 +1,235 @@
+from logzero import logger
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import bisect
+import contextlib
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CYCLE_BUCKETS = (0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_registry = []
+_server = None
+
+
+class Instrument:
+    """
+    A named family of series, one per combination of label values
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._series = {}
+        self._lock = threading.Lock()
+        if len(self.labels) == 0:
+            # a series without labels is reported from the start
+            self._series[()] = self.create_series()
+        _registry.append(self)
+
+    def create_series(self):
+        return 0
+
+    def get_label_values(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} {}".format(self.name, self.kind)
+        ]
+
+        with self._lock:
+            series = sorted(self._series.items())
+            lines.extend(self.render_series(series))
+
+        return lines
+
+    def render_series(self, series):
+        return [
+            "{}{} {}".format(self.name, format_labels(self.labels, label_values), format_value(value))
+            for label_values, value in series
+        ]
+
+
+class Counter(Instrument):
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.get_label_values(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+
+class Gauge(Instrument):
+
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self.get_label_values(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self.get_label_values(labels)
+        with self._lock:
+            self._series[key] = value
+
+
+class Histogram(Instrument):
+    """
+    Count observations into fixed buckets, keeping a running sum and count per series
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labels)
+
+    def create_series(self):
+        # one count per bucket plus +Inf, then the sum
+        return [0] * (len(self.buckets) + 1) + [0.0]
+
+    def observe(self, value, **labels):
+        key = self.get_label_values(labels)
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self.create_series()
+                self._series[key] = series
+            series[index] = series[index] + 1
+            series[-1] = series[-1] + value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render_series(self, series):
+        lines = []
+        for label_values, counts in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative = cumulative + count
+                lines.append("{}_bucket{} {}".format(
+                    self.name,
+                    format_labels(self.labels + ("le",), label_values + (format_value(bound),)),
+                    cumulative
+                ))
+
+            label_text = format_labels(self.labels, label_values)
+            lines.append("{}_sum{} {}".format(self.name, label_text, format_value(counts[-1])))
+            lines.append("{}_count{} {}".format(self.name, label_text, cumulative))
+        return lines
+
+
+def format_labels(labels, label_values):
+    if len(labels) == 0:
+        return ""
+
+    return "{{{}}}".format(",".join([
+        '{}="{}"'.format(label, value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+        for label, value in zip(labels, label_values)
+    ]))
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    lines = []
+    for instrument in _registry:
+        lines.extend(instrument.render())
+    return "\n".join(lines) + "\n"
+
+
+PROBE_DURATION = Histogram(
+    "cupcake_probe_duration_seconds", "Duration of probe attempts", ["scheme", "result"])
+PROBES_QUEUED = Gauge(
+    "cupcake_probes_queued", "Probe attempts waiting to start")
+PROBES_IN_FLIGHT = Gauge(
+    "cupcake_probes_in_flight", "Probe attempts in progress")
+CYCLE_DURATION = Histogram(
+    "cupcake_cycle_duration_seconds", "Duration of probe cycles", buckets=CYCLE_BUCKETS)
+CYCLE_OVERRUNS = Counter(
+    "cupcake_cycle_overruns_total", "Probe cycles that took longer than SLEEP_SECONDS")
+SCHEDULE_OVERRUNS = Counter(
+    "cupcake_schedule_overruns_total", "Scheduled probe runs skipped because the previous run had not finished")
+TLS_HANDSHAKES = Counter(
+    "cupcake_tls_handshakes_total", "TLS handshakes made by the thread engine, by whether a session was resumed", ["resumed"])
+CONFIG_LOAD_DURATION = Histogram(
+    "cupcake_config_load_duration_seconds", "Duration of loading the definition files")
+DATABASE_DURATION = Histogram(
+    "cupcake_database_duration_seconds", "Duration of database calls", ["method"])
+DATABASE_ERRORS = Counter(
+    "cupcake_database_errors_total", "Database calls that failed", ["method"])
+ALERT_DELIVERY_DURATION = Histogram(
+    "cupcake_alert_delivery_duration_seconds", "Duration of alert deliveries", ["type"])
+ALERT_DELIVERY_ERRORS = Counter(
+    "cupcake_alert_delivery_errors_total", "Alert deliveries that failed", ["type"])
+METRIC_DELIVERY_DURATION = Histogram(
+    "cupcake_metric_delivery_duration_seconds", "Duration of metric deliveries", ["provider"])
+METRIC_DELIVERY_ERRORS = Counter(
+    "cupcake_metric_delivery_errors_total", "Metric deliveries that failed", ["provider"])
+SPAN_DURATION = Histogram(
+    "cupcake_span_duration_seconds", "Duration of instrumented spans, with SPAN_SINK set to telemetry", ["span"])
+
+
+class TelemetryServer(ThreadingMixIn, HTTPServer):
+    """
+    Serve each scrape on its own thread; http.server.ThreadingHTTPServer needs Python 3.7
+    """
+
+    daemon_threads = True
+
+
+class TelemetryHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("telemetry: {} {}".format(self.address_string(), format % args))
+
+
+def start_server(address, port):
+    global _server
+    _server = TelemetryServer((address, port), TelemetryHandler)
+    threading.Thread(target=_server.serve_forever, name="telemetry", daemon=True).start()
+    logger.info("telemetry: serving /metrics on {}:{}".format(address, port))
+
+
+def stop_server():
+    global _server
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
@@ -0,0 +1,89 @@
+import socket
+import time
+
+DNS = "DNS-TIME"
+CONNECT = "CONNECT-TIME"
+TLS = "TLS-TIME"
+FIRST_BYTE = "FIRST-BYTE-TIME"
+TOTAL = "RESPONSE-TIME"
+
+PHASES = [DNS, CONNECT, TLS, FIRST_BYTE, TOTAL]
+
+
+class PhaseTimer:
+    """
+    Time the phases of a probe attempt with a monotonic clock.
+
+    Each phase is recorded as its own duration. The total runs from the
+    creation of the timer until finish() is called. A phase that did not
+    happen, such as DNS on a reused connection, is not recorded at all.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+
+    def record(self, phase, started):
+        self.phases[phase] = time.perf_counter() - started
+
+    def finish(self):
+        """
+        Record the total if it has not been recorded yet, and return the phase durations in seconds
+        """
+        if TOTAL not in self.phases:
+            self.record(TOTAL, self.started)
+        return self.phases
+
+
+def get_milliseconds(phases):
+    return {phase: int(round(seconds * 1000.0)) for phase, seconds in phases.items()}
+
+
+def create_socket(address, timeout, source_address=None, timer=None):
+    """
+    Connect a socket like socket.create_connection(), recording the DNS and connect phases on the timer
+    """
+    host, port = address
+
+    started = time.perf_counter()
+    addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    if timer is not None:
+        timer.record(DNS, started)
+
+    error = None
+    started = time.perf_counter()
+    for family, socket_type, proto, _, socket_address in addresses:
+        sock = None
+        try:
+            sock = socket.socket(family, socket_type, proto)
+            if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(socket_address)
+            if timer is not None:
+                timer.record(CONNECT, started)
+            return sock
+
+        except OSError as e:
+            error = e
+            if sock is not None:
+                sock.close()
+
+    if error is not None:
+        raise error
+    raise OSError("getaddrinfo returned an empty list")
+
+
+class TimedConnection:
+    """
+    Mixin for http.client connections that records the DNS and connect phases on self.timer
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timer = None
+        self._create_connection = self._create_timed_connection
+
+    def _create_timed_connection(self, address, timeout, source_address=None):
+        return create_socket(address, timeout, source_address, self.timer)
@@ -0,0 +1,183 @@
+from logzero import logger
+import calendar
+import http.client
+import os
+import ssl
+import threading
+import time
+
+from timing import TimedConnection, TLS
+import settings
+import telemetry
+
+_ssl_context = None
+_ssl_context_lock = threading.Lock()
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+# fallback for Python versions without SSLContext.minimum_version
+LEGACY_PROTOCOL_OPTIONS = {
+    "TLSv1_1": ssl.OP_NO_SSLv3 | ssl.OP_NO_TLSv1,
+    "TLSv1_2": ssl.OP_NO_SSLv3 | ssl.OP_NO_TLSv1 | ssl.OP_NO_TLSv1_1
+}
+
+
+def get_ssl_context():
+    """
+    Return the SSLContext shared by every HTTPS probe, building it on first use
+    """
+    global _ssl_context
+
+    with _ssl_context_lock:
+        if _ssl_context is None:
+            _ssl_context = create_ssl_context(
+                ca_path=settings.TLS_CA_PATH,
+                verify=settings.TLS_VERIFY,
+                minimum_version=settings.TLS_MINIMUM_VERSION
+            )
+        return _ssl_context
+
+
+def create_ssl_context(ca_path, verify, minimum_version):
+    logger.info("tls: creating ssl context (verify: {}, minimum version: {})".format(verify, minimum_version or "default"))
+
+    context = None
+    if ca_path and os.path.isdir(ca_path):
+        context = ssl.create_default_context(capath=ca_path)
+    elif ca_path:
+        context = ssl.create_default_context(cafile=ca_path)
+    else:
+        context = ssl.create_default_context()
+
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+
+    if minimum_version:
+        if hasattr(ssl, "TLSVersion"):
+            context.minimum_version = ssl.TLSVersion[minimum_version]
+        else:
+            context.options |= LEGACY_PROTOCOL_OPTIONS[minimum_version]
+
+    return context
+
+
+def get_session(host, port):
+    with _sessions_lock:
+        return _sessions.get((host, port))
+
+
+def save_session(host, port, session):
+    if session is None:
+        return
+
+    with _sessions_lock:
+        _sessions[(host, port)] = session
+
+
+# DER tags of the two ASN.1 time types used for certificate validity
+UTC_TIME = 0x17
+GENERALIZED_TIME = 0x18
+# tag of the explicit version field at the start of a TBSCertificate
+CERTIFICATE_VERSION = 0xa0
+
+
+def get_certificate_expiry(certificate):
+    """
+    Return the notAfter time of a DER encoded peer certificate in seconds since the epoch, if known.
+
+    The binary certificate is read because getpeercert() only decodes it when
+    it has been verified, and expiry is wanted with TLS_VERIFY off too.
+    """
+    if not certificate:
+        return None
+
+    try:
+        # Certificate ::= SEQUENCE { tbsCertificate SEQUENCE { [0] version, serialNumber, signature, issuer, validity, ... } ... }
+        _, start, _ = read_der(certificate, 0)
+        _, offset, _ = read_der(certificate, start)
+
+        tag, _, end = read_der(certificate, offset)
+        if tag == CERTIFICATE_VERSION:
+            offset = end
+        for _ in range(3):
+            offset = read_der(certificate, offset)[2]
+
+        # Validity ::= SEQUENCE { notBefore Time, notAfter Time }
+        _, validity, _ = read_der(certificate, offset)
+        not_before_end = read_der(certificate, validity)[2]
+        tag, start, end = read_der(certificate, not_before_end)
+        return parse_der_time(tag, certificate[start:end].decode("ascii"))
+    except (IndexError, ValueError) as e:
+        logger.warning("tls: could not read certificate expiry - {}".format(str(e)))
+        return None
+
+
+def read_der(data, offset):
+    """
+    Return the tag of the DER element at offset, and where its contents start and end
+    """
+    tag = data[offset]
+    length = data[offset + 1]
+    offset = offset + 2
+
+    if length & 0x80:
+        count = length & 0x7f
+        length = int.from_bytes(data[offset:offset + count], "big")
+        offset = offset + count
+
+    if offset + length > len(data):
+        raise ValueError("truncated DER element")
+
+    return tag, offset, offset + length
+
+
+def parse_der_time(tag, text):
+    if tag == UTC_TIME:
+        # two digit years from 50 are in the 1900s (RFC 5280)
+        year = int(text[:2])
+        text = str(year + 1900 if year >= 50 else year + 2000) + text[2:]
+    elif tag != GENERALIZED_TIME:
+        raise ValueError("unexpected DER tag {} for a time".format(tag))
+
+    return calendar.timegm(time.strptime(text, "%Y%m%d%H%M%SZ"))
+
+
+class TLSConnection(TimedConnection, http.client.HTTPSConnection):
+    """
+    An HTTPSConnection that uses the shared SSLContext, resumes TLS sessions per host and records certificate expiry and handshake time
+    """
+
+    def __init__(self, host, timeout):
+        super().__init__(host=host, timeout=timeout, context=get_ssl_context())
+        self.certificate_expiry = None
+
+    def connect(self):
+        http.client.HTTPConnection.connect(self)
+
+        server_hostname = self._tunnel_host if self._tunnel_host else self.host
+
+        started = time.perf_counter()
+        self.sock = self._context.wrap_socket(
+            self.sock,
+            server_hostname=server_hostname,
+            session=get_session(self.host, self.port)
+        )
+
+        if self.timer is not None:
+            self.timer.record(TLS, started)
+
+        telemetry.TLS_HANDSHAKES.inc(resumed=str(self.sock.session_reused).lower())
+        self.certificate_expiry = get_certificate_expiry(self.sock.getpeercert(binary_form=True))
+        self.save_session()
+
+    def close(self):
+        self.save_session()
+        super().close()
+
+    def save_session(self):
+        """
+        Remember the session for the next handshake with this host; TLS 1.3 tickets only arrive after the handshake
+        """
+        save_session(self.host, self.port, getattr(self.sock, "session", None))
@@ -0,0 +1,124 @@
+"""
+Store benchmark results as named baselines and compare later runs against them.
+"""
+import json
+import os
+import sys
+import time
+
+DEFAULT_BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+
+# result name, label, whether a higher value is better, and the smallest change that is not noise
+MEASURES = [
+    ("endpoints_per_second", "endpoints/sec", True, 0),
+    ("cycle_p50", "cycle p50 (s)", False, 0.01),
+    ("cycle_p99", "cycle p99 (s)", False, 0.01),
+    ("check_p50", "endpoints_check p50 (s)", False, 0.01),
+    ("load_p50", "load_definitions p50 (s)", False, 0.01),
+    ("peak_rss_mb", "peak RSS (MB)", False, 1),
+    ("peak_threads", "peak threads", False, 0),
+    ("peak_fds", "peak open fds", False, 0)
+]
+
+
+def add_baseline_arguments(parser):
+    parser.add_argument("--save", metavar="NAME", help="store the results as a baseline")
+    parser.add_argument("--compare", metavar="NAME", help="compare the results with a stored baseline, exiting with 1 on a regression")
+    parser.add_argument("--baselines", default=DEFAULT_BASELINES, help="file holding the baselines")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="relative change counted as a regression")
+
+
+def create_run(parameters, settings, results):
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": sys.version.split()[0],
+        "parameters": parameters,
+        "settings": settings,
+        "results": results
+    }
+
+
+def report_run(run, arguments, measures=MEASURES):
+    """
+    Print a run, compare it with and save it as baselines as asked, and exit with 1 if it regressed
+    """
+    print("\n".join(format_results(run["results"], measures)))
+    print(json.dumps(run, sort_keys=True))
+
+    regressed = False
+    if arguments.compare:
+        baseline = load_baselines(arguments.baselines).get(arguments.compare)
+        if baseline is None:
+            print("no baseline named {} in {}".format(arguments.compare, arguments.baselines))
+            sys.exit(2)
+
+        lines, regressed = compare(baseline, run, arguments.tolerance, measures)
+        print("\ncompared with {} ({}):".format(arguments.compare, baseline["timestamp"]))
+        print("\n".join(lines))
+
+    if arguments.save:
+        save_baseline(arguments.baselines, arguments.save, run)
+        print("saved baseline {} to {}".format(arguments.save, arguments.baselines))
+
+    if regressed:
+        sys.exit(1)
+
+
+def load_baselines(path):
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(path, name, run):
+    baselines = load_baselines(path)
+    baselines[name] = run
+
+    with open(path, "w") as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+
+
+def compare(baseline, run, tolerance, measures=MEASURES):
+    """
+    Return report lines comparing a run with a baseline, and whether any measure regressed by more than tolerance
+    """
+    lines = []
+    regressed = False
+
+    for section in ("parameters", "settings"):
+        for key in sorted(set(baseline[section]) | set(run[section])):
+            if baseline[section].get(key) != run[section].get(key):
+                lines.append("note: {} was {} in the baseline, now {}".format(key, baseline[section].get(key), run[section].get(key)))
+
+    for key, label, higher_is_better, noise in measures:
+        before = baseline["results"].get(key)
+        after = run["results"].get(key)
+        if before is None or after is None:
+            continue
+
+        change = 0.0 if before == 0 else (after - before) / before
+        worse = -change if higher_is_better else change
+        flag = ""
+        if abs(after - before) <= noise:
+            pass
+        elif worse > tolerance:
+            flag = "  REGRESSION"
+            regressed = True
+        elif worse < -tolerance:
+            flag = "  improved"
+
+        lines.append("{:<26} {:>12} {:>12} {:>+8.1%}{}".format(label, format_number(before), format_number(after), change, flag))
+
+    return lines, regressed
+
+
+def format_results(results, measures=MEASURES):
+    return ["{:<26} {:>12}".format(label, format_number(results[key])) for key, label, _, _ in measures]
+
+
+def format_number(value):
+    if isinstance(value, float):
+        return "{:.3f}".format(value)
+    return str(value)
@@ -0,0 +1,119 @@
+"""
+Generate endpoint, alert and metrics definition files for benchmarking Cupcake.
+"""
+import json
+import os
+
+# endpoints per endpoint group, and endpoint groups per environment
+GROUP_SIZE = 100
+GROUPS_PER_ENVIRONMENT = 10
+
+
+def get_schemes(count, https_fraction, tcp_fraction):
+    """
+    Spread the schemes evenly through the endpoints, so that every group has a similar mix
+    """
+    schemes = []
+    https = 0.0
+    tcp = 0.0
+    for _ in range(count):
+        https = https + https_fraction
+        tcp = tcp + tcp_fraction
+        if https >= 1:
+            https = https - 1
+            schemes.append("https")
+        elif tcp >= 1:
+            tcp = tcp - 1
+            schemes.append("tcp")
+        else:
+            schemes.append("http")
+    return schemes
+
+
+def create_endpoint(index, scheme, ports):
+    if scheme == "tcp":
+        return {
+            "@type": "endpoint",
+            "id": "endpoint-{}".format(index),
+            "url": "tcp://127.0.0.1:{}".format(ports["tcp"])
+        }
+
+    return {
+        "@type": "endpoint",
+        "id": "endpoint-{}".format(index),
+        "url": "{}://localhost:{}/endpoint/{}".format(scheme, ports[scheme], index),
+        "expected": "^2\\d\\d$"
+    }
+
+
+def create_endpoint_definitions(count, ports, https_fraction=0.0, tcp_fraction=0.0):
+    schemes = get_schemes(count, https_fraction, tcp_fraction)
+
+    endpoint_groups = []
+    for start in range(0, count, GROUP_SIZE):
+        endpoint_groups.append({
+            "@type": "endpoint-group",
+            "id": "group-{}".format(start // GROUP_SIZE),
+            "enabled": "true",
+            "endpoints": [create_endpoint(index, schemes[index], ports) for index in range(start, min(count, start + GROUP_SIZE))]
+        })
+
+    environments = []
+    for start in range(0, len(endpoint_groups), GROUPS_PER_ENVIRONMENT):
+        environments.append({
+            "@type": "environment",
+            "id": "environment-{}".format(start // GROUPS_PER_ENVIRONMENT),
+            "endpoint-groups": endpoint_groups[start:start + GROUPS_PER_ENVIRONMENT]
+        })
+
+    return {
+        "@type": "endpoint-definitions",
+        "groups": [
+            {
+                "@type": "environment-group",
+                "id": "benchmark",
+                "environments": environments
+            }
+        ]
+    }
+
+
+def create_alert_definitions(alerts=()):
+    """
+    Deliver to every given alert from the default group
+    """
+    return {
+        "@type": "alert-definitions",
+        "groups": [
+            {"@type": "alert-group", "id": "default", "alerts": [alert["id"] for alert in alerts]},
+            {"@type": "alert-group", "id": "summary", "alerts": []}
+        ],
+        "alerts": list(alerts)
+    }
+
+
+def create_metrics_definitions(metrics=()):
+    return {
+        "@type": "metrics-definitions",
+        "groups": [
+            {"@type": "metrics-group", "id": "default", "metrics": [metric["id"] for metric in metrics]}
+        ],
+        "metrics": list(metrics)
+    }
+
+
+def write_definitions(directory, endpoint_definitions, alert_definitions, metrics_definitions):
+    """
+    Write the definition files, returning their paths keyed by the environment variable that names them
+    """
+    paths = {
+        "ENDPOINT_DEFINITIONS_FILE": (os.path.join(directory, "endpoints.json"), endpoint_definitions),
+        "ALERT_DEFINITIONS_FILE": (os.path.join(directory, "alerts.json"), alert_definitions),
+        "METRICS_DEFINITIONS_FILE": (os.path.join(directory, "metrics.json"), metrics_definitions)
+    }
+
+    for path, definitions in paths.values():
+        with open(path, "w") as f:
+            json.dump(definitions, f)
+
+    return {name: path for name, (path, _) in paths.items()}
@@ -0,0 +1,332 @@
+"""
+Local fakes of Slack webhooks, SNS, CloudWatch and S3 for benchmarking Cupcake's delivery paths.
+
+Each fake records the calls it receives and can be made slow, throttled or
+failing. Point Cupcake at them with WEBHOOK_HOST_OVERRIDE, SNS_ENDPOINT_URL,
+CLOUDWATCH_ENDPOINT_URL and S3_ENDPOINT_URL. Like the stand-in servers, the
+fakes run in their own process.
+"""
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+import gzip
+import hashlib
+import json
+import multiprocessing
+import random
+import threading
+import time
+import urllib.request
+import uuid
+
+from standins import StandInHTTPServer
+
+# path on every fake that returns, and with POST clears, the calls recorded so far
+CALLS_PATH = "/_fake/calls"
+
+SERVICES = ("slack", "sns", "cloudwatch", "s3")
+
+
+class FaultConfig:
+    """
+    Describe how the fakes misbehave.
+
+    Every call waits latency seconds, then is throttled with a chance of
+    throttle_rate, or else fails with a chance of error_rate.
+    """
+
+    def __init__(self, latency=0.0, throttle_rate=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.seed = seed
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    """
+    Base for the fakes, recording each call with the time it was answered
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def read_body(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        return body
+
+    def get_fault(self):
+        """
+        Wait the configured latency, then return "throttle", "error" or None
+        """
+        faults = self.server.faults
+        if faults.latency > 0:
+            time.sleep(faults.latency)
+
+        with self.server.lock:
+            draw = self.server.random.random()
+        if draw < faults.throttle_rate:
+            return "throttle"
+        if draw < faults.throttle_rate + faults.error_rate:
+            return "error"
+        return None
+
+    def respond(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def record(self, operation, status, fault, items=1, text=""):
+        with self.server.lock:
+            self.server.calls.append({
+                "operation": operation,
+                "status": status,
+                "fault": fault,
+                "items": items,
+                "text": text,
+                "time": time.time()
+            })
+
+    def handle_calls(self):
+        with self.server.lock:
+            body = json.dumps(self.server.calls).encode("utf-8")
+            if self.command == "POST":
+                self.server.calls = []
+        self.respond(200, body, {"Content-Type": "application/json"})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SlackHandler(FakeHandler):
+    """
+    Accept Slack incoming webhook posts, throttling with HTTP 429 as Slack does
+    """
+
+    def do_POST(self):
+        if self.path == CALLS_PATH:
+            self.handle_calls()
+            return
+
+        text = json.loads(self.read_body()).get("text", "")
+        fault = self.get_fault()
+        if fault == "throttle":
+            status = 429
+            self.respond(status, b"rate_limited", {"Retry-After": "1"})
+        elif fault == "error":
+            status = 500
+            self.respond(status, b"internal_error")
+        else:
+            status = 200
+            self.respond(status, b"ok", {"Content-Type": "text/plain"})
+        self.record("webhook", status, fault, text=text)
+
+    def do_GET(self):
+        if self.path == CALLS_PATH:
+            self.handle_calls()
+        else:
+            self.respond(404)
+
+
+class SnsHandler(FakeHandler):
+    """
+    Answer SNS Publish calls in the query protocol
+    """
+
+    def do_POST(self):
+        if self.path == CALLS_PATH:
+            self.handle_calls()
+            return
+
+        parameters = parse_qs(self.read_body().decode("utf-8"))
+        action = parameters.get("Action", [""])[0]
+        fault = self.get_fault()
+        if fault is not None:
+            status, code = (400, "ThrottlingException") if fault == "throttle" else (500, "InternalError")
+            self.respond(status, create_query_error(code), {"Content-Type": "text/xml"})
+        else:
+            status = 200
+            self.respond(status, (
+                "<PublishResponse xmlns=\"http://sns.amazonaws.com/doc/2010-03-31/\">"
+                "<PublishResult><MessageId>{}</MessageId></PublishResult>"
+                "<ResponseMetadata><RequestId>{}</RequestId></ResponseMetadata>"
+                "</PublishResponse>"
+            ).format(uuid.uuid4(), uuid.uuid4()).encode("utf-8"), {"Content-Type": "text/xml"})
+        self.record(action, status, fault, text=parameters.get("Message", [""])[0])
+
+    def do_GET(self):
+        if self.path == CALLS_PATH:
+            self.handle_calls()
+        else:
+            self.respond(404)
+
+
+class CloudWatchHandler(FakeHandler):
+    """
+    Answer CloudWatch PutMetricData calls in the JSON protocol used by current botocore, or the query protocol of older ones
+    """
+
+    def do_POST(self):
+        if self.path == CALLS_PATH:
+            self.handle_calls()
+            return
+
+        body = self.read_body()
+        json_protocol = self.headers.get("Content-Type", "").startswith("application/x-amz-json")
+        if json_protocol:
+            operation = self.headers.get("X-Amz-Target", "").rsplit(".", 1)[-1]
+            datums = json.loads(body).get("MetricData", [])
+            items = len(datums)
+            endpoints = [
+                dimension["Value"]
+                for datum in datums
+                for dimension in datum.get("Dimensions", [])
+                if dimension.get("Name") == "ENDPOINT"
+            ]
+        else:
+            parameters = {name: values[0] for name, values in parse_qs(body.decode("utf-8")).items()}
+            operation = parameters.get("Action", "")
+            items = len({name.split(".")[2] for name in parameters if name.startswith("MetricData.member.")})
+            endpoints = [
+                parameters[name[:-len("Name")] + "Value"]
+                for name, value in parameters.items()
+                if name.endswith(".Name") and value == "ENDPOINT"
+            ]
+
+        fault = self.get_fault()
+        status = 200
+        if fault is not None:
+            status, code = (400, "ThrottlingException") if fault == "throttle" else (500, "InternalServiceFault")
+            if json_protocol:
+                self.respond(status, json.dumps({"__type": "com.amazonaws.cloudwatch#" + code, "message": code}).encode("utf-8"),
+                             {"Content-Type": "application/x-amz-json-1.0"})
+            else:
+                self.respond(status, create_query_error(code), {"Content-Type": "text/xml"})
+        elif json_protocol:
+            self.respond(status, b"{}", {"Content-Type": "application/x-amz-json-1.0"})
+        else:
+            self.respond(status, (
+                "<{0}Response><ResponseMetadata><RequestId>{1}</RequestId></ResponseMetadata></{0}Response>"
+            ).format(operation, uuid.uuid4()).encode("utf-8"), {"Content-Type": "text/xml"})
+        self.record(operation, status, fault, items=items, text=" ".join(endpoints))
+
+    def do_GET(self):
+        if self.path == CALLS_PATH:
+            self.handle_calls()
+        else:
+            self.respond(404)
+
+
+class S3Handler(FakeHandler):
+    """
+    Serve GetObject for the objects the fake was started with, honouring If-None-Match
+    """
+
+    def do_GET(self):
+        if self.path == CALLS_PATH:
+            self.handle_calls()
+            return
+
+        key = self.path.split("?")[0].lstrip("/")
+        body = self.server.objects.get(key)
+        fault = self.get_fault()
+        if fault is not None:
+            # S3 throttles with 503 SlowDown rather than a ThrottlingException
+            status, code = (503, "SlowDown") if fault == "throttle" else (500, "InternalError")
+            self.respond(status, create_s3_error(code), {"Content-Type": "application/xml"})
+        elif body is None:
+            status = 404
+            self.respond(status, create_s3_error("NoSuchKey"), {"Content-Type": "application/xml"})
+        else:
+            etag = "\"{}\"".format(hashlib.md5(body).hexdigest())
+            if self.headers.get("If-None-Match") == etag:
+                status = 304
+                self.respond(status, headers={"ETag": etag})
+            else:
+                status = 200
+                self.respond(status, body, {"Content-Type": "application/json", "ETag": etag})
+        self.record("GetObject", status, fault, text=key)
+
+    def do_POST(self):
+        if self.path == CALLS_PATH:
+            self.handle_calls()
+        else:
+            self.respond(405)
+
+
+def create_query_error(code):
+    return (
+        "<ErrorResponse><Error><Type>Sender</Type><Code>{}</Code><Message>{}</Message></Error>"
+        "<RequestId>{}</RequestId></ErrorResponse>"
+    ).format(code, code, uuid.uuid4()).encode("utf-8")
+
+
+def create_s3_error(code):
+    return "<Error><Code>{}</Code><Message>{}</Message></Error>".format(code, code).encode("utf-8")
+
+
+HANDLERS = {
+    "slack": SlackHandler,
+    "sns": SnsHandler,
+    "cloudwatch": CloudWatchHandler,
+    "s3": S3Handler
+}
+
+
+def start_fake(service, faults, objects):
+    server = StandInHTTPServer(("127.0.0.1", 0), HANDLERS[service])
+    server.faults = faults
+    server.objects = objects
+    server.random = random.Random(faults.seed)
+    server.lock = threading.Lock()
+    server.calls = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1]
+
+
+def serve(faults, objects, ports, stop):
+    ports.put({service: start_fake(service, faults, objects) for service in SERVICES})
+    stop.wait()
+
+
+class Fakes:
+    """
+    Run the fakes in a child process.
+
+    objects maps "bucket/key" to the bytes the S3 fake serves.
+    """
+
+    def __init__(self, faults, objects=None):
+        self.faults = faults
+        self.objects = dict(objects or {})
+        self.ports = None
+        self._stop = multiprocessing.Event()
+        self._process = None
+
+    def __enter__(self):
+        ports = multiprocessing.Queue()
+        self._process = multiprocessing.Process(target=serve, args=(self.faults, self.objects, ports, self._stop), daemon=True)
+        self._process.start()
+        self.ports = ports.get(timeout=30)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._process.join(5)
+        if self._process.is_alive():
+            self._process.terminate()
+
+    def get_url(self, service):
+        return "http://127.0.0.1:{}".format(self.ports[service])
+
+    def get_calls(self, service, clear=False):
+        request = urllib.request.Request(self.get_url(service) + CALLS_PATH, method="POST" if clear else "GET")
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read())
+
+    def clear_calls(self):
+        for service in SERVICES:
+            self.get_calls(service, clear=True)
@@ -0,0 +1,219 @@
+"""
+Benchmark Cupcake's probe cycle against local stand-in servers.
+
+Run from the repository root, for example:
+
+    python bench/run.py --endpoints 10000 --https 0.1 --tcp 0.1 --save thread-10k
+
+Cupcake's own settings (PROBE_ENGINE, MAX_WORKERS, HTTP_KEEP_ALIVE and so on)
+are read from the environment as usual, and are stored with each baseline.
+Cupcake's background services are started as main() starts them.
+"""
+import argparse
+import logging
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+from baselines import add_baseline_arguments, create_run, report_run
+from definitions import create_alert_definitions, create_endpoint_definitions, create_metrics_definitions, write_definitions
+from standins import StandInConfig, StandIns, parse_status_mix
+
+APP_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "app")
+
+# environment settings stored with a run, as they change what is being measured
+RECORDED_SETTINGS = ("PROBE_", "MAX_WORKERS", "HTTP_", "TLS_", "RETRY_", "DB_", "SCHEDULING", "CONNECTION_TIMEOUT_SECONDS", "ALERT_", "METRICS_", "OUTBOX_", "TELEMETRY_", "SPAN_SINK")
+# paths that differ from run to run
+UNRECORDED_SETTINGS = ("DB_NAME", "ALERT_DEFINITIONS_FILE", "METRICS_DEFINITIONS_FILE")
+
+SAMPLE_INTERVAL = 0.05
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark Cupcake's probe cycle against local stand-in servers")
+    parser.add_argument("--endpoints", type=int, default=1000, help="number of endpoints to generate")
+    parser.add_argument("--cycles", type=int, default=5, help="number of measured cycles")
+    parser.add_argument("--warmup", type=int, default=1, help="number of cycles to run before measuring")
+    parser.add_argument("--https", type=float, default=0.0, help="fraction of endpoints using https")
+    parser.add_argument("--tcp", type=float, default=0.0, help="fraction of endpoints using tcp")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds the stand-in servers wait before responding")
+    parser.add_argument("--status-mix", default="200:1", help="weighted statuses the stand-in servers respond with, e.g. 200:0.95,500:0.05")
+    parser.add_argument("--timeout-rate", type=float, default=0.0, help="fraction of requests that get no response")
+    parser.add_argument("--hang-seconds", type=float, default=5.0, help="seconds a request that gets no response is held open")
+    parser.add_argument("--no-keep-alive", action="store_true", help="close the connection after every response")
+    parser.add_argument("--log-level", default="WARNING", help="log level for Cupcake while benchmarking")
+    add_baseline_arguments(parser)
+    return parser.parse_args()
+
+
+def get_schemes(arguments):
+    schemes = ["http"]
+    if arguments.https > 0:
+        schemes.append("https")
+    if arguments.tcp > 0:
+        schemes.append("tcp")
+    return schemes
+
+
+def set_environment(directory, paths):
+    """
+    Fill in the settings Cupcake requires, leaving any already set alone
+    """
+    defaults = dict(paths)
+    defaults.update({
+        "SLEEP_SECONDS": "60",
+        "CONNECTION_TIMEOUT_SECONDS": "2",
+        "DB_TYPE": "sqlite",
+        "DB_NAME": os.path.join(directory, "cupcake.db"),
+        "SUMMARY_ENABLED": "False",
+        "SUMMARY_SLEEP_SECONDS": "3600",
+        "TLS_VERIFY": "False"
+    })
+    for name, value in defaults.items():
+        os.environ.setdefault(name, value)
+
+
+def get_recorded_settings():
+    return {name: value for name, value in sorted(os.environ.items()) if name.startswith(RECORDED_SETTINGS) and name not in UNRECORDED_SETTINGS}
+
+
+class ResourceSampler:
+    """
+    Track the peak number of threads and open file descriptors of this process
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.peak_threads = 0
+        self.peak_fds = 0
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            self.sample()
+            if self._stopping.wait(self.interval):
+                break
+
+    def sample(self):
+        self.peak_threads = max(self.peak_threads, threading.active_count())
+        try:
+            self.peak_fds = max(self.peak_fds, len(os.listdir("/proc/self/fd")))
+        except OSError:
+            # not available outside Linux
+            pass
+
+
+def get_percentile(values, percentile):
+    """
+    Nearest-rank percentile
+    """
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * percentile // 100))
+    return ordered[int(rank) - 1]
+
+
+def get_peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    if sys.platform == "darwin":
+        return peak / 1024.0 / 1024.0
+    return peak / 1024.0
+
+
+def run_benchmark(cupcake, arguments):
+    for _ in range(arguments.warmup):
+        cupcake.lifecycle()
+
+    loads = []
+    checks = []
+    cycles = []
+
+    sampler = ResourceSampler(SAMPLE_INTERVAL)
+    sampler.start()
+    try:
+        for _ in range(arguments.cycles):
+            started = time.perf_counter()
+            cupcake.load_definitions()
+            loaded = time.perf_counter()
+            cupcake.endpoints_check()
+            finished = time.perf_counter()
+
+            loads.append(loaded - started)
+            checks.append(finished - loaded)
+            cycles.append(finished - started)
+    finally:
+        sampler.stop()
+
+    return {
+        "endpoints_per_second": arguments.endpoints / get_percentile(cycles, 50),
+        "cycle_p50": get_percentile(cycles, 50),
+        "cycle_p99": get_percentile(cycles, 99),
+        "check_p50": get_percentile(checks, 50),
+        "load_p50": get_percentile(loads, 50),
+        "peak_rss_mb": get_peak_rss_mb(),
+        "peak_threads": sampler.peak_threads,
+        "peak_fds": sampler.peak_fds
+    }
+
+
+def main():
+    arguments = get_arguments()
+
+    config = StandInConfig(
+        latency=arguments.latency,
+        status_mix=parse_status_mix(arguments.status_mix),
+        timeout_rate=arguments.timeout_rate,
+        hang_seconds=arguments.hang_seconds,
+        keep_alive=not arguments.no_keep_alive
+    )
+
+    # start the servers before Cupcake is imported, so the child process does not inherit its threads
+    with StandIns(config, get_schemes(arguments)) as standins, tempfile.TemporaryDirectory() as directory:
+        paths = write_definitions(
+            directory,
+            create_endpoint_definitions(arguments.endpoints, standins.ports, arguments.https, arguments.tcp),
+            create_alert_definitions(),
+            create_metrics_definitions()
+        )
+        set_environment(directory, paths)
+
+        sys.path.insert(0, APP_DIRECTORY)
+        import logzero
+        logzero.loglevel(getattr(logging, arguments.log_level.upper()))
+        import cupcake
+
+        # start what main() would, so that settings such as ALERT_WORKERS and METRICS_BATCHING take effect
+        cupcake.start_services()
+        try:
+            results = run_benchmark(cupcake, arguments)
+        finally:
+            cupcake.shutdown()
+
+    parameters = {
+        "endpoints": arguments.endpoints,
+        "cycles": arguments.cycles,
+        "https": arguments.https,
+        "tcp": arguments.tcp,
+        "latency": arguments.latency,
+        "status_mix": arguments.status_mix,
+        "timeout_rate": arguments.timeout_rate,
+        "hang_seconds": arguments.hang_seconds,
+        "keep_alive": not arguments.no_keep_alive
+    }
+
+    report_run(create_run(parameters, get_recorded_settings(), results), arguments)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""
+Local stand-in HTTP, HTTPS and TCP servers for benchmarking Cupcake.
+
+The servers run in their own process so that they do not count towards the
+memory, threads and file descriptors measured in the Cupcake process.
+"""
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import multiprocessing
+import os
+import random
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+
+class StandInConfig:
+    """
+    Describe how the stand-in servers respond.
+
+    status_mix is a list of (status, weight). The status of an endpoint is
+    chosen from its path, so each endpoint keeps the same status from cycle to
+    cycle. timeout_rate is the chance that any one request gets no response
+    for hang_seconds.
+    """
+
+    def __init__(self, latency=0.0, status_mix=((200, 1.0),), timeout_rate=0.0, hang_seconds=5.0, keep_alive=True, seed=0):
+        self.latency = latency
+        self.status_mix = tuple(status_mix)
+        self.timeout_rate = timeout_rate
+        self.hang_seconds = hang_seconds
+        self.keep_alive = keep_alive
+        self.seed = seed
+
+
+def parse_status_mix(text):
+    """
+    Parse "200:0.95,500:0.05" into [(200, 0.95), (500, 0.05)]
+    """
+    mix = []
+    for part in text.split(","):
+        status, _, weight = part.partition(":")
+        mix.append((int(status), float(weight or 1)))
+    return mix
+
+
+def choose_status(path, status_mix):
+    draw = zlib.crc32(path.encode("utf-8")) / 2 ** 32 * sum([weight for _, weight in status_mix])
+    for status, weight in status_mix:
+        if draw < weight:
+            return status
+        draw = draw - weight
+    return status_mix[-1][0]
+
+
+def create_handler(config):
+    timeouts = random.Random(config.seed)
+
+    class StandInHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1" if config.keep_alive else "HTTP/1.0"
+
+        def do_GET(self):
+            if config.timeout_rate > 0 and timeouts.random() < config.timeout_rate:
+                time.sleep(config.hang_seconds)
+                self.close_connection = True
+                return
+
+            if config.latency > 0:
+                time.sleep(config.latency)
+
+            body = b"ok"
+            self.send_response(choose_status(self.path.split("?")[0], config.status_mix))
+            self.send_header("Content-Length", str(len(body)))
+            if not config.keep_alive:
+                self.send_header("Connection", "close")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return StandInHandler
+
+
+class StandInHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 4096
+    ssl_context = None
+
+    def finish_request(self, request, client_address):
+        # handshake on the request's own thread rather than the one accepting connections
+        if self.ssl_context is not None:
+            try:
+                request = self.ssl_context.wrap_socket(request, server_side=True)
+            except (ssl.SSLError, OSError):
+                return
+        super().finish_request(request, client_address)
+
+    def handle_error(self, request, client_address):
+        # clients closing a connection they have finished with is not an error here
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def create_certificate(directory):
+    """
+    Create a self-signed certificate for localhost with the openssl command
+    """
+    certificate = os.path.join(directory, "cert.pem")
+    key = os.path.join(directory, "key.pem")
+    subprocess.run([
+        "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "2",
+        "-keyout", key, "-out", certificate, "-subj", "/CN=localhost"
+    ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certificate, key
+
+
+def start_http_server(config, directory=None):
+    server = StandInHTTPServer(("127.0.0.1", 0), create_handler(config))
+
+    if directory is not None:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(*create_certificate(directory))
+        server.ssl_context = context
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1]
+
+
+def start_tcp_server():
+    """
+    Accept connections and close them straight away; a TCP probe only needs the connection to open
+    """
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(4096)
+
+    def accept():
+        while True:
+            connection, _ = listener.accept()
+            connection.close()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+def serve(config, schemes, ports, stop):
+    with tempfile.TemporaryDirectory() as directory:
+        started = {}
+        if "http" in schemes:
+            started["http"] = start_http_server(config)
+        if "https" in schemes:
+            started["https"] = start_http_server(config, directory)
+        if "tcp" in schemes:
+            started["tcp"] = start_tcp_server()
+        ports.put(started)
+        stop.wait()
+
+
+class StandIns:
+    """
+    Run the stand-in servers for some schemes in a child process, exposing the port of each scheme
+    """
+
+    def __init__(self, config, schemes=("http", "https", "tcp")):
+        self.config = config
+        self.schemes = tuple(schemes)
+        self.ports = None
+        self._stop = multiprocessing.Event()
+        self._process = None
+
+    def __enter__(self):
+        ports = multiprocessing.Queue()
+        self._process = multiprocessing.Process(target=serve, args=(self.config, self.schemes, ports, self._stop), daemon=True)
+        self._process.start()
+        self.ports = ports.get(timeout=30)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._process.join(5)
+        if self._process.is_alive():
+            self._process.terminate()
@@ -0,0 +1,285 @@
+"""
+Benchmark Cupcake's alert and metric delivery during an outage storm, against local fakes of Slack, SNS, CloudWatch and S3.
+
+Run from the repository root, for example:
+
+    python bench/storm.py --incidents 500 --latency 0.05 --throttle-rate 0.05 --save storm-500
+
+Each round raises --incidents incidents at once from --concurrency threads,
+as probe workers would when a shared dependency goes down. Every incident is
+committed as a new active alert, alerted to a Slack webhook and an SNS topic,
+and records one CloudWatch metric. The alert and metric definitions are read
+from the S3 fake. Delivery settings (ALERT_WORKERS, ALERT_COALESCING,
+ALERT_OUTBOX, METRICS_BATCHING and so on) are read from the environment as
+usual, and are stored with each baseline.
+"""
+from concurrent.futures.thread import ThreadPoolExecutor
+from types import SimpleNamespace
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import time
+
+from baselines import add_baseline_arguments, create_run, report_run
+from definitions import create_alert_definitions, create_metrics_definitions
+from fakes import Fakes, FaultConfig
+from run import APP_DIRECTORY, get_percentile, get_recorded_settings, set_environment
+
+BUCKET = "cupcake-bench"
+
+SLACK_ALERT = {
+    "@type": "alert-slack-webhook",
+    "id": "storm-slack",
+    "url": "https://hooks.slack.com/services/T00000000/B00000000/storm"
+}
+
+SNS_ALERT = {
+    "@type": "alert-sns",
+    "id": "storm-sns",
+    "arn": "arn:aws:sns:eu-west-1:000000000000:storm",
+    "region": "eu-west-1"
+}
+
+CLOUDWATCH_METRICS = {
+    "@type": "metrics",
+    "id": "storm-cloudwatch",
+    "provider": {
+        "@type": "cloudwatch",
+        "region": "eu-west-1",
+        "namespace": "CUPCAKE-STORM"
+    }
+}
+
+# the fakes that receive alerts, and the one that receives metrics
+ALERT_SERVICES = ("slack", "sns")
+METRIC_SERVICE = "cloudwatch"
+
+# incident and endpoint names carry their number, so deliveries can be matched to when they were raised
+NUMBER = re.compile(r"storm-(?:incident|endpoint)-(\d+)")
+
+# result name, label, whether a higher value is better, and the smallest change that is not noise
+STORM_MEASURES = [
+    ("alerts_per_second", "alerts/sec", True, 0),
+    ("alert_p50", "alert latency p50 (s)", False, 0.01),
+    ("alert_p99", "alert latency p99 (s)", False, 0.01),
+    ("alerts_undelivered", "alerts undelivered", False, 0),
+    ("metrics_per_second", "metrics/sec", True, 0),
+    ("metric_p50", "metric latency p50 (s)", False, 0.01),
+    ("metric_p99", "metric latency p99 (s)", False, 0.01),
+    ("metrics_undelivered", "metrics undelivered", False, 0),
+    ("storm_p50", "storm p50 (s)", False, 0.01),
+    ("throttled_calls", "throttled calls", False, 0),
+    ("failed_calls", "failed calls", False, 0),
+    ("config_load", "S3 config load (s)", False, 0.01),
+    ("config_reload", "S3 config reload (s)", False, 0.01)
+]
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark Cupcake's alert and metric delivery during an outage storm")
+    parser.add_argument("--incidents", type=int, default=500, help="number of incidents raised at once in each round")
+    parser.add_argument("--rounds", type=int, default=3, help="number of measured rounds")
+    parser.add_argument("--concurrency", type=int, default=32, help="number of threads raising incidents")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds the fakes wait before answering")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of calls throttled (HTTP 429 or ThrottlingException)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls failing with a server error")
+    parser.add_argument("--seed", type=int, default=0, help="seed for choosing which calls are throttled or fail")
+    parser.add_argument("--log-level", default="CRITICAL", help="log level for Cupcake while benchmarking")
+    add_baseline_arguments(parser)
+    return parser.parse_args()
+
+
+def set_fake_environment(fakes):
+    """
+    Point Cupcake at the fakes, with credentials for botocore to sign its requests with
+    """
+    os.environ["WEBHOOK_HOST_OVERRIDE"] = fakes.get_url("slack")
+    os.environ["SNS_ENDPOINT_URL"] = fakes.get_url("sns")
+    os.environ["CLOUDWATCH_ENDPOINT_URL"] = fakes.get_url("cloudwatch")
+    os.environ["S3_ENDPOINT_URL"] = fakes.get_url("s3")
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "storm")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "storm")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-1")
+
+
+def get_delivery_times(calls):
+    """
+    Return the time each numbered incident or endpoint was first delivered, and the number of throttled and failed calls
+    """
+    delivered = {}
+    throttled = 0
+    failed = 0
+    for call in calls:
+        if call["fault"] == "throttle":
+            throttled = throttled + 1
+        elif call["fault"] == "error":
+            failed = failed + 1
+        else:
+            for number in NUMBER.findall(call["text"]):
+                delivered[int(number)] = min(call["time"], delivered.get(int(number), call["time"]))
+    return delivered, throttled, failed
+
+
+def run_round(app, fakes, arguments, first):
+    cupcake, alerts, metrics, settings, models = app.cupcake, app.alerts, app.metrics, app.settings, app.models
+
+    raised = {}
+
+    def raise_incident(number):
+        endpoint = models.Endpoint(
+            environment_group="storm",
+            environment="storm",
+            endpoint_group="storm",
+            endpoint="storm-endpoint-{}".format(number),
+            url="https://storm.invalid/{}".format(number)
+        )
+        timestamp = time.time()
+        raised[number] = timestamp
+        incident = models.Incident(
+            timestamp=timestamp,
+            endpoint=endpoint,
+            result={"result": False, "message": "connection refused"},
+            expected="^2\\d\\d$",
+            message="storm-incident-{} is down: connection refused".format(number)
+        )
+        # as handle_result() does for a new alert, so the active table and any outbox are written too
+        cupcake.commit_incident(cupcake.db, incident, ["default"], cleared=False)
+        metrics.deliver_metric_to_groups(
+            models.Metric(endpoint=endpoint, timestamp=timestamp, name="RESPONSE-TIME", data=1000.0),
+            ["default"],
+            cupcake.metrics_definitions
+        )
+
+    fakes.clear_calls()
+    cupcake.start_services()
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=arguments.concurrency) as executor:
+        list(executor.map(raise_incident, range(first, first + arguments.incidents)))
+    if settings.ALERT_COALESCING_SECONDS == 0:
+        alerts.flush_coalesced()
+    # stops and drains delivery, including a last pass over the outbox
+    cupcake.shutdown()
+    finished = time.time()
+
+    alert_latencies = []
+    throttled = 0
+    failed = 0
+    for service in ALERT_SERVICES:
+        delivered, service_throttled, service_failed = get_delivery_times(fakes.get_calls(service))
+        alert_latencies.extend([delivered[number] - raised[number] for number in delivered if number in raised])
+        throttled = throttled + service_throttled
+        failed = failed + service_failed
+
+    delivered, service_throttled, service_failed = get_delivery_times(fakes.get_calls(METRIC_SERVICE))
+    metric_latencies = [delivered[number] - raised[number] for number in delivered if number in raised]
+
+    return {
+        "seconds": finished - started,
+        "alert_latencies": alert_latencies,
+        "metric_latencies": metric_latencies,
+        "throttled": throttled + service_throttled,
+        "failed": failed + service_failed
+    }
+
+
+def run_benchmark(app, fakes, arguments):
+    loader = app.config_source.ConfigLoader({
+        "alerts": app.settings.ALERT_DEFINITIONS_FILE,
+        "metrics": app.settings.METRICS_DEFINITIONS_FILE
+    })
+    started = time.perf_counter()
+    loader.load()
+    config_load = time.perf_counter() - started
+    # unchanged definitions come back as 304 Not Modified
+    started = time.perf_counter()
+    loader.load()
+    config_reload = time.perf_counter() - started
+
+    app.cupcake.alert_definitions = loader.get("alerts")
+    app.cupcake.metrics_definitions = loader.get("metrics")
+
+    rounds = [
+        run_round(app, fakes, arguments, index * arguments.incidents)
+        for index in range(arguments.rounds)
+    ]
+
+    seconds = sum([storm["seconds"] for storm in rounds])
+    alert_latencies = [latency for storm in rounds for latency in storm["alert_latencies"]] or [0.0]
+    metric_latencies = [latency for storm in rounds for latency in storm["metric_latencies"]] or [0.0]
+    alerts_expected = arguments.incidents * arguments.rounds * len(ALERT_SERVICES)
+    metrics_expected = arguments.incidents * arguments.rounds
+    alerts_delivered = sum([len(storm["alert_latencies"]) for storm in rounds])
+    metrics_delivered = sum([len(storm["metric_latencies"]) for storm in rounds])
+
+    return {
+        "alerts_per_second": alerts_delivered / seconds,
+        "alert_p50": get_percentile(alert_latencies, 50),
+        "alert_p99": get_percentile(alert_latencies, 99),
+        "alerts_undelivered": alerts_expected - alerts_delivered,
+        "metrics_per_second": metrics_delivered / seconds,
+        "metric_p50": get_percentile(metric_latencies, 50),
+        "metric_p99": get_percentile(metric_latencies, 99),
+        "metrics_undelivered": metrics_expected - metrics_delivered,
+        "storm_p50": get_percentile([storm["seconds"] for storm in rounds], 50),
+        "throttled_calls": sum([storm["throttled"] for storm in rounds]),
+        "failed_calls": sum([storm["failed"] for storm in rounds]),
+        "config_load": config_load,
+        "config_reload": config_reload
+    }
+
+
+def main():
+    arguments = get_arguments()
+
+    objects = {
+        BUCKET + "/alerts.json": json.dumps(create_alert_definitions([SLACK_ALERT, SNS_ALERT])).encode("utf-8"),
+        BUCKET + "/metrics.json": json.dumps(create_metrics_definitions([CLOUDWATCH_METRICS])).encode("utf-8")
+    }
+    faults = FaultConfig(
+        latency=arguments.latency,
+        throttle_rate=arguments.throttle_rate,
+        error_rate=arguments.error_rate,
+        seed=arguments.seed
+    )
+
+    # start the fakes before Cupcake is imported, so the child process does not inherit its threads
+    with Fakes(faults, objects) as fakes, tempfile.TemporaryDirectory() as directory:
+        set_fake_environment(fakes)
+        set_environment(directory, {
+            "ENDPOINT_DEFINITIONS_FILE": os.path.join(directory, "endpoints.json"),
+            "ALERT_DEFINITIONS_FILE": "s3://{}/alerts.json".format(BUCKET),
+            "METRICS_DEFINITIONS_FILE": "s3://{}/metrics.json".format(BUCKET)
+        })
+
+        sys.path.insert(0, APP_DIRECTORY)
+        import logzero
+        logzero.loglevel(getattr(logging, arguments.log_level.upper()))
+        import alerts
+        import config_source
+        import cupcake
+        import metrics
+        import models
+        import settings
+
+        app = SimpleNamespace(alerts=alerts, config_source=config_source, cupcake=cupcake, metrics=metrics, models=models, settings=settings)
+        results = run_benchmark(app, fakes, arguments)
+
+    parameters = {
+        "incidents": arguments.incidents,
+        "rounds": arguments.rounds,
+        "concurrency": arguments.concurrency,
+        "latency": arguments.latency,
+        "throttle_rate": arguments.throttle_rate,
+        "error_rate": arguments.error_rate,
+        "seed": arguments.seed
+    }
+
+    report_run(create_run(parameters, get_recorded_settings(), results), arguments, STORM_MEASURES)
+
+
+if __name__ == "__main__":
+    main()